@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare the JSON backends of pymatter.serializer on attachment heavy messages.
+
+Usage: python benchmarks/bench_json.py [-n NUMBER] [-a ATTACHMENTS]
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import timeit
+
+from pymatter.base import IncomingMessage, Attachment, Field, Code
+from pymatter.serializer import BACKENDS, BACKEND, get_backend
+
+
+def payload(attachments):
+    msg = IncomingMessage(text="**build #1234 failed** on `ci-runner-07`", channel='builds')
+    for i in range(attachments):
+        log = "".join("[{:05d}] compiling module_{}.c ... warning: unused variable ‘x’\n".format(n, n) for n in range(40))
+        att = Attachment(fallback='build.log', title='build.log (part {})'.format(i + 1), color='#d00000',
+                         text=Code(log, 'bash'), author_name='jenkins', author_link='https://ci.example.com/job/1234')
+        att.fields.append(Field('Date', 'Mon Jan  1 00:00:00 2024', True))
+        att.fields.append(Field('Local user', 'jenkins', True))
+        att.fields.append(Field('Hostname', 'ci-runner-07', True))
+        msg.attachments.append(att)
+    return msg.to_dict()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the JSON backends")
+    parser.add_argument("-n", "--number", type=int, default=2000, help="Number of iterations")
+    parser.add_argument("-a", "--attachments", type=int, default=10, help="Number of attachments per message")
+    args = parser.parse_args()
+
+    d = payload(args.attachments)
+    print("selected backend: {}".format(BACKEND))
+    results = {}
+    for name in sorted(BACKENDS):
+        try:
+            dumpb, loads = get_backend(name)
+        except ImportError:
+            print("{:<8} not installed".format(name))
+            continue
+        data = dumpb(d)
+        dump_time = min(timeit.repeat(lambda: dumpb(d), number=args.number, repeat=5)) / args.number * 1e6
+        load_time = min(timeit.repeat(lambda: loads(data), number=args.number, repeat=5)) / args.number * 1e6
+        results[name] = (dump_time, load_time)
+        print("{:<8} {:>7} bytes   dumpb {:>9.2f} us   loads {:>9.2f} us".format(name, len(data), dump_time, load_time))
+    if 'json' in results:
+        for name, (dump_time, load_time) in sorted(results.items()):
+            print("{:<8} speedup over json: dumpb x{:.1f}, loads x{:.1f}".format(
+                name, results['json'][0] / dump_time, results['json'][1] / load_time
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare the message model with the previous __dict__ based classes: memory allocated per message, to_dict and dumps.
+
+Usage: python benchmarks/bench_model.py [-n NUMBER]
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import json
+import timeit
+import tracemalloc
+
+from pymatter.base import IncomingMessage, Attachment, Field, decode_text
+
+
+class LegacyIncomingMessage(object):
+    def __init__(self, text=u'', username=u'pymatter', icon_url=None, channel=None, attachments=None):
+        self.text = decode_text(text)
+        self.username = decode_text(username)
+        self.icon_url = decode_text(icon_url)
+        self.channel = decode_text(channel)
+        self.attachments = [] if not attachments else [LegacyAttachment.factory(a) for a in attachments]
+
+    def to_dict(self):
+        d = {}
+        for attr in ['text', 'username', 'icon_url', 'channel']:
+            if self.__getattribute__(attr):
+                d[attr] = self.__getattribute__(attr)
+        if self.attachments:
+            d['attachments'] = [a.to_dict() for a in self.attachments]
+        return d
+
+    def dumps(self):
+        return json.dumps(self.to_dict())
+
+
+class LegacyAttachment(object):
+    def __init__(self, text=u'', fallback=u'', title=u'', color=None, pretext=u'', author_name=None, author_link=None,
+                 author_icon=None, title_link=None, image_url=None, thumb_url=None, fields=None):
+        self.fallback = decode_text(fallback)
+        self.title = decode_text(title)
+        self.text = decode_text(text)
+        self.color = decode_text(color)
+        self.pretext = decode_text(pretext)
+        self.author_name = decode_text(author_name)
+        self.author_link = decode_text(author_link)
+        self.author_icon = decode_text(author_icon)
+        self.title_link = decode_text(title_link)
+        self.image_url = decode_text(image_url)
+        self.thumb_url = decode_text(thumb_url)
+        self.fields = [] if not fields else [LegacyField.factory(f) for f in fields]
+
+    @classmethod
+    def factory(cls, d):
+        if isinstance(d, LegacyAttachment):
+            return d
+        raise NotImplementedError
+
+    def to_dict(self):
+        d = {}
+        for attr in [
+            'fallback', 'color', 'pretext', 'author_name', 'author_link', 'author_icon', 'title', 'title_link',
+            'text', 'image_url', 'thumb_url'
+        ]:
+            if self.__getattribute__(attr):
+                d[attr] = self.__getattribute__(attr)
+        if self.fields:
+            d['fields'] = [f.to_dict() for f in self.fields]
+        return d
+
+
+class LegacyField(object):
+    def __init__(self, title, value, short=False):
+        self.title = decode_text(title)
+        self.value = decode_text(value)
+        self.short = bool(short)
+
+    @classmethod
+    def factory(cls, f):
+        if isinstance(f, LegacyField):
+            return f
+        raise NotImplementedError
+
+    def to_dict(self):
+        d = {}
+        if self.title:
+            d['title'] = self.title
+        if self.value:
+            d['value'] = self.value
+        d['short'] = self.short
+        return d
+
+
+def build(message_cls, attachment_cls, field_cls):
+    attachments = []
+    for i in range(3):
+        fields = [field_cls('Hostname', 'host{}'.format(i), True), field_cls('Date', 'Mon Jan  1 00:00:00 2024', True)]
+        attachments.append(attachment_cls(text='line {}\n'.format(i) * 20, fallback='attachment', title='file.log',
+                                          color='#ff0000', fields=fields))
+    return message_cls(text='**alert**', channel='ops', attachments=attachments)
+
+
+def allocated(func, number):
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    objects = [func() for _ in range(number)]
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del objects
+    return size / number
+
+
+def per_call(func, number):
+    """
+    Best time of a call over 5 runs, in microseconds.
+    """
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def report(name, legacy, current, unit):
+    print("{:<28} legacy {:>10.2f} {}   current {:>10.2f} {}   ratio {:.2f}".format(
+        name, legacy, unit, current, unit, legacy / current if current else float('inf')
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the message model")
+    parser.add_argument("-n", "--number", type=int, default=5000, help="Number of iterations")
+    args = parser.parse_args()
+    n = args.number
+
+    def legacy():
+        return build(LegacyIncomingMessage, LegacyAttachment, LegacyField)
+
+    def current():
+        return build(IncomingMessage, Attachment, Field)
+
+    report("bytes per message", allocated(legacy, 1000), allocated(current, 1000), "B ")
+    report("build", per_call(legacy, n), per_call(current, n), "us")
+
+    legacy_msg, current_msg = legacy(), current()
+    report("to_dict", per_call(legacy_msg.to_dict, n), per_call(current_msg.to_dict, n), "us")
+    report("dumps (same message)", per_call(legacy_msg.dumps, n), per_call(current_msg.dumps, n), "us")
+    report("build + dumps", per_call(lambda: legacy().dumps(), n), per_call(lambda: current().dumps(), n), "us")
+
+    text = current_msg.dumps()
+    report("loads (validated / trusted)", per_call(lambda: IncomingMessage.loads(text), n),
+           per_call(lambda: IncomingMessage.loads(text, validate=False), n), "us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+"""
+Startup time of the command line tools.
+
+For each entry point, the module is imported with ``python -X importtime`` and ``--help`` is run, several times in
+fresh interpreters. The medians are reported, with the modules that take the most time to import. Results are saved
+as JSON, and two result files can be compared.
+
+Usage: python benchmarks/bench_startup.py [-e pymatter.echo,...] [-r REPEAT] [--top N] [-o FILE]
+       python benchmarks/bench_startup.py --compare OLD.json NEW.json [--threshold 0.1]
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from os.path import abspath, dirname, join, exists
+
+ROOT = dirname(dirname(abspath(__file__)))
+HERE = dirname(abspath(__file__))
+ENTRY_POINTS = ('pymatter.echo', 'pymatter.tee', 'pymatter.cat', 'pymatter.tail', 'pymatter.mgpoll', 'pymatter.smtpd')
+
+
+def child_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def import_times(module):
+    """
+    Import `module` in a fresh interpreter; return the cumulative import time of each module, in seconds.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)], env=child_env(), cwd=ROOT,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    _, err = proc.communicate()
+    times = {}
+    for line in err.decode('utf-8', 'replace').splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        times[parts[2].strip()] = int(parts[1]) / 1e6
+    return times
+
+
+def help_time(module):
+    started = time.time()
+    subprocess.call([sys.executable, '-m', module, '--help'], env=child_env(), cwd=ROOT,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.time() - started
+
+
+def measure(module, repeat, top):
+    # the first run compiles the bytecode
+    import_times(module)
+    runs = [import_times(module) for _ in range(repeat)]
+    heaviest = sorted(runs[-1].items(), key=lambda item: -item[1])
+    return {
+        'entry_point': module,
+        'import': median([run.get(module, 0.0) for run in runs]),
+        'help': median([help_time(module) for _ in range(repeat)]),
+        'requests': any('requests' in run for run in runs),
+        'heaviest': [[name, seconds] for name, seconds in heaviest if name not in (module, 'site')][:top]
+    }
+
+
+def format_result(result):
+    return '{:<16} import={:7.1f}ms  --help={:7.1f}ms  requests={}  heaviest: {}'.format(
+        result['entry_point'], result['import'] * 1000, result['help'] * 1000,
+        'yes' if result['requests'] else 'no',
+        ', '.join('{} {:.1f}ms'.format(name, seconds * 1000) for name, seconds in result['heaviest'][:3])
+    )
+
+
+def compare(old_file, new_file, threshold):
+    with open(old_file) as f:
+        old = dict((r['entry_point'], r) for r in json.load(f)['results'])
+    with open(new_file) as f:
+        new = dict((r['entry_point'], r) for r in json.load(f)['results'])
+    regressions = 0
+    for name in sorted(set(old) & set(new)):
+        for key in ('import', 'help'):
+            change = (new[name][key] - old[name][key]) / old[name][key] if old[name][key] else 0.0
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            print('{:<16} {:<6} {:7.1f}ms -> {:7.1f}ms  {:+.0%}{}'.format(
+                name, key, old[name][key] * 1000, new[name][key] * 1000, change, flag
+            ))
+    return regressions
+
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=ROOT) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return revision + ('-dirty' if dirty else '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pymatter startup benchmark")
+    parser.add_argument("-e", "--entrypoints", default=','.join(ENTRY_POINTS), help="Comma separated modules")
+    parser.add_argument("-r", "--repeat", type=int, default=7, help="Number of runs per measure")
+    parser.add_argument("--top", type=int, default=10, help="Number of heaviest imports saved per entry point")
+    parser.add_argument("-o", "--output", help="Result file (default: benchmarks/results/startup-REVISION.json)")
+    parser.add_argument("--compare", nargs=2, metavar=('OLD', 'NEW'), help="Compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change reported as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    results = []
+    for module in args.entrypoints.split(','):
+        results.append(measure(module, max(1, args.repeat), args.top))
+        print(format_result(results[-1]))
+        sys.stdout.flush()
+    report = {'revision': git_revision(), 'python': sys.version.split()[0], 'results': results}
+    output = args.output or join(HERE, 'results', 'startup-{}.json'.format(report['revision']))
+    if not exists(dirname(output)):
+        os.makedirs(dirname(output))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results saved to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
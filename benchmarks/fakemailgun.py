@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in for the Mailgun events and stored messages APIs, used to exercise pymatter.mgpoll.
+
+`events` stored events are available from the start; POST /add?n=N stores N more. Every answer is delayed by
+`latency` seconds. GET /stats returns the counters as JSON, including the stored messages fetched more than once.
+With `overlap`, the next page of a full page starts `overlap` events before its end, as the Mailgun pages may overlap.
+
+Usage: python benchmarks/fakemailgun.py [--port PORT] [--events N] [--latency SECONDS] [--overlap N]
+
+The API URL (the api_url setting of mgpoll) is printed on stdout once the server listens.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import json
+import sys
+import time
+
+import tornado.gen
+import tornado.ioloop
+import tornado.netutil
+import tornado.httpserver
+import tornado.web
+
+
+class Store(object):
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.events = []
+        self.fetched = {}
+        self.pages = 0
+
+    def add(self, number):
+        for _ in range(number):
+            i = len(self.events)
+            self.events.append({
+                'id': 'event-{}'.format(i),
+                'event': 'stored',
+                'timestamp': time.time(),
+                'storage': {'key': 'key{}'.format(i), 'url': '{}/messages/key{}'.format(self.base_url, i)}
+            })
+
+    def to_dict(self):
+        return {
+            'events': len(self.events),
+            'pages': self.pages,
+            'fetched': len(self.fetched),
+            'duplicates': sum(n - 1 for n in self.fetched.values())
+        }
+
+
+class MailgunHandler(tornado.web.RequestHandler):
+    def initialize(self, options, store):
+        self.options = options
+        self.store = store
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        if not self.request.headers.get('Authorization'):
+            self.send_error(401)
+        elif self.options.latency:
+            yield tornado.gen.sleep(self.options.latency)
+
+
+class EventsHandler(MailgunHandler):
+    def get(self, domain, offset=None):
+        store = self.store
+        store.pages += 1
+        offset = int(offset or 0)
+        limit = int(self.get_argument('limit', '300'))
+        items = store.events[offset:offset + limit]
+        overlap = min(self.options.overlap, len(items) - 1) if len(items) == limit else 0
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps({
+            'items': items,
+            'paging': {'next': '{}/{}/events/{}?limit={}'.format(
+                store.base_url, domain, offset + len(items) - overlap, limit
+            )}
+        }))
+
+
+class MessageHandler(MailgunHandler):
+    def get(self, key):
+        i = int(key[3:])
+        self.store.fetched[key] = self.store.fetched.get(key, 0) + 1
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps({
+            'From': 'sender{}@example.org'.format(i),
+            'To': 'alerts@example.org',
+            'Subject': 'mail {}'.format(i),
+            'Date': 'Mon, 02 Jan 2017 10:00:00 +0000',
+            'body-plain': 'body of mail {}\n'.format(i) + 'x' * 200,
+            'attachments': []
+        }))
+
+
+class AddHandler(tornado.web.RequestHandler):
+    def initialize(self, store):
+        self.store = store
+
+    def post(self):
+        self.store.add(int(self.get_argument('n', '1')))
+        self.finish(json.dumps(self.store.to_dict()))
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, store):
+        self.store = store
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(self.store.to_dict()))
+
+
+def make_app(options, store):
+    args = {'options': options, 'store': store}
+    return tornado.web.Application([
+        (r'/stats', StatsHandler, {'store': store}),
+        (r'/add', AddHandler, {'store': store}),
+        (r'/v3/messages/(.*)', MessageHandler, args),
+        (r'/v3/([^/]+)/events', EventsHandler, args),
+        (r'/v3/([^/]+)/events/(\d+)', EventsHandler, args)
+    ])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fake Mailgun API")
+    parser.add_argument("--port", type=int, default=0, help="Listening port (0 for a random port)")
+    parser.add_argument("--events", type=int, default=0, help="Number of stored events available from the start")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before answering")
+    parser.add_argument("--overlap", type=int, default=0, help="Events repeated at the start of the next page")
+    return parser.parse_args(argv)
+
+
+def main():
+    options = parse_args()
+    sockets = tornado.netutil.bind_sockets(options.port, '127.0.0.1')
+    store = Store('http://127.0.0.1:{}/v3'.format(sockets[0].getsockname()[1]))
+    store.add(options.events)
+    server = tornado.httpserver.HTTPServer(make_app(options, store))
+    server.add_sockets(sockets)
+    print(store.base_url)
+    sys.stdout.flush()
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
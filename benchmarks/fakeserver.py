@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in for a Mattermost incoming webhook.
+
+Every POST is answered after `latency` seconds: with a 500 error with probability `error_rate`, with a 429 and a
+Retry-After header with probability `throttle_rate` (or when more than `rate_limit` requests per second arrive),
+and with 200 otherwise. GET /stats returns the counters as JSON.
+
+Usage: python benchmarks/fakeserver.py [--port PORT] [--latency SECONDS] [--errorrate P] [--throttlerate P]
+                                       [--ratelimit N] [--retryafter SECONDS]
+
+The URL of the webhook is printed on stdout once the server listens.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import json
+import random
+import sys
+import time
+
+import tornado.gen
+import tornado.ioloop
+import tornado.netutil
+import tornado.httpserver
+import tornado.web
+
+
+class Stats(object):
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.answers = {}
+        self.started = time.time()
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'bytes': self.bytes,
+            'answers': dict((str(code), n) for code, n in self.answers.items()),
+            'seconds': time.time() - self.started
+        }
+
+
+class Window(object):
+    """
+    Count the requests of the current second, like the Mattermost rate limiter.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.second = 0
+        self.count = 0
+
+    def allow(self):
+        if not self.limit:
+            return True
+        now = int(time.time())
+        if now != self.second:
+            self.second, self.count = now, 0
+        self.count += 1
+        return self.count <= self.limit
+
+
+class HookHandler(tornado.web.RequestHandler):
+    def initialize(self, options, stats, window):
+        self.options = options
+        self.stats = stats
+        self.window = window
+
+    @tornado.gen.coroutine
+    def post(self, *args):
+        self.stats.requests += 1
+        self.stats.bytes += len(self.request.body)
+        allowed = self.window.allow()
+        if self.options.latency:
+            yield tornado.gen.sleep(self.options.latency)
+        draw = random.random()
+        if draw < self.options.errorrate:
+            code = 500
+        elif not allowed or draw < self.options.errorrate + self.options.throttlerate:
+            code = 429
+            self.set_header('Retry-After', str(self.options.retryafter))
+        else:
+            code = 200
+        self.stats.answers[code] = self.stats.answers.get(code, 0) + 1
+        self.set_status(code)
+        self.finish('ok' if code == 200 else 'error')
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, stats):
+        self.stats = stats
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(self.stats.to_dict()))
+
+
+def make_app(options):
+    stats = Stats()
+    window = Window(options.ratelimit)
+    return tornado.web.Application([
+        (r'/stats', StatsHandler, {'stats': stats}),
+        (r'/hooks/(.*)', HookHandler, {'options': options, 'stats': stats, 'window': window}),
+        (r'/(.*)', HookHandler, {'options': options, 'stats': stats, 'window': window})
+    ])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fake Mattermost incoming webhook")
+    parser.add_argument("--port", type=int, default=0, help="Listening port (0 for a random port)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before answering")
+    parser.add_argument("--errorrate", type=float, default=0.0, help="Probability of a 500 answer")
+    parser.add_argument("--throttlerate", type=float, default=0.0, help="Probability of a 429 answer")
+    parser.add_argument("--ratelimit", type=int, default=0, help="Requests per second above which 429 is answered")
+    parser.add_argument("--retryafter", type=int, default=1, help="Retry-After value of the 429 answers")
+    return parser.parse_args(argv)
+
+
+def main():
+    options = parse_args()
+    sockets = tornado.netutil.bind_sockets(options.port, '127.0.0.1')
+    server = tornado.httpserver.HTTPServer(make_app(options))
+    server.add_sockets(sockets)
+    print('http://127.0.0.1:{}/hooks/bench'.format(sockets[0].getsockname()[1]))
+    sys.stdout.flush()
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
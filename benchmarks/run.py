@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+
+"""
+Throughput and latency of the posters, the command line tools and iproxy against a local fake webhook.
+
+Every scenario runs at each load (number of concurrent senders) in a fresh process, so that CPU time and peak RSS
+are measured for that scenario only. Results are saved as JSON, named after the current commit, and two result files
+can be compared to spot regressions.
+
+Usage: python benchmarks/run.py [-s poster,asyncposter,...] [-l 1,4,16] [-n NUMBER] [--latency SECONDS]
+                                [--errorrate P] [--throttlerate P] [--ratelimit N] [-o FILE]
+       python benchmarks/run.py --compare OLD.json NEW.json [--threshold 0.1]
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from os.path import abspath, dirname, join, exists
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+ROOT = dirname(dirname(abspath(__file__)))
+HERE = dirname(abspath(__file__))
+SCENARIOS = ('poster', 'asyncposter', 'aioposter', 'tee', 'cat', 'echo', 'iproxy', 'mgpoll')
+# the command line tools start a process per run: they get fewer messages
+CLI_SCENARIOS = ('echo',)
+
+
+def child_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    return env
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def message(i):
+    from pymatter import IncomingMessage, Attachment, Field
+    att = Attachment(fallback='benchmark', text='message {} '.format(i) + 'x' * 200, title='benchmark')
+    att.fields.append(Field('Number', i, True))
+    return IncomingMessage(text='benchmark message {}'.format(i), username='bench', attachments=[att])
+
+
+def run_cli(module, args, stdin=None):
+    started = time.time()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', module] + args, env=child_env(), stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    proc.communicate(stdin)
+    return proc.returncode, time.time() - started
+
+
+# Each scenario sends about `number` messages from `load` concurrent senders, and returns (number of messages, number
+# of failed messages, per message latencies)
+
+def bench_poster(url, load, number):
+    from pymatter import Poster
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def sender(count):
+        poster = Poster(url)
+        for i in range(count):
+            msg = message(i)
+            started = time.time()
+            try:
+                poster.post(msg)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+            with lock:
+                latencies.append(time.time() - started)
+
+    threads = [threading.Thread(target=sender, args=(number // load,)) for _ in range(load)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies), errors[0], latencies
+
+
+def bench_asyncposter(url, load, number):
+    from pymatter import AsyncPoster
+    latencies = []
+    poster = AsyncPoster(url, workers=load, queue_size=load * 4)
+
+    def record(resp, *args, **kwargs):
+        latencies.append(resp.elapsed.total_seconds())
+
+    poster.session.hooks['response'].append(record)
+    with poster:
+        for i in range(number):
+            poster.post(message(i))
+    return number, poster.failed + poster.dropped, latencies
+
+
+def bench_aioposter(url, load, number):
+    import tornado.gen
+    import tornado.ioloop
+    from pymatter.aio import AioPoster
+    latencies = []
+    errors = [0]
+
+    @tornado.gen.coroutine
+    def lane(poster, count):
+        for i in range(count):
+            started = time.time()
+            try:
+                yield poster.post(message(i))
+            except Exception:
+                errors[0] += 1
+            latencies.append(time.time() - started)
+
+    @tornado.gen.coroutine
+    def run():
+        poster = AioPoster(url, concurrency=load).open()
+        yield [lane(poster, number // load) for _ in range(load)]
+        yield poster.close()
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+    return len(latencies), errors[0], latencies
+
+
+def bench_tee(url, load, number):
+    lines = ''.join('line {} {}\n'.format(i, 'x' * 80) for i in range(number)).encode('utf-8')
+    code, _ = run_cli('pymatter.tee', ['-m', url, '-n', '-w', str(load), '-o', 'block'], lines)
+    return number, 0 if code == 0 else number, []
+
+
+def bench_cat(url, load, number):
+    directory = tempfile.mkdtemp()
+    try:
+        files = []
+        for i in range(number):
+            files.append(join(directory, 'file{}.py'.format(i)))
+            with open(files[-1], 'w') as f:
+                f.write('print({})\n'.format(i) * 50)
+        code, _ = run_cli('pymatter.cat', ['-m', url, '--separate', '-w', str(load)] + files)
+    finally:
+        shutil.rmtree(directory)
+    return number, 0 if code == 0 else number, []
+
+
+def bench_echo(url, load, number):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def lane(count):
+        for i in range(count):
+            code, seconds = run_cli('pymatter.echo', ['-m', url, 'message', str(i)])
+            with lock:
+                latencies.append(seconds)
+                errors[0] += code != 0
+
+    threads = [threading.Thread(target=lane, args=(max(1, number // load),)) for _ in range(load)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies), errors[0], latencies
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def bench_iproxy(url, load, number):
+    import tornado.gen
+    import tornado.httpclient
+    import tornado.ioloop
+    base, hook = url.rsplit('/', 1)
+    port = free_port()
+    directory = tempfile.mkdtemp()
+    conf = join(directory, 'proxy.conf')
+    with open(conf, 'w') as f:
+        f.write('[proxy]\nport={}\nmax_clients={}\n[mattermost]\nurl={}\ndefault_hook={}\n'.format(
+            port, max(load, 10), base, hook
+        ))
+    proxy = subprocess.Popen(
+        [sys.executable, '-m', 'pymatter.iproxy', '-c', conf], env=child_env(),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    latencies = []
+    errors = [0]
+    try:
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                break
+            except (IOError, OSError):
+                if time.time() > deadline or proxy.poll() is not None:
+                    raise RuntimeError("iproxy did not start")
+                time.sleep(0.05)
+
+        client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=load)
+        proxy_url = 'http://127.0.0.1:{}/hook'.format(port)
+
+        @tornado.gen.coroutine
+        def lane(count):
+            for i in range(count):
+                started = time.time()
+                try:
+                    yield client.fetch(proxy_url, method='POST', body=message(i).dumpb(),
+                                       headers={'Content-Type': 'application/json'}, request_timeout=60)
+                except Exception:
+                    errors[0] += 1
+                latencies.append(time.time() - started)
+
+        @tornado.gen.coroutine
+        def run():
+            yield [lane(number // load) for _ in range(load)]
+
+        tornado.ioloop.IOLoop.current().run_sync(run)
+        client.close()
+    finally:
+        proxy.send_signal(signal.SIGTERM)
+        proxy.wait()
+        shutil.rmtree(directory)
+    return len(latencies), errors[0], latencies
+
+
+def bench_mgpoll(url, load, number):
+    """
+    Catch up with `number` stored Mailgun events, then poll again after new events arrived: every stored message
+    must be fetched exactly once.
+    """
+    directory = tempfile.mkdtemp()
+    mailgun = subprocess.Popen(
+        [sys.executable, join(HERE, 'fakemailgun.py'), '--events', str(number), '--latency', '0.01'],
+        env=child_env(), stdout=subprocess.PIPE
+    )
+    try:
+        api_url = mailgun.stdout.readline().decode('utf-8').strip()
+        conf = join(directory, 'mailgun.conf')
+        with open(conf, 'w') as f:
+            f.write('[mailgun]\napi_key=key\ndomain=bench\napi_url={}\nworkers={}\ncursor={}\n'
+                    '[mattermost]\nurl={}\nsenders={}\n'.format(api_url, load, join(directory, 'cursor'), url, load))
+        latencies = []
+        codes = 0
+        for added in (0, max(1, number // 10)):
+            if added:
+                urlopen(api_url.rsplit('/', 1)[0] + '/add?n={}'.format(added), b'').read()
+            code, seconds = run_cli('pymatter.mgpoll', ['-c', conf, '--once'])
+            latencies.append(seconds)
+            codes += code != 0
+        stats = json.loads(urlopen(api_url.rsplit('/', 1)[0] + '/stats').read().decode('utf-8'))
+    finally:
+        mailgun.terminate()
+        mailgun.wait()
+        shutil.rmtree(directory)
+    errors = stats['duplicates'] + stats['events'] - stats['fetched'] + (stats['events'] if codes else 0)
+    return stats['fetched'], errors, latencies
+
+
+def usage():
+    self = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (
+        self.ru_utime + self.ru_stime + children.ru_utime + children.ru_stime,
+        max(self.ru_maxrss, children.ru_maxrss) * scale
+    )
+
+
+def run_child(scenario, url, load, number):
+    """
+    Run one scenario in the current process and print its measures as JSON.
+    """
+    bench = globals()['bench_' + scenario]
+    # warm up: imports, connections
+    bench(url, 1, 1)
+    cpu_before, _ = usage()
+    started = time.time()
+    messages, errors, latencies = bench(url, load, number)
+    seconds = time.time() - started
+    cpu_after, rss = usage()
+    print(json.dumps({
+        'scenario': scenario,
+        'load': load,
+        'messages': messages,
+        'errors': errors,
+        'seconds': seconds,
+        'msgs_per_s': messages / seconds if seconds else None,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'cpu': cpu_after - cpu_before,
+        'cpu_per_msg': (cpu_after - cpu_before) / messages if messages else None,
+        'max_rss': rss
+    }))
+
+
+def start_server(args):
+    command = [sys.executable, join(HERE, 'fakeserver.py'), '--latency', str(args.latency),
+               '--errorrate', str(args.errorrate), '--throttlerate', str(args.throttlerate),
+               '--ratelimit', str(args.ratelimit)]
+    server = subprocess.Popen(command, env=child_env(), stdout=subprocess.PIPE)
+    url = server.stdout.readline().decode('utf-8').strip()
+    if not url:
+        raise RuntimeError("the fake server did not start")
+    return server, url
+
+
+def server_stats(url):
+    return json.loads(urlopen(url.split('/hooks/')[0] + '/stats').read().decode('utf-8'))
+
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=ROOT) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return revision + ('-dirty' if dirty else '')
+
+
+def run_all(args):
+    server, url = start_server(args)
+    results = []
+    try:
+        for scenario in args.scenarios.split(','):
+            for load in [int(load) for load in args.loads.split(',')]:
+                number = args.climessages if scenario in CLI_SCENARIOS else args.number
+                before = server_stats(url)['requests']
+                out = subprocess.check_output(
+                    [sys.executable, abspath(__file__), '--child', scenario, '--url', url, '-l', str(load),
+                     '-n', str(number)],
+                    env=child_env()
+                )
+                result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+                # includes the warm up message and the retries
+                result['requests'] = server_stats(url)['requests'] - before
+                results.append(result)
+                print(format_result(result))
+                sys.stdout.flush()
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        'revision': git_revision(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'server': {'latency': args.latency, 'errorrate': args.errorrate, 'throttlerate': args.throttlerate,
+                   'ratelimit': args.ratelimit},
+        'results': results
+    }
+
+
+def ms(value):
+    return '-' if value is None else '{:.1f}ms'.format(value * 1000)
+
+
+def format_result(result):
+    return '{:<12} load={:<4} {:>10.1f} msgs/s  p50={:>9} p99={:>9}  cpu={:.2f}s  rss={:.1f}MB  errors={}'.format(
+        result['scenario'], result['load'], result['msgs_per_s'] or 0, ms(result['p50']), ms(result['p99']),
+        result['cpu'], result['max_rss'] / 1024 / 1024, result['errors']
+    )
+
+
+def change(old, new):
+    if not old or new is None:
+        return None
+    return (new - old) / old
+
+
+def compare(old_file, new_file, threshold):
+    """
+    Print the changes between two result files. Return the number of regressions beyond `threshold`.
+    """
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print('{} -> {}'.format(old['revision'], new['revision']))
+    old_results = dict(((r['scenario'], r['load']), r) for r in old['results'])
+    regressions = 0
+    for result in new['results']:
+        previous = old_results.get((result['scenario'], result['load']))
+        if previous is None:
+            continue
+        throughput = change(previous['msgs_per_s'], result['msgs_per_s'])
+        p99 = change(previous['p99'], result['p99'])
+        cpu = change(previous['cpu_per_msg'], result['cpu_per_msg'])
+        flags = []
+        if throughput is not None and throughput < -threshold:
+            flags.append('throughput')
+        if p99 is not None and p99 > threshold:
+            flags.append('p99')
+        if cpu is not None and cpu > threshold:
+            flags.append('cpu')
+        regressions += bool(flags)
+        print('{:<12} load={:<4} msgs/s {:>+7.1%}  p99 {:>8}  cpu/msg {:>8}  {}'.format(
+            result['scenario'], result['load'], throughput or 0,
+            '-' if p99 is None else '{:+.1%}'.format(p99), '-' if cpu is None else '{:+.1%}'.format(cpu),
+            'REGRESSION ({})'.format(', '.join(flags)) if flags else ''
+        ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pymatter benchmarks")
+    parser.add_argument("-s", "--scenarios", default=','.join(SCENARIOS), help="Comma separated scenarios")
+    parser.add_argument("-l", "--loads", default='1,4,16', help="Comma separated numbers of concurrent senders")
+    parser.add_argument("-n", "--number", type=int, default=1000, help="Number of messages per run")
+    parser.add_argument("--climessages", type=int, default=20, help="Number of messages per run of pymatterecho")
+    parser.add_argument("--latency", type=float, default=0.01, help="Latency of the fake server in seconds")
+    parser.add_argument("--errorrate", type=float, default=0.0, help="Probability of a 500 answer")
+    parser.add_argument("--throttlerate", type=float, default=0.0, help="Probability of a 429 answer")
+    parser.add_argument("--ratelimit", type=int, default=0, help="Requests per second accepted by the fake server")
+    parser.add_argument("-o", "--output", help="Result file (default: benchmarks/results/REVISION.json)")
+    parser.add_argument("--compare", nargs=2, metavar=('OLD', 'NEW'), help="Compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change reported as a regression")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.url, int(args.loads), args.number)
+        return
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    report = run_all(args)
+    output = args.output or join(HERE, 'results', '{}.json'.format(report['revision']))
+    if not exists(dirname(output)):
+        os.makedirs(dirname(output))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results saved to {}'.format(output))
+
+
+if __name__ == '__main__':
+    main()
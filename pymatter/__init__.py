@@ -5,5 +5,22 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
-from .base import decode_text, IncomingMessage, Attachment, Field, Poster, AsyncPoster, Code, Emoji
+import sys
 
+__all__ = ['decode_text', 'IncomingMessage', 'Attachment', 'Field', 'Poster', 'AsyncPoster', 'FanoutPoster',
+           'Destination', 'LineBatcher', 'Code', 'Emoji']
+
+if sys.version_info >= (3, 7):
+    # the public names are imported from pymatter.base on first use (PEP 562): the command line tools import
+    # their modules without paying for the whole package
+    def __getattr__(name):
+        if name in __all__:
+            from . import base
+            return getattr(base, name)
+        raise AttributeError("module 'pymatter' has no attribute '{}'".format(name))
+
+    def __dir__():
+        return sorted(list(globals()) + __all__)
+else:
+    from .base import decode_text, IncomingMessage, Attachment, Field, Poster, AsyncPoster, FanoutPoster, Destination, \
+        LineBatcher, Code, Emoji
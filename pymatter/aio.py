@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+
+"""
+Post messages to Mattermost from an asyncio (or tornado) event loop.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import base64
+import signal
+import ssl
+import time
+from io import BytesIO
+
+import tornado.gen
+import tornado.http1connection
+import tornado.httpclient
+import tornado.httputil
+import tornado.ioloop
+import tornado.iostream
+import tornado.locks
+import tornado.tcpclient
+
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+
+from .base import IncomingMessage
+from .ratelimit import get_limiter, parse_retry_after, backoff_delay, THROTTLE_CODES, RETRY_CODES
+
+AsyncHTTPClient = tornado.httpclient.AsyncHTTPClient
+HTTPClientError = tornado.httpclient.HTTPClientError
+HTTPRequest = tornado.httpclient.HTTPRequest
+HTTPResponse = tornado.httpclient.HTTPResponse
+HTTPError = tornado.httpclient.HTTPError
+HTTP1Connection = tornado.http1connection.HTTP1Connection
+HTTP1ConnectionParameters = tornado.http1connection.HTTP1ConnectionParameters
+HTTPHeaders = tornado.httputil.HTTPHeaders
+HTTPMessageDelegate = tornado.httputil.HTTPMessageDelegate
+RequestStartLine = tornado.httputil.RequestStartLine
+IOLoop = tornado.ioloop.IOLoop
+StreamClosedError = tornado.iostream.StreamClosedError
+TCPClient = tornado.tcpclient.TCPClient
+Semaphore = tornado.locks.Semaphore
+coroutine = tornado.gen.coroutine
+sleep = tornado.gen.sleep
+with_timeout = tornado.gen.with_timeout
+
+
+class HTTPConnectError(HTTPClientError):
+    """
+    The connection to the server could not be established: the request was not sent, it is safe to send it again.
+    """
+    def __init__(self, message):
+        super(HTTPConnectError, self).__init__(599, message)
+
+
+class HTTPTimeoutError(HTTPClientError):
+    """
+    No complete answer within the request timeout: the server may have received the request.
+    """
+    def __init__(self, message="Timeout"):
+        super(HTTPTimeoutError, self).__init__(599, message)
+
+
+class ResponseReader(HTTPMessageDelegate):
+    def __init__(self):
+        self.start_line = None
+        self.headers = None
+        self.chunks = []
+
+    def headers_received(self, start_line, headers):
+        self.start_line = start_line
+        self.headers = headers
+
+    def data_received(self, chunk):
+        self.chunks.append(chunk)
+
+    def keep_alive(self):
+        connection = (self.headers.get('Connection') or '').lower()
+        if self.start_line.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+
+class KeepAliveHTTPClient(AsyncHTTPClient):
+    """
+    Tornado HTTP/1.1 client that keeps its connections to the servers alive and reuses them.
+
+    The simple tornado client opens a new connection for each request, and the curl based client needs pycurl. At
+    most `max_clients` requests run at the same time, further requests wait for a free slot; as many idle connections
+    are kept per server. A request sent on a reused connection that the server had closed in the meantime is sent
+    again on a new connection.
+
+    Connection failures are reported as `HTTPConnectError` and request timeouts as `HTTPTimeoutError`, both with the
+    599 code. Redirections are not followed.
+    """
+    def initialize(self, max_clients=10, defaults=None):
+        super(KeepAliveHTTPClient, self).initialize(defaults=defaults)
+        self.max_clients = max_clients
+        self.semaphore = Semaphore(max_clients)
+        self.tcp_client = TCPClient()
+        # (scheme, host, port): idle streams
+        self.idle = {}
+        # number of connections opened, for the statistics
+        self.connections = 0
+
+    def close(self):
+        for streams in self.idle.values():
+            for stream in streams:
+                stream.set_close_callback(None)
+                stream.close()
+        self.idle = {}
+        self.tcp_client.close()
+        super(KeepAliveHTTPClient, self).close()
+
+    def fetch_impl(self, request, callback):
+        IOLoop.current().add_future(self._fetch(request), lambda future: callback(future.result()))
+
+    @coroutine
+    def _fetch(self, request):
+        start_time = time.time()
+        with (yield self.semaphore.acquire()):
+            io_loop = IOLoop.current()
+            deadline = io_loop.time() + request.request_timeout if request.request_timeout else None
+            try:
+                reader = yield self._fetch_on_stream(request, deadline)
+            except HTTPClientError as ex:
+                raise tornado.gen.Return(HTTPResponse(request, 599, error=ex, request_time=time.time() - start_time,
+                                                      start_time=start_time))
+        raise tornado.gen.Return(HTTPResponse(
+            request, reader.start_line.code, reason=reader.start_line.reason, headers=reader.headers,
+            buffer=BytesIO(b''.join(reader.chunks)), effective_url=request.url,
+            request_time=time.time() - start_time, start_time=start_time
+        ))
+
+    @coroutine
+    def _fetch_on_stream(self, request, deadline):
+        parsed = urlsplit(request.url)
+        if parsed.scheme not in ('http', 'https'):
+            raise HTTPConnectError("Unsupported URL scheme: {}".format(parsed.scheme))
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        key = (parsed.scheme, parsed.hostname, port)
+        path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+        start_line = RequestStartLine(request.method, path, 'HTTP/1.1')
+        headers = self._headers(request, parsed)
+        while True:
+            stream = self._idle_stream(key)
+            reused = stream is not None
+            if stream is None:
+                stream = yield self._connect(key, request)
+            reader = ResponseReader()
+            connection = HTTP1Connection(stream, True, HTTP1ConnectionParameters(
+                decompress=bool(request.decompress_response)
+            ))
+            try:
+                connection.write_headers(start_line, headers, request.body)
+                connection.finish()
+                exchange = connection.read_response(reader)
+                if deadline is None:
+                    yield exchange
+                else:
+                    yield with_timeout(deadline, exchange, quiet_exceptions=(StreamClosedError,))
+            except tornado.gen.TimeoutError:
+                stream.close()
+                raise HTTPTimeoutError()
+            except StreamClosedError as ex:
+                stream.close()
+                if reused and reader.start_line is None:
+                    # the server closed the idle connection
+                    continue
+                raise HTTPClientError(599, "Connection closed: {}".format(ex.real_error or ex))
+            if reader.start_line is None:
+                stream.close()
+                raise HTTPClientError(599, "Invalid answer")
+            if stream.closed() or not reader.keep_alive() or not self._keep(key, stream):
+                stream.close()
+            raise tornado.gen.Return(reader)
+
+    @staticmethod
+    def _headers(request, parsed):
+        headers = HTTPHeaders(request.headers)
+        if 'Host' not in headers:
+            headers['Host'] = parsed.netloc.rsplit('@', 1)[-1]
+        if request.user_agent and 'User-Agent' not in headers:
+            headers['User-Agent'] = request.user_agent
+        if request.decompress_response:
+            headers['Accept-Encoding'] = 'gzip'
+        if request.auth_username is not None:
+            credentials = '{}:{}'.format(request.auth_username, request.auth_password or '')
+            headers['Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf-8')).decode('ascii')
+        if request.body is not None:
+            headers['Content-Length'] = str(len(request.body))
+        return headers
+
+    @coroutine
+    def _connect(self, key, request):
+        scheme, host, port = key
+        ssl_options = None
+        if scheme == 'https':
+            ssl_options = request.ssl_options
+            if ssl_options is None:
+                ssl_options = ssl.create_default_context(cafile=request.ca_certs)
+                if not request.validate_cert:
+                    ssl_options.check_hostname = False
+                    ssl_options.verify_mode = ssl.CERT_NONE
+        try:
+            stream = yield self.tcp_client.connect(host, port, ssl_options=ssl_options,
+                                                   timeout=request.connect_timeout or None)
+        except tornado.gen.TimeoutError:
+            raise HTTPConnectError("Timeout while connecting")
+        except (IOError, OSError, StreamClosedError) as ex:
+            raise HTTPConnectError("Connection failed: {}".format(ex))
+        stream.set_nodelay(True)
+        self.connections += 1
+        raise tornado.gen.Return(stream)
+
+    def _idle_stream(self, key):
+        streams = self.idle.get(key)
+        while streams:
+            stream = streams.pop()
+            stream.set_close_callback(None)
+            if not stream.closed():
+                return stream
+        return None
+
+    def _keep(self, key, stream):
+        streams = self.idle.setdefault(key, [])
+        if len(streams) >= self.max_clients:
+            return False
+        # an idle stream with a close callback notices when the server closes it
+        stream.set_close_callback(lambda: streams.remove(stream) if stream in streams else None)
+        streams.append(stream)
+        return True
+
+
+def make_http_client(max_clients=10, **defaults):
+    """
+    Build a dedicated tornado HTTP client allowing `max_clients` concurrent requests, and keeping its connections alive
+    between requests (`KeepAliveHTTPClient`).
+    """
+    return KeepAliveHTTPClient(force_instance=True, max_clients=max_clients, defaults=defaults)
+
+
+def call_from_signal(callback):
+    """
+    Schedule `callback` on the current IOLoop, from a signal handler.
+    """
+    io_loop = IOLoop.current()
+    # on asyncio, add_callback does not wake the loop up when called from a signal handler
+    asyncio_loop = getattr(io_loop, 'asyncio_loop', None)
+    if asyncio_loop is None:
+        io_loop.add_callback_from_signal(callback)
+    else:
+        asyncio_loop.call_soon_threadsafe(io_loop.add_callback, callback)
+
+
+def handle_signals(callback, signals=(signal.SIGTERM, signal.SIGINT)):
+    """
+    Run `callback` on the IOLoop when one of `signals` is received.
+    """
+    for sig in signals:
+        signal.signal(sig, lambda sig, frame: call_from_signal(callback))
+
+
+class AioPoster(object):
+    """
+    Non-blocking poster.
+
+    `post` returns an awaitable resolving to the HTTP response. At most `concurrency` requests are in flight at the
+    same time; further posts wait for a free slot. Use it with ``async with``, or call `open` and `close`.
+
+    The send path is reported to `observer`, a `pymatter.metrics.Observer`.
+    """
+    def __init__(self, incoming_webhook_url, concurrency=10, max_retries=5, limiter=None, connect_timeout=10,
+                 request_timeout=30, observer=None):
+        self.url = incoming_webhook_url
+        self.concurrency = max(1, int(concurrency))
+        self.max_retries = max_retries
+        self.limiter = get_limiter(incoming_webhook_url) if limiter is None else limiter
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.observer = observer
+        self.semaphore = Semaphore(self.concurrency)
+        self.client = None
+
+    def open(self):
+        if self.client is None:
+            self.client = make_http_client(
+                self.concurrency, connect_timeout=self.connect_timeout, request_timeout=self.request_timeout
+            )
+        return self
+
+    @coroutine
+    def close(self):
+        # wait for the in-flight requests
+        for _ in range(self.concurrency):
+            yield self.semaphore.acquire()
+        try:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+        finally:
+            for _ in range(self.concurrency):
+                self.semaphore.release()
+
+    @coroutine
+    def __aenter__(self):
+        raise tornado.gen.Return(self.open())
+
+    @coroutine
+    def __aexit__(self, exc_type, exc_val, exc_tb):
+        yield self.close()
+
+    @coroutine
+    def post(self, incoming_message):
+        incoming_message = IncomingMessage.factory(incoming_message)
+        if self.client is None:
+            self.open()
+        started = time.time()
+        body = incoming_message.dumpb()
+        if self.observer is not None:
+            self.observer.serialized(self.url, time.time() - started)
+        req = HTTPRequest(
+            url=self.url,
+            method="POST",
+            headers={'Content-Type': 'application/json'},
+            body=body
+        )
+        with (yield self.semaphore.acquire()):
+            resp = yield self._send(req)
+        raise tornado.gen.Return(resp)
+
+    @coroutine
+    def _send(self, req):
+        attempt = 0
+        while True:
+            wait = self.limiter.delay()
+            while wait > 0:
+                yield sleep(wait)
+                wait = self.limiter.delay()
+            if self.observer is not None:
+                self.observer.request_started(self.url)
+            started = time.time()
+            try:
+                resp = yield self.client.fetch(req)
+            except HTTPError as ex:
+                # 599 is used by tornado for timeouts and connection failures; like `pymatter.base.send`, don't retry
+                # timeouts, the server may have received the message
+                retry_after = None if ex.response is None else parse_retry_after(ex.response.headers.get('Retry-After'))
+                if ex.code in THROTTLE_CODES:
+                    self.limiter.throttled(retry_after)
+                retriable = ex.code in RETRY_CODES or (ex.code == 599 and not isinstance(ex, HTTPTimeoutError))
+                retry = retriable and attempt < self.max_retries
+                self._observe(started, -1 if ex.code == 599 else ex.code, retry)
+                if not retry:
+                    raise
+            except (IOError, OSError):
+                # connection failures
+                retry = attempt < self.max_retries
+                self._observe(started, -1, retry)
+                if not retry:
+                    raise
+            else:
+                self.limiter.succeeded()
+                self._observe(started, resp.code, False)
+                raise tornado.gen.Return(resp)
+            yield sleep(backoff_delay(attempt))
+            attempt += 1
+
+    def _observe(self, started, status, retry):
+        if self.observer is None:
+            return
+        self.observer.request_finished(self.url, status, time.time() - started)
+        if retry:
+            self.observer.retried(self.url, status)
+        elif status == 200:
+            self.observer.sent(self.url)
+        else:
+            self.observer.failed(self.url, status)
+
+    def __repr__(self):
+        return u"AioPoster('{}')".format(self.url)
+
+    def __str__(self):
+        return u"AioPoster('{}')".format(self.url)
@@ -5,18 +5,33 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
-import json
+import itertools
+import logging
+import operator
 import threading
-from queue import Queue, Empty
+import time
+from collections import Counter, deque
+from queue import Queue, Empty, Full
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
 
-import requests
 from builtins import str as t
 from builtins import bytes as b
 
+from .lazy import lazy_import
+from .serializer import dumpb, loads
+from .ratelimit import get_limiter, parse_retry_after, backoff_delay, THROTTLE_CODES, RETRY_CODES
+
+# the message model is used without posting (iproxy, pymatterecho): requests is loaded by the first poster
+requests = lazy_import('requests')
+
 
 def decode_text(text):
-    if text is None:
-        return None
+    # fast path for the common case, text that is already decoded
+    if text is None or type(text) is t:
+        return text
     if isinstance(text, Code) or isinstance(text, Emoji):
         text = str(text)
     if not isinstance(text, t) and not isinstance(text, b):
@@ -26,151 +41,563 @@ def decode_text(text):
     return text
 
 
-class IncomingMessage(object):
+_generations = itertools.count(1)
+
+
+class ModelList(list):
+    """
+    List of attachments or fields that invalidates the serialization cache of its owner when modified.
+    """
+    __slots__ = ('owner',)
+
+    def __init__(self, owner, items=()):
+        list.__init__(self, items)
+        self.owner = owner
+
+    def append(self, item):
+        list.append(self, item)
+        self.owner.touch()
+
+    def extend(self, items):
+        list.extend(self, items)
+        self.owner.touch()
+
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self.owner.touch()
+
+    def remove(self, item):
+        list.remove(self, item)
+        self.owner.touch()
+
+    def pop(self, *args):
+        item = list.pop(self, *args)
+        self.owner.touch()
+        return item
+
+    def clear(self):
+        del self[:]
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.owner.touch()
+
+    def reverse(self):
+        list.reverse(self)
+        self.owner.touch()
+
+    def __setitem__(self, index, item):
+        list.__setitem__(self, index, item)
+        self.owner.touch()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self.owner.touch()
+
+    def __setslice__(self, i, j, items):
+        list.__setslice__(self, i, j, items)
+        self.owner.touch()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self.owner.touch()
+
+    def __iadd__(self, items):
+        list.extend(self, items)
+        self.owner.touch()
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self.owner.touch()
+        return self
+
+
+def attribute(name, convert=None):
+    """
+    Public attribute of the message model, stored in the `_<name>` slot. Assigning it invalidates the cached
+    serialization. The assigned values go through `convert` when given.
+    """
+    slot = '_' + name
+
+    def setter(self, value):
+        setattr(self, slot, value if convert is None else convert(value))
+        self.generation = next(_generations)
+    return property(operator.attrgetter(slot), setter)
+
+
+class Model(object):
+    """
+    Base class of the message model.
+
+    Objects remember their JSON serialization. Every assignment to a public attribute (and every change to a
+    `ModelList`) stamps the object with a new generation number; the cached serialization is reused as long as the
+    highest generation in the object tree has not changed. New objects have no cache yet: they start at generation 0.
+    """
+    __slots__ = ('generation', 'cache')
+
+    def touch(self):
+        self.generation = next(_generations)
+
+    def stamp(self):
+        return self.generation
+
+    def to_dict(self):
+        raise NotImplementedError
+
+    def dumpb(self):
+        """
+        Return the JSON serialization as bytes.
+        """
+        stamp = self.stamp()
+        cache = self.cache
+        if cache is not None and cache[0] == stamp:
+            return cache[1]
+        data = self.serialize()
+        self.cache = (stamp, data)
+        return data
+
+    def serialize(self):
+        return dumpb(self.to_dict())
+
+    def dumps(self):
+        return self.dumpb().decode('utf-8')
+
+    def __str__(self):
+        return str(self.to_dict())
+
+
+class IncomingMessage(Model):
+    __slots__ = ('_text', '_username', '_icon_url', '_channel', '_attachments')
+
+    text = attribute('text')
+    username = attribute('username')
+    icon_url = attribute('icon_url')
+    channel = attribute('channel')
+
     def __init__(self, text=u'', username=u'pymatter', icon_url=None, channel=None, attachments=None):
-        self.text = decode_text(text)
-        self.username = decode_text(username)
-        self.icon_url = decode_text(icon_url)
-        self.channel = decode_text(channel)
-        self.attachments = [] if not attachments else [Attachment.factory(a) for a in attachments]
+        self._text = decode_text(text)
+        self._username = decode_text(username)
+        self._icon_url = decode_text(icon_url)
+        self._channel = decode_text(channel)
+        self._attachments = ModelList(self, [Attachment.factory(a) for a in attachments]) if attachments else None
+        self.cache = None
+        self.generation = 0
+
+    @property
+    def attachments(self):
+        # the list is only allocated when needed
+        if self._attachments is None:
+            self._attachments = ModelList(self)
+        return self._attachments
+
+    @attachments.setter
+    def attachments(self, attachments):
+        self._attachments = ModelList(self, [Attachment.factory(a) for a in attachments]) if attachments else None
+        self.touch()
+
+    def stamp(self):
+        stamp = self.generation
+        if self._attachments:
+            for a in self._attachments:
+                s = a.stamp()
+                if s > stamp:
+                    stamp = s
+        return stamp
 
     def to_dict(self):
         d = {}
-        for attr in ['text', 'username', 'icon_url', 'channel']:
-            if self.__getattribute__(attr):
-                d[attr] = self.__getattribute__(attr)
-        if self.attachments:
-            d['attachments'] = [a.to_dict() for a in self.attachments]
+        if self._text:
+            d['text'] = self._text
+        if self._username:
+            d['username'] = self._username
+        if self._icon_url:
+            d['icon_url'] = self._icon_url
+        if self._channel:
+            d['channel'] = self._channel
+        if self._attachments:
+            d['attachments'] = [a.to_dict() for a in self._attachments]
         return d
 
-    def __str__(self):
-        return str(self.to_dict())
+    OVERRIDABLE = ('text', 'username', 'icon_url', 'channel')
+
+    def serialize(self):
+        head = {}
+        for name in self.OVERRIDABLE:
+            value = getattr(self, '_' + name)
+            if value:
+                head[name] = value
+        return self.splice(head)
+
+    def dumpb_with(self, **overrides):
+        """
+        Return the JSON serialization as bytes, with some of the top level attributes (text, username, icon_url,
+        channel) replaced by `overrides`. The message is not modified, and the serialization of the attachments, cached
+        by each attachment, is spliced as is.
+        """
+        if not overrides:
+            return self.dumpb()
+        head = {}
+        for name in self.OVERRIDABLE:
+            value = decode_text(overrides.pop(name)) if name in overrides else getattr(self, '_' + name)
+            if value:
+                head[name] = value
+        if overrides:
+            raise ValueError(u"can't override: {}".format(u', '.join(sorted(overrides))))
+        return self.splice(head)
+
+    def splice(self, head):
+        """
+        Serialize the top level attributes of `head` around the cached serialization of the attachments.
+        """
+        if not self._attachments:
+            return dumpb(head)
+        attachments = b'[' + b','.join([a.dumpb() for a in self._attachments]) + b']'
+        return dumpb(head)[:-1] + (b',"attachments":' if head else b'"attachments":') + attachments + b'}'
 
     def __repr__(self):
         return u"IncomingMessage.loads('{}')".format(self.dumps())
 
     @classmethod
-    def loads(cls, json_text):
-        d = json.loads(json_text)
-        return cls.factory(d)
-
-    def dumps(self):
-        return json.dumps(self.to_dict())
+    def loads(cls, json_text, validate=True):
+        d = loads(json_text)
+        return cls.factory(d, validate)
 
     @classmethod
-    def factory(cls, msg):
+    def factory(cls, msg, validate=True):
         if isinstance(msg, IncomingMessage):
             return msg
+        if not validate:
+            return cls.from_trusted_dict(msg)
         return cls(
             msg.get('text'), msg.get('username'), msg.get('icon_url'), msg.get('channel'), msg.get('attachments')
         )
 
+    @classmethod
+    def from_trusted_dict(cls, msg):
+        """
+        Build the message tree from a dict whose values are already decoded text, such as decoded JSON,
+        skipping the normalization done by the constructors.
+        """
+        self = cls.__new__(cls)
+        get = msg.get
+        self._text = get('text')
+        self._username = get('username')
+        self._icon_url = get('icon_url')
+        self._channel = get('channel')
+        attachments = get('attachments')
+        if attachments:
+            self._attachments = ModelList(self, [Attachment.from_trusted_dict(a) for a in attachments])
+        else:
+            self._attachments = None
+        self.cache = None
+        self.generation = 0
+        return self
+
     def post(self, url):
         # noinspection PyTypeChecker
         return Poster(url).post(self)
 
 
-class Attachment(object):
+class Attachment(Model):
+    __slots__ = ('_fallback', '_color', '_pretext', '_author_name', '_author_link', '_author_icon', '_title',
+                 '_title_link', '_text', '_image_url', '_thumb_url', '_fields')
+
+    fallback = attribute('fallback')
+    color = attribute('color')
+    pretext = attribute('pretext')
+    author_name = attribute('author_name')
+    author_link = attribute('author_link')
+    author_icon = attribute('author_icon')
+    title = attribute('title')
+    title_link = attribute('title_link')
+    text = attribute('text')
+    image_url = attribute('image_url')
+    thumb_url = attribute('thumb_url')
+
     def __init__(self, text=u'', fallback=u'', title=u'', color=None, pretext=u'', author_name=None, author_link=None,
                  author_icon=None, title_link=None, image_url=None, thumb_url=None, fields=None):
-        self.fallback = decode_text(fallback)
-        self.title = decode_text(title)
-        self.text = decode_text(text)
-        self.color = decode_text(color)
-        self.pretext = decode_text(pretext)
-        self.author_name = decode_text(author_name)
-        self.author_link = decode_text(author_link)
-        self.author_icon = decode_text(author_icon)
-        self.title_link = decode_text(title_link)
-        self.image_url = decode_text(image_url)
-        self.thumb_url = decode_text(thumb_url)
-        self.fields = [] if not fields else [Field.factory(f) for f in fields]
+        self._fallback = decode_text(fallback)
+        self._title = decode_text(title)
+        self._text = decode_text(text)
+        self._color = decode_text(color)
+        self._pretext = decode_text(pretext)
+        self._author_name = decode_text(author_name)
+        self._author_link = decode_text(author_link)
+        self._author_icon = decode_text(author_icon)
+        self._title_link = decode_text(title_link)
+        self._image_url = decode_text(image_url)
+        self._thumb_url = decode_text(thumb_url)
+        self._fields = ModelList(self, [Field.factory(f) for f in fields]) if fields else None
+        self.cache = None
+        self.generation = 0
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = ModelList(self)
+        return self._fields
+
+    @fields.setter
+    def fields(self, fields):
+        self._fields = ModelList(self, [Field.factory(f) for f in fields]) if fields else None
+        self.touch()
+
+    def stamp(self):
+        stamp = self.generation
+        if self._fields:
+            for f in self._fields:
+                s = f.generation
+                if s > stamp:
+                    stamp = s
+        return stamp
 
     @classmethod
-    def factory(cls, d):
+    def factory(cls, d, validate=True):
         if isinstance(d, Attachment):
             return d
-        args = [d.get(attr) for attr in [
-            'fallback', 'color', 'pretext', 'author_name', 'author_link', 'author_icon', 'title', 'title_link',
-            'text', 'image_url', 'thumb_url', 'fields'
-        ]]
-        return cls(*args)
+        if not validate:
+            return cls.from_trusted_dict(d)
+        return cls(
+            text=d.get('text'), fallback=d.get('fallback'), title=d.get('title'), color=d.get('color'),
+            pretext=d.get('pretext'), author_name=d.get('author_name'), author_link=d.get('author_link'),
+            author_icon=d.get('author_icon'), title_link=d.get('title_link'), image_url=d.get('image_url'),
+            thumb_url=d.get('thumb_url'), fields=d.get('fields')
+        )
 
-    def __str__(self):
-        return str(self.to_dict())
+    @classmethod
+    def from_trusted_dict(cls, d):
+        self = cls.__new__(cls)
+        get = d.get
+        self._fallback = get('fallback')
+        self._title = get('title')
+        self._text = get('text')
+        self._color = get('color')
+        self._pretext = get('pretext')
+        self._author_name = get('author_name')
+        self._author_link = get('author_link')
+        self._author_icon = get('author_icon')
+        self._title_link = get('title_link')
+        self._image_url = get('image_url')
+        self._thumb_url = get('thumb_url')
+        fields = get('fields')
+        self._fields = ModelList(self, [Field.from_trusted_dict(f) for f in fields]) if fields else None
+        self.cache = None
+        self.generation = 0
+        return self
 
     def __repr__(self):
         return u"Attachment.loads('{}')".format(self.dumps())
 
     def to_dict(self):
         d = {}
-        for attr in [
-            'fallback', 'color', 'pretext', 'author_name', 'author_link', 'author_icon', 'title', 'title_link',
-            'text', 'image_url', 'thumb_url'
-        ]:
-            if self.__getattribute__(attr):
-                d[attr] = self.__getattribute__(attr)
-        if self.fields:
-            d['fields'] = [f.to_dict() for f in self.fields]
+        if self._fallback:
+            d['fallback'] = self._fallback
+        if self._color:
+            d['color'] = self._color
+        if self._pretext:
+            d['pretext'] = self._pretext
+        if self._author_name:
+            d['author_name'] = self._author_name
+        if self._author_link:
+            d['author_link'] = self._author_link
+        if self._author_icon:
+            d['author_icon'] = self._author_icon
+        if self._title:
+            d['title'] = self._title
+        if self._title_link:
+            d['title_link'] = self._title_link
+        if self._text:
+            d['text'] = self._text
+        if self._image_url:
+            d['image_url'] = self._image_url
+        if self._thumb_url:
+            d['thumb_url'] = self._thumb_url
+        if self._fields:
+            d['fields'] = [f.to_dict() for f in self._fields]
         return d
 
-    def dumps(self):
-        return json.dumps(self.to_dict())
-
     @classmethod
-    def loads(cls, json_text):
-        d = json.loads(json_text)
-        return cls.factory(d)
+    def loads(cls, json_text, validate=True):
+        d = loads(json_text)
+        return cls.factory(d, validate)
 
 
-class Field(object):
+class Field(Model):
+    __slots__ = ('_title', '_value', '_short')
+
+    title = attribute('title')
+    value = attribute('value')
+    short = attribute('short', bool)
+
     def __init__(self, title, value, short=False):
-        self.title = decode_text(title)
-        self.value = decode_text(value)
-        self.short = bool(short)
+        self._title = decode_text(title)
+        self._value = decode_text(value)
+        self._short = bool(short)
+        self.cache = None
+        self.generation = 0
 
     @classmethod
-    def factory(cls, f):
+    def factory(cls, f, validate=True):
         if isinstance(f, Field):
             return f
+        if not validate:
+            return cls.from_trusted_dict(f)
         return cls(
             f.get('title'),
             f.get('value'),
             f.get('short', False)
         )
 
+    @classmethod
+    def from_trusted_dict(cls, f):
+        self = cls.__new__(cls)
+        self._title = f.get('title')
+        self._value = f.get('value')
+        self._short = bool(f.get('short', False))
+        self.cache = None
+        self.generation = 0
+        return self
+
     def __str__(self):
-        return u"{}: {}".format(self.title, self.value)
+        return u"{}: {}".format(self._title, self._value)
 
     def __repr__(self):
-        return u"Field('{}', '{}', {})".format(self.title, self.value, self.short)
+        return u"Field('{}', '{}', {})".format(self._title, self._value, self._short)
 
     def to_dict(self):
         d = {}
-        if self.title:
-            d['title'] = self.title
-        if self.value:
-            d['value'] = self.value
-        d['short'] = self.short
+        if self._title:
+            d['title'] = self._title
+        if self._value:
+            d['value'] = self._value
+        d['short'] = self._short
         return d
 
-    def dumps(self):
-        return json.dumps(self.to_dict())
+
+def send(session, url, incoming_message, limiter=None, max_retries=0, observer=None):
+    """
+    POST `incoming_message` (a message object, or its JSON serialization as bytes) to `url`, waiting on `limiter`
+    before each attempt.
+
+    Throttling answers (429, 503) are reported to the limiter, which pauses for the Retry-After delay. Connection
+    errors (including connect timeouts) and 429/502/503/504 answers are retried up to `max_retries` times with
+    jittered exponential backoff. Read timeouts are not retried: the server may have received the message already.
+    Return the last response, or raise the last `requests.RequestException` if no response could be obtained.
+
+    The requests, retries and outcome are reported to `observer` (see `pymatter.metrics.Observer`).
+    """
+    if observer is None:
+        data = incoming_message if isinstance(incoming_message, bytes) else incoming_message.dumpb()
+    else:
+        data = _observed_dumpb(url, incoming_message, observer)
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        if observer is not None:
+            observer.request_started(url)
+            started = time.time()
+        try:
+            resp = session.post(url, data=data)
+        except (requests.ConnectionError, requests.Timeout) as ex:
+            # ConnectTimeout is a ConnectionError, ReadTimeout is not
+            last_attempt = attempt >= max_retries or not isinstance(ex, requests.ConnectionError)
+            if observer is not None:
+                observer.request_finished(url, -1, time.time() - started)
+                if last_attempt:
+                    observer.failed(url, -1)
+                else:
+                    observer.retried(url, -1)
+            if last_attempt:
+                raise
+            retry_after = None
+        else:
+            if observer is not None:
+                _observe_answer(url, resp.status_code, time.time() - started, attempt >= max_retries, observer)
+            if resp.status_code not in RETRY_CODES:
+                if limiter is not None and resp.status_code == requests.codes.ok:
+                    limiter.succeeded()
+                return resp
+            retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+            if limiter is not None and resp.status_code in THROTTLE_CODES:
+                limiter.throttled(retry_after)
+            if attempt >= max_retries:
+                return resp
+        if retry_after is None or limiter is None:
+            time.sleep(max(retry_after or 0, backoff_delay(attempt)))
+        else:
+            # the limiter already waits for Retry-After, add some jitter so that senders don't wake up together
+            time.sleep(backoff_delay(0))
+        attempt += 1
+
+
+def _observed_dumpb(url, incoming_message, observer):
+    if isinstance(incoming_message, bytes):
+        return incoming_message
+    started = time.time()
+    data = incoming_message.dumpb()
+    observer.serialized(url, time.time() - started)
+    return data
+
+
+def _observe_answer(url, status, seconds, last_attempt, observer):
+    observer.request_finished(url, status, seconds)
+    if status == 200:
+        observer.sent(url)
+    elif status in RETRY_CODES and not last_attempt:
+        observer.retried(url, status)
+    else:
+        observer.failed(url, status)
+
+
+def send_summaries(session, summaries, max_retries=0):
+    """
+    Post the summaries returned by `DedupCache.expire`. Failures are ignored.
+    """
+    for url, summary in summaries:
+        try:
+            send(session, url, summary, get_limiter(url), max_retries)
+        except requests.RequestException:
+            pass
 
 
 class Poster(object):
-    def __init__(self, incoming_webhook_url):
+    """
+    Post messages to a webhook.
+
+    With a `DedupCache`, duplicates of recently posted messages are not sent (`post` returns None), and the summaries
+    of the suppressed duplicates are posted along the following messages, or by `flush`.
+
+    The send path is reported to `observer`, a `pymatter.metrics.Observer`.
+    """
+    def __init__(self, incoming_webhook_url, max_retries=5, limiter=None, dedup=None, observer=None):
         self.url = incoming_webhook_url
+        self.max_retries = max_retries
+        self.limiter = get_limiter(incoming_webhook_url) if limiter is None else limiter
+        self.dedup = dedup
+        self.observer = observer
         self.session = requests.Session()
         self.session.headers.update({'Content-Type': 'application/json'})
 
     def post(self, incoming_message):
         incoming_message = IncomingMessage.factory(incoming_message)
-        r = self.session.post(self.url, json=incoming_message.to_dict())
+        if self.dedup is not None:
+            send_summaries(self.session, self.dedup.expire(), self.max_retries)
+            if self.dedup.seen(incoming_message, self.url):
+                return None
+        r = send(self.session, self.url, incoming_message, self.limiter, self.max_retries, self.observer)
         if r.status_code != requests.codes.ok:
             r.raise_for_status()
         return r
 
+    def flush(self):
+        """
+        Close the deduplication windows and post their summaries.
+        """
+        if self.dedup is not None:
+            send_summaries(self.session, self.dedup.expire(everything=True), self.max_retries)
+
     def __repr__(self):
         return u"Poster('{}')".format(self.url)
 
@@ -178,48 +605,297 @@ class Poster(object):
         return u"Poster('{}')".format(self.url)
 
 
+class Delivery(object):
+    """
+    Handle on a message posted by an `AsyncPoster`.
+
+    Once the delivery is `done`, `status` holds the HTTP status of the last answer (-1 when the server could not be
+    reached), or `error` the exception that prevented the delivery (`queue.Full` when the message was dropped).
+    """
+    __slots__ = ('message', 'status', 'error', 'finished', 'callbacks', 'condition')
+
+    def __init__(self, message, condition):
+        self.message = message
+        self.status = None
+        self.error = None
+        self.finished = False
+        self.callbacks = None
+        # shared by the deliveries of a poster
+        self.condition = condition
+
+    def done(self):
+        return self.finished
+
+    @property
+    def ok(self):
+        return self.status == 200
+
+    def result(self, timeout=None):
+        """
+        Wait until the delivery is done and return the HTTP status. Raise the error that prevented the delivery, or
+        `concurrent.futures.TimeoutError` if it is still pending after `timeout` seconds.
+        """
+        if not self.finished:
+            deadline = None if timeout is None else time.time() + timeout
+            with self.condition:
+                while not self.finished:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        from concurrent.futures import TimeoutError
+                        raise TimeoutError()
+                    self.condition.wait(remaining)
+        if self.error is not None:
+            raise self.error
+        return self.status
+
+    def add_done_callback(self, callback):
+        """
+        Call `callback(delivery)` when the delivery is done: from the sending thread, or now if it is already done.
+        """
+        with self.condition:
+            if not self.finished:
+                if self.callbacks is None:
+                    self.callbacks = []
+                self.callbacks.append(callback)
+                return
+        self.invoke(callback)
+
+    def invoke(self, callback):
+        # like concurrent.futures, a failing callback must not break the sending thread or the other callbacks
+        try:
+            callback(self)
+        except Exception:
+            logging.exception("Exception calling the callback of %r", self)
+
+    def resolve(self, status=None, error=None):
+        with self.condition:
+            self.status = status
+            self.error = error
+            self.finished = True
+            callbacks, self.callbacks = self.callbacks, None
+            self.condition.notify_all()
+        for callback in callbacks or ():
+            self.invoke(callback)
+
+    def __repr__(self):
+        state = u'pending' if not self.finished else (self.status if self.error is None else repr(self.error))
+        return u"Delivery({})".format(state)
+
+
 class AsyncPoster(object):
-    def __init__(self, incoming_webhook_url):
+    """
+    Post messages to a webhook in the background.
+
+    `workers` threads share one HTTP session whose connection pool holds `pool_size` connections (defaults to the
+    number of workers). When `queue_size` is positive, the queue is bounded and `overflow` decides what `post` does
+    when it is full: block until a worker frees a slot (``'block'``), discard the oldest queued message
+    (``'drop-oldest'``) or discard the message being posted (``'drop-newest'``). Discarded messages are counted in
+    `dropped`.
+
+    `post` returns a `Delivery` handle. The outcomes are aggregated in `sent`, `failed` and `codes` (count of answers by
+    HTTP status, -1 when the server could not be reached). The last `max_failures` failed deliveries are kept in
+    `failures`, with their message, so that they can be posted again with `retry_failures`.
+
+    Like `Poster`, sends wait on the rate limiter shared by all posters of the same URL, and throttled or failed sends
+    are retried up to `max_retries` times.
+
+    When a `Spool` is given, posted messages are written to it instead of the in-memory queue, and a single thread
+    delivers them in order, retrying until the server accepts them. Messages that could not be delivered when the
+    poster exits stay in the spool and are delivered by the next poster using it; their deliveries stay pending.
+
+    With a `DedupCache`, duplicates are not queued; their summaries are posted when their window closes, or when the
+    poster exits.
+
+    The send path, including the queue depth and the time spent by the messages in the queue, is reported to
+    `observer`, a `pymatter.metrics.Observer`.
+    """
+    BLOCK = u'block'
+    DROP_OLDEST = u'drop-oldest'
+    DROP_NEWEST = u'drop-newest'
+    OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+    def __init__(self, incoming_webhook_url, workers=1, queue_size=0, overflow=u'block', pool_size=None,
+                 max_retries=5, limiter=None, spool=None, dedup=None, observer=None, max_failures=100):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(u"overflow must be one of: {}".format(u', '.join(self.OVERFLOW_POLICIES)))
         self.url = incoming_webhook_url
+        self.workers = max(1, int(workers))
+        self.queue_size = max(0, int(queue_size))
+        self.overflow = overflow
+        self.pool_size = self.workers if pool_size is None else max(1, int(pool_size))
+        self.max_retries = max_retries
+        self.limiter = get_limiter(incoming_webhook_url) if limiter is None else limiter
+        self.spool = spool
+        self.dedup = dedup
+        self.observer = observer
         self.session = requests.Session()
         self.session.headers.update({'Content-Type': 'application/json'})
-        self.thread = None
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.threads = []
         self.queue = None
-        self.answers_codes = None
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.codes = Counter()
+        self.failures = deque(maxlen=max(0, int(max_failures)))
+        self.stats_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.spooled = {}
         self.stopping = threading.Event()
 
+    @property
+    def all_sent(self):
+        """
+        True if every message was accepted by the server.
+        """
+        return self.failed == 0 and self.dropped == 0
+
     def __enter__(self):
         self.stopping.clear()
-        self.queue = Queue()
-        self.answers_codes = []
-        self.thread = threading.Thread(target=self.posting_thread)
-        self.thread.start()
+        self.queue = Queue(self.queue_size)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.codes = Counter()
+        self.failures.clear()
+        if self.spool is None:
+            self.threads = [threading.Thread(target=self.posting_thread) for _ in range(self.workers)]
+        else:
+            self.threads = [threading.Thread(target=self.spool_thread)]
+        for thread in self.threads:
+            thread.start()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stopping.set()
-        if self.thread is not None:
-            self.thread.join()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.spool is not None:
+            self.spool.sync()
+        if self.dedup is not None:
+            send_summaries(self.session, self.dedup.expire(everything=True), self.max_retries)
 
     def posting_thread(self):
         while (not self.stopping.is_set()) or (not self.queue.empty()):
             try:
-                msg = self.queue.get(True, 0.1)
+                delivery, queued_at = self.queue.get(True, 0.1)
             except Empty:
-                pass
+                if self.dedup is not None:
+                    send_summaries(self.session, self.dedup.expire(), self.max_retries)
             else:
+                if self.observer is not None:
+                    self.observer.dequeued(self.url, time.time() - queued_at, self.queue.qsize())
                 try:
-                    resp = self.session.post(self.url, json=msg.to_dict())
+                    resp = send(self.session, self.url, delivery.message, self.limiter, self.max_retries, self.observer)
                 except requests.RequestException as ex:
-                    if ex.response:
-                        self.answers_codes.append(ex.response.status_code)
-                    else:
-                        self.answers_codes.append(-1)
+                    self._done(delivery, -1 if ex.response is None else ex.response.status_code, ex)
+                else:
+                    self._done(delivery, resp.status_code)
+
+    def _done(self, delivery, status, error=None):
+        with self.stats_lock:
+            self.codes[status] += 1
+            if status == 200:
+                self.sent += 1
+            else:
+                self.failed += 1
+                self.failures.append(delivery)
+        delivery.resolve(status, error)
+
+    def spool_thread(self):
+        attempt = 0
+        while True:
+            records = self.spool.pending()
+            if not records:
+                if self.stopping.is_set():
+                    return
+                self.spool.sync()
+                if self.dedup is not None:
+                    send_summaries(self.session, self.dedup.expire(), self.max_retries)
+                self.spool.not_empty.wait(0.1)
+                continue
+            for position, data in records:
+                try:
+                    code = send(self.session, self.url, data, self.limiter, self.max_retries, self.observer).status_code
+                except requests.RequestException:
+                    code = -1
+                if code == -1 or code in RETRY_CODES:
+                    # the server is unavailable: keep the message in the spool
+                    if self.stopping.is_set():
+                        return
+                    time.sleep(backoff_delay(attempt))
+                    attempt = min(attempt + 1, 6)
+                    break
+                attempt = 0
+                self.spool.commit(position)
+                with self.stats_lock:
+                    delivery = self.spooled.pop(position, None)
+                if delivery is None:
+                    # posted by a previous poster
+                    with self.stats_lock:
+                        self.codes[code] += 1
+                        self.sent += code == 200
+                        self.failed += code != 200
                 else:
-                    self.answers_codes.append(resp.status_code)
+                    self._done(delivery, code)
 
     def post(self, incoming_message):
-        self.queue.put(IncomingMessage.factory(incoming_message))
+        """
+        Queue a message and return its `Delivery`, or None if it is a duplicate.
+        """
+        msg = IncomingMessage.factory(incoming_message)
+        if self.dedup is not None and self.dedup.seen(msg, self.url):
+            return None
+        delivery = Delivery(msg, self.condition)
+        if self.spool is not None:
+            data = msg.dumpb() if self.observer is None else _observed_dumpb(self.url, msg, self.observer)
+            # the record may be delivered before post returns: register it under the lock used by spool_thread
+            with self.stats_lock:
+                self.spooled[self.spool.append(data)] = delivery
+            return delivery
+        item = (delivery, time.time())
+        if self.overflow == self.BLOCK:
+            self.queue.put(item)
+            self._queued()
+            return delivery
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                self._queued()
+                return delivery
+            except Full:
+                if self.overflow == self.DROP_NEWEST:
+                    self._drop(delivery)
+                    return delivery
+            try:
+                dropped = self.queue.get_nowait()[0]
+            except Empty:
+                pass
+            else:
+                self._drop(dropped)
+
+    def retry_failures(self):
+        """
+        Post again the messages of the failed deliveries kept in `failures`, and return their new deliveries.
+        """
+        with self.stats_lock:
+            failures = list(self.failures)
+            self.failures.clear()
+        return [self.post(delivery.message) for delivery in failures]
+
+    def _queued(self):
+        if self.observer is not None:
+            self.observer.queued(self.url, self.queue.qsize())
+
+    def _drop(self, delivery):
+        with self.stats_lock:
+            self.dropped += 1
+        if self.observer is not None:
+            self.observer.dropped(self.url)
+        delivery.resolve(error=Full())
 
     def __repr__(self):
         return u"AsyncPoster('{}')".format(self.url)
@@ -228,7 +904,234 @@ class AsyncPoster(object):
         return u"AsyncPoster('{}')".format(self.url)
 
 
+class Destination(object):
+    """
+    Webhook URL, with the channel, username and icon URL that replace those of the messages posted to it (None keeps
+    the value of the message).
+
+    The outcomes of the deliveries to the destination are counted in `sent`, `failed` and `codes`.
+    """
+    __slots__ = ('url', 'channel', 'username', 'icon_url', 'sent', 'failed', 'codes')
+
+    def __init__(self, url, channel=None, username=None, icon_url=None):
+        self.url = decode_text(url)
+        self.channel = decode_text(channel)
+        self.username = decode_text(username)
+        self.icon_url = decode_text(icon_url)
+        self.sent = 0
+        self.failed = 0
+        self.codes = Counter()
+
+    @classmethod
+    def factory(cls, d):
+        if isinstance(d, Destination):
+            return d
+        if isinstance(d, dict):
+            return cls(d['url'], d.get('channel'), d.get('username'), d.get('icon_url'))
+        return cls(d)
+
+    def overrides(self):
+        overrides = {}
+        if self.channel is not None:
+            overrides['channel'] = self.channel
+        if self.username is not None:
+            overrides['username'] = self.username
+        if self.icon_url is not None:
+            overrides['icon_url'] = self.icon_url
+        return overrides
+
+    def __repr__(self):
+        return u"Destination('{}')".format(self.url)
+
+
+class FanoutPoster(object):
+    """
+    Post each message to several destinations in parallel.
+
+    `destinations` are URLs, `Destination` objects or dicts with the keys of `Destination`. The message is serialized
+    once: each destination gets the same bytes, or a copy of the top level where its overrides are applied, around
+    the attachments serialized once. Deliveries run on a pool of `workers` threads (one per destination by default)
+    sharing one HTTP session; each destination has its own rate limiter and retries, up to `max_retries` times.
+
+    `post` returns one `Delivery` per destination, in the order of the destinations. Use the poster as a context
+    manager, or call `close` to wait for the pending deliveries.
+    """
+    def __init__(self, destinations, workers=None, max_retries=5, observer=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.destinations = [Destination.factory(d) for d in destinations]
+        if not self.destinations:
+            raise ValueError(u"at least one destination is needed")
+        self.workers = max(1, int(workers)) if workers else len(self.destinations)
+        self.max_retries = max_retries
+        self.observer = observer
+        self.limiters = [get_limiter(d.url) for d in self.destinations]
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json'})
+        # one connection pool per destination host, so that the pools don't evict each other
+        hosts = set()
+        for d in self.destinations:
+            parts = urlsplit(d.url)
+            hosts.add((parts.scheme, parts.hostname, parts.port))
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=len(hosts), pool_maxsize=self.workers, pool_block=True
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.stats_lock = threading.Lock()
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    @property
+    def all_sent(self):
+        """
+        True if every message was accepted by every destination.
+        """
+        return all(d.failed == 0 for d in self.destinations)
+
+    def post(self, incoming_message):
+        """
+        Start the delivery of a message to every destination and return the `Delivery` handles.
+        """
+        msg = IncomingMessage.factory(incoming_message)
+        bodies = {}
+        deliveries = []
+        for destination, limiter in zip(self.destinations, self.limiters):
+            overrides = destination.overrides()
+            key = tuple(sorted(overrides.items()))
+            body = bodies.get(key)
+            if body is None:
+                body = bodies[key] = self._serialize(destination.url, msg, overrides)
+            delivery = Delivery(msg, self.condition)
+            self.executor.submit(self._deliver, destination, limiter, body, delivery)
+            deliveries.append(delivery)
+        return deliveries
+
+    def _serialize(self, url, msg, overrides):
+        if self.observer is None:
+            return msg.dumpb_with(**overrides)
+        started = time.time()
+        body = msg.dumpb_with(**overrides)
+        self.observer.serialized(url, time.time() - started)
+        return body
+
+    def _deliver(self, destination, limiter, body, delivery):
+        try:
+            resp = send(self.session, destination.url, body, limiter, self.max_retries, self.observer)
+        except requests.RequestException as ex:
+            status, error = -1 if ex.response is None else ex.response.status_code, ex
+        else:
+            status, error = resp.status_code, None
+        with self.stats_lock:
+            destination.codes[status] += 1
+            if status == 200:
+                destination.sent += 1
+            else:
+                destination.failed += 1
+        delivery.resolve(status, error)
+
+    def __repr__(self):
+        return u"FanoutPoster({})".format(len(self.destinations))
+
+
+class LineBatcher(object):
+    """
+    Coalesce consecutive lines of text and hand them to `callback` as a single string.
+
+    A batch is flushed as soon as it holds `max_lines` lines, would grow beyond `max_bytes` (UTF-8 encoded), or its
+    first line has been waiting for `max_latency` seconds, whichever comes first.
+    """
+    def __init__(self, callback, max_bytes=4000, max_lines=100, max_latency=1.0):
+        self.callback = callback
+        self.max_bytes = max(1, int(max_bytes))
+        self.max_lines = max(1, int(max_lines))
+        self.max_latency = max(0.0, float(max_latency))
+        self.lines = []
+        self.size = 0
+        self.deadline = None
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.stopping = False
+        self.thread = None
+
+    def __enter__(self):
+        self.stopping = False
+        self.thread = threading.Thread(target=self.timer_thread)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def add(self, line):
+        line = decode_text(line)
+        size = len(line.encode('utf-8'))
+        with self.flush_lock:
+            batches = []
+            with self.condition:
+                if self.lines and self.size + size > self.max_bytes:
+                    batches.append(self._take())
+                self.lines.append(line)
+                self.size += size
+                if len(self.lines) >= self.max_lines or self.size >= self.max_bytes:
+                    batches.append(self._take())
+                elif self.deadline is None:
+                    self.deadline = time.time() + self.max_latency
+                    self.condition.notify()
+            for batch in batches:
+                self.callback(batch)
+
+    def flush(self, expired_only=False):
+        # flush_lock keeps batches in order when the timer thread and the producer flush concurrently
+        with self.flush_lock:
+            with self.condition:
+                if expired_only and (self.deadline is None or self.deadline > time.time()):
+                    return
+                batch = self._take()
+            if batch:
+                self.callback(batch)
+
+    def _take(self):
+        batch = u''.join(self.lines)
+        self.lines = []
+        self.size = 0
+        self.deadline = None
+        return batch
+
+    def timer_thread(self):
+        while True:
+            with self.condition:
+                if self.stopping:
+                    return
+                if self.deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = self.deadline - time.time()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+            self.flush(expired_only=True)
+
+
 class Code(object):
+    __slots__ = ('language', 'code')
+
     def __init__(self, code, language=u''):
         language = u'' if language is None else decode_text(language)
         self.language = language
@@ -245,6 +1148,8 @@ class Code(object):
 
 
 class Emoji(object):
+    __slots__ = ('emoji_text',)
+
     def __init__(self, emoji_text):
         self.emoji_text = decode_text(emoji_text)
 
@@ -15,11 +15,14 @@ import sys
 import getpass
 import os
 import datetime
-from os.path import exists, basename
+import io
+import mmap
+import codecs
+from os.path import exists, basename, getsize
 
-import requests
-
-from .base import IncomingMessage, Code, Attachment, Field, decode_text
+from .base import IncomingMessage, AsyncPoster, Code, Attachment, Field, decode_text
+from .oneshot import post, hand_off, PostError
+from .cli import exit_with_report
 
 ext_to_language = {
     'md': 'markdown',
@@ -39,6 +42,95 @@ ext_to_language = {
     'ini': 'ini'
 }
 
+# files larger than this are read through a memory map
+MMAP_THRESHOLD = 1024 * 1024
+
+
+def file_language(filename, language):
+    """
+    Language used to highlight `filename`: `language`, or the language guessed from the file extension when
+    `language` is 'detect'.
+    """
+    if language != "detect":
+        return language
+    try:
+        return ext_to_language[decode_text(filename.rsplit('.', 1)[1])]
+    except (IndexError, KeyError):
+        return None
+
+
+def read_file(filename):
+    """
+    Return the content of `filename` as text. Large files are decoded straight from a memory map, without an
+    intermediate copy of their content.
+    """
+    size = getsize(filename)
+    with open(filename, 'rb') as handle:
+        if size < MMAP_THRESHOLD:
+            return codecs.utf_8_decode(handle.read(), 'replace', True)[0]
+        buf = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return codecs.utf_8_decode(buf, 'replace', True)[0]
+        finally:
+            buf.close()
+
+
+def iter_chunks(handle, chunk_size):
+    """
+    Read the text file `handle` incrementally, and yield its content in chunks of at most `chunk_size` UTF-8 bytes.
+
+    Chunks are cut on line boundaries. Lines longer than `chunk_size` are cut too. Every chunk ends with a new line,
+    so that the closing code fence stays on its own line.
+    """
+    lines = []
+    size = 0
+    for line in handle:
+        if not line.endswith('\n'):
+            line += '\n'
+        n = len(line.encode('utf-8'))
+        if lines and size + n > chunk_size:
+            yield ''.join(lines)
+            lines, size = [], 0
+        while n > chunk_size:
+            head = line.encode('utf-8')[:chunk_size - 1].decode('utf-8', 'ignore')
+            yield head + '\n'
+            line = line[len(head):]
+            n = len(line.encode('utf-8'))
+        lines.append(line)
+        size += n
+    if lines:
+        yield ''.join(lines)
+
+
+def post_chunks(url, args, msg_args, fields):
+    """
+    Post each file as a series of numbered parts. Files are streamed concurrently, but the parts of a file go through
+    a single sender so that they arrive in order. Return the posters.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    fence_size = len(str(Code('', 'x' * 20)).encode('utf-8'))
+    chunk_size = max(100, args.chunksize - (0 if args.plain else fence_size))
+
+    def post_file(f):
+        base = basename(f)
+        language = file_language(base, decode_text(args.language))
+        poster = AsyncPoster(url, workers=1, queue_size=2)
+        with poster:
+            with io.open(f, encoding='utf-8', errors='replace') as handle:
+                for number, chunk in enumerate(iter_chunks(handle, chunk_size), 1):
+                    title = u"{} (part {})".format(base, number)
+                    att = Attachment(fallback=title, text=chunk if args.plain else Code(chunk, language), title=title)
+                    for name, value in fields:
+                        att.fields.append(Field(name, value, True))
+                    att.fields.append(Field('File name', base, True))
+                    att.fields.append(Field('Part', number, True))
+                    poster.post(IncomingMessage(attachments=[att], **msg_args))
+        return poster
+
+    with ThreadPoolExecutor(max(1, args.workers)) as executor:
+        return list(executor.map(post_file, args.files))
+
+
 def main():
     hostname = platform.uname()[1]
     local_username = getpass.getuser()
@@ -52,6 +144,13 @@ def main():
     parser.add_argument("-m", "--mattermosturl", help="Post the message to the specified webhook URL")
     parser.add_argument("-p", "--plain", action='store_true', help="Don't surround the message with triple ticks")
     parser.add_argument("-u", "--username", default="pymattertee", help="Displayed username")
+    parser.add_argument("--direct", action='store_true', help="Post directly, even when a relay is running")
+    parser.add_argument("-s", "--split", action='store_true',
+                        help="Stream the files and post them in parts of at most --chunksize bytes")
+    parser.add_argument("--chunksize", type=int, default=15000, help="Maximum size of a part in bytes")
+    parser.add_argument("-S", "--separate", action='store_true', help="Post each file as a separate message")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                        help="Number of files read and messages sent concurrently")
     parser.add_argument("files", nargs="+", help="Files to print")
     args = parser.parse_args()
 
@@ -63,42 +162,65 @@ def main():
     username = decode_text(args.username if args.username else os.environ.get("MM_USERNAME"))
 
     if not url:
-        sys.stderr.write(b"No Mattermost URL was provided\n")
+        sys.stderr.write("No Mattermost URL was provided\n")
         sys.exit(-1)
 
     for f in args.files:
         if not exists(f):
-            sys.stderr.write(b"'{}' does not exist\n".format(f))
+            sys.stderr.write("'{}' does not exist\n".format(f))
             sys.exit(-1)
 
     now = datetime.datetime.utcnow().strftime('%c')
     text = u"**{} on `{}` wrote:**\n".format(local_username, hostname)
-    msg = IncomingMessage(username=username, icon_url=icon_url, channel=channel, text=text)
 
-    for f in args.files:
-        with open(f) as handle:
-            buf = handle.read()
+    if args.split:
+        posters = post_chunks(
+            url, args, dict(username=username, icon_url=icon_url, channel=channel, text=text),
+            [('Date', now), ('Local user', local_username), ('Hostname', hostname)]
+        )
+        exit_with_report(posters)
+        return
+
+    def make_attachment(f):
+        buf = read_file(f)
         base = basename(f)
-        if language == "detect":
-            try:
-                ext = decode_text(base.rsplit('.', 1)[1])
-                language = ext_to_language[ext]
-            except (IndexError, KeyError):
-                pass
-        att = Attachment(fallback=base, text=buf if plain else Code(buf, language), title=base)
+        att = Attachment(fallback=base, text=buf if plain else Code(buf, file_language(base, language)), title=base)
         att.fields.append(Field('Date', now, True))
         att.fields.append(Field('Local user', local_username, True))
         att.fields.append(Field('Hostname', hostname, True))
         att.fields.append(Field('File name', base, True))
-        msg.attachments.append(att)
+        return att
+
+    from concurrent.futures import ThreadPoolExecutor
+    workers = max(1, args.workers)
+    with ThreadPoolExecutor(workers) as executor:
+        attachments = executor.map(make_attachment, args.files)
+
+        if args.separate:
+            poster = AsyncPoster(url, workers=workers, queue_size=workers)
+            with poster:
+                for att in attachments:
+                    poster.post(IncomingMessage(
+                        username=username, icon_url=icon_url, channel=channel, text=text, attachments=[att]
+                    ))
+            exit_with_report([poster])
+            return
+
+        msg = IncomingMessage(
+            username=username, icon_url=icon_url, channel=channel, text=text, attachments=list(attachments)
+        )
+
+    if not args.direct and hand_off(url, msg):
+        sys.stderr.write("Message handed to the relay\n")
+        return
 
     try:
-        resp = msg.post(url)
-    except requests.RequestException as ex:
+        post(url, msg)
+    except PostError as ex:
         sys.stderr.write(str(ex) + '\n')
         sys.exit(-1)
     else:
-        sys.stderr.write(b"Mattermost server answered OK\n")
+        sys.stderr.write("Mattermost server answered OK\n")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+"""
+Helpers shared by the command line tools.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+from collections import Counter
+
+
+def format_codes(codes):
+    return " ".join(["{} (x{})".format(code, n) for code, n in sorted(codes.items()) if code != 200])
+
+
+def exit_with_report(posters, lost=False):
+    """
+    Report the outcome of the messages posted by `posters`, and exit with a non zero status when some content did not
+    reach mattermost: failed or dropped messages, or `lost` content.
+    """
+    if any(poster.failed for poster in posters):
+        codes = Counter()
+        for poster in posters:
+            codes.update(poster.codes)
+        sys.stderr.write("One or more requests failed: {}\n".format(format_codes(codes)))
+        sys.exit(-1)
+    if lost or any(poster.dropped for poster in posters):
+        sys.exit(-1)
+    sys.stderr.write("Mattermost server answered OK\n")
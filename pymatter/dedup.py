@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""
+Suppression of repeated messages.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from .base import IncomingMessage
+
+
+class DedupCache(object):
+    """
+    Remember the messages sent during the last `ttl` seconds, and flag identical messages as duplicates.
+
+    Messages are identical when their JSON serializations are equal and they go to the same destination (`scope`,
+    usually the webhook URL). The window of a message opens when it is first seen and closes `ttl` seconds later.
+    When a window closes after duplicates were suppressed, `expire` returns a summary message for it, unless
+    `summary` is false. At most `max_size` windows are tracked; the oldest ones are closed first.
+    """
+    def __init__(self, ttl=60.0, max_size=10000, summary=True):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.summary = summary
+        self.entries = OrderedDict()
+        self.evicted = []
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(message, scope):
+        return hashlib.sha1(scope.encode('utf-8') + b'\n' + message.dumpb()).digest()
+
+    def seen(self, message, scope=''):
+        """
+        Return True if `message` is a duplicate that should not be sent.
+        """
+        message = IncomingMessage.factory(message)
+        key = self.key(message, scope)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                entry[1] += 1
+                self.suppressed += 1
+                return True
+            if entry is not None:
+                del self.entries[key]
+                if entry[1]:
+                    self.evicted.append(entry)
+            self.entries[key] = [now + self.ttl, 0, scope, message]
+            while len(self.entries) > self.max_size:
+                entry = self.entries.popitem(last=False)[1]
+                if entry[1]:
+                    self.evicted.append(entry)
+            return False
+
+    def expire(self, everything=False):
+        """
+        Close the expired windows (or all of them) and return the summaries to post, as (scope, message) tuples.
+        """
+        now = time.time()
+        with self.lock:
+            closed, self.evicted = self.evicted, []
+            # entries are ordered by expiration date
+            while self.entries:
+                key, entry = next(iter(self.entries.items()))
+                if not everything and entry[0] > now:
+                    break
+                del self.entries[key]
+                closed.append(entry)
+        if not self.summary:
+            return []
+        return [(scope, summary_message(message, count)) for _, count, scope, message in closed if count > 0]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return u"DedupCache({}, {})".format(self.ttl, self.max_size)
+
+
+def summary_message(message, count):
+    text = message.text or (message.attachments[0].fallback if message.attachments else None) or u''
+    if len(text) > 200:
+        text = text[:200] + u'…'
+    return IncomingMessage(
+        text=u"_Suppressed {} duplicate{} of:_\n{}".format(count, u's' if count > 1 else u'', text),
+        username=message.username,
+        icon_url=message.icon_url,
+        channel=message.channel
+    )
@@ -16,9 +16,8 @@ import getpass
 import os
 import datetime
 
-import requests
-
 from .base import IncomingMessage, Attachment, Field, decode_text
+from .oneshot import post, hand_off, PostError
 
 
 def main():
@@ -32,6 +31,7 @@ def main():
     parser.add_argument("-i", "--iconurl", help="Icon URL")
     parser.add_argument("-m", "--mattermosturl", help="Post the message to the specified webhook URL")
     parser.add_argument("-u", "--username", default="pymattertee", help="Displayed username")
+    parser.add_argument("--direct", action='store_true', help="Post directly, even when a relay is running")
     parser.add_argument("arguments", nargs="+", help="Arguments to print")
     args = parser.parse_args()
 
@@ -41,7 +41,7 @@ def main():
     username = decode_text(args.username if args.username else os.environ.get("MM_USERNAME"))
 
     if not url:
-        sys.stderr.write(b"No Mattermost URL was provided\n")
+        sys.stderr.write("No Mattermost URL was provided\n")
         sys.exit(-1)
 
     buf = ' '.join(args.arguments)
@@ -53,13 +53,17 @@ def main():
     att.fields.append(Field('Hostname', hostname, True))
     msg.attachments.append(att)
 
+    if not args.direct and hand_off(url, msg):
+        sys.stderr.write("Message handed to the relay\n")
+        return
+
     try:
-        resp = msg.post(url)
-    except requests.RequestException as ex:
+        post(url, msg)
+    except PostError as ex:
         sys.stderr.write(str(ex) + '\n')
         sys.exit(-1)
     else:
-        sys.stderr.write(b"Mattermost server answered OK\n")
+        sys.stderr.write("Mattermost server answered OK\n")
 
 
 if __name__ == '__main__':
@@ -9,14 +9,24 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import errno
 import logging
 import signal
 import os
+import shutil
 import sys
+import tempfile
+import time
 from os.path import expanduser, abspath, exists, dirname, join
-from ConfigParser import SafeConfigParser
+try:
+    from ConfigParser import SafeConfigParser
+except ImportError:
+    from configparser import ConfigParser as SafeConfigParser
 import argparse
-import json
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
 
 import tornado.ioloop
 import tornado.httpserver
@@ -25,57 +35,233 @@ import tornado.netutil
 import tornado.process
 import tornado.httpclient
 import tornado.gen
+import tornado.locks
+import tornado.concurrent
+import tornado.util
+
+from .aio import make_http_client, handle_signals
+from .base import IncomingMessage
+from .dedup import DedupCache
+from .metrics import Registry, MetricsObserver, CONTENT_TYPE, upstream, merge_renderings
+from .ratelimit import backoff_delay, RETRY_CODES
+from .spool import Spool
+from .serializer import dumpb, loads
 
 IOLoop = tornado.ioloop.IOLoop
 HTTPServer = tornado.httpserver.HTTPServer
 RequestHandler = tornado.web.RequestHandler
 Application = tornado.web.Application
 bind_sockets = tornado.netutil.bind_sockets
-fork_processes = tornado.process.fork_processes
+cpu_count = tornado.process.cpu_count
 AsyncHTTPClient = tornado.httpclient.AsyncHTTPClient
 HTTPRequest = tornado.httpclient.HTTPRequest
 HTTPError = tornado.httpclient.HTTPError
+PeriodicCallback = tornado.ioloop.PeriodicCallback
 coroutine = tornado.gen.coroutine
+sleep = tornado.gen.sleep
+Event = tornado.locks.Event
+TimeoutError = tornado.util.TimeoutError
+Future = tornado.concurrent.Future
 
 defaults = {
     'port': '8080',
     'default_path': '/hook',
     'hooks_path': '/hooks',
-    'bind_localhost': 'false'
+    'bind_localhost': 'false',
+    'validation': 'full',
+    'status_path': '/status',
+    'metrics_path': '/metrics',
+    'max_clients': '100',
+    'connect_timeout': '10',
+    'request_timeout': '30',
+    'workers': '1',
+    'shutdown_timeout': '10'
 }
 
+# full: parse the JSON body and forward it re-encoded
+# structural: forward the original body if it looks like a JSON object
+# none: forward the original body as is
+VALIDATION_MODES = ('full', 'structural', 'none')
+
 server = None
+application = None
+children = {}
+stopping = False
+
+
+class Upstreams(object):
+    """
+    HTTP clients used to forward messages, one per upstream host.
+
+    Each client (a `pymatter.aio.KeepAliveHTTPClient`) runs at most `max_clients` concurrent requests over keep-alive
+    connections; further requests wait in the client queue. The pool statistics report the requests in flight or queued
+    (`pending`), how many requests had to wait because the pool was full (`saturated`) and how many connections were
+    opened (`connections`). The requests are also reported to `observer`, a `pymatter.metrics.Observer`.
+    """
+    def __init__(self, max_clients=100, connect_timeout=10, request_timeout=30, observer=None):
+        self.max_clients = max_clients
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.observer = observer
+        self.clients = {}
+        self.stats = {}
+
+    def client(self, host):
+        # clients are created lazily, in the process and the IOLoop that use them
+        client = self.clients.get(host)
+        if client is None:
+            client = self.clients[host] = make_http_client(
+                self.max_clients, connect_timeout=self.connect_timeout, request_timeout=self.request_timeout
+            )
+            self.stats[host] = {'requests': 0, 'errors': 0, 'pending': 0, 'peak_pending': 0, 'saturated': 0}
+        return client
+
+    @coroutine
+    def fetch(self, request):
+        host = urlsplit(request.url).netloc
+        client = self.client(host)
+        stats = self.stats[host]
+        stats['requests'] += 1
+        if stats['pending'] >= self.max_clients:
+            stats['saturated'] += 1
+        stats['pending'] += 1
+        stats['peak_pending'] = max(stats['peak_pending'], stats['pending'])
+        observer = self.observer
+        if observer is not None:
+            observer.request_started(request.url)
+        started = time.time()
+        try:
+            resp = yield client.fetch(request)
+        except Exception as ex:
+            stats['errors'] += 1
+            if observer is not None:
+                code = getattr(ex, 'code', 599)
+                status = -1 if code == 599 else code
+                observer.request_finished(request.url, status, time.time() - started)
+                observer.failed(request.url, status)
+            raise
+        finally:
+            stats['pending'] -= 1
+        if observer is not None:
+            observer.request_finished(request.url, resp.code, time.time() - started)
+            observer.sent(request.url)
+        raise tornado.gen.Return(resp)
+
+    def pool_stats(self):
+        return {
+            host: dict(stats, max_clients=self.max_clients, connections=self.clients[host].connections)
+            for host, stats in self.stats.items()
+            if host in self.clients
+        }
+
+    def metrics(self):
+        """
+        Pool statistics in the Prometheus text format.
+        """
+        lines = []
+        for name, kind, key, documentation in [
+            ('pymatter_upstream_pool_size', 'gauge', 'max_clients', 'Maximum number of concurrent requests'),
+            ('pymatter_upstream_pending', 'gauge', 'pending', 'Requests in flight or waiting for the pool'),
+            ('pymatter_upstream_peak_pending', 'gauge', 'peak_pending', 'Highest number of pending requests'),
+            ('pymatter_upstream_saturated_total', 'counter', 'saturated', 'Requests that waited for the pool'),
+            ('pymatter_upstream_requests_total', 'counter', 'requests', 'Requests sent upstream'),
+            ('pymatter_upstream_errors_total', 'counter', 'errors', 'Upstream requests that failed'),
+            ('pymatter_upstream_connections_total', 'counter', 'connections', 'Connections opened to the upstream')
+        ]:
+            lines.append('# HELP {} {}'.format(name, documentation))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for host, stats in sorted(self.pool_stats().items()):
+                lines.append('{}{{upstream="{}"}} {}'.format(name, host, stats[key]))
+        return lines
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients = {}
 
 
 class MyHandler(RequestHandler):
 
+    def on_finish(self):
+        app = self.application
+        app.requests_total.inc(code=self.get_status())
+        app.request_seconds.observe(self.request.request_time())
+
+    def json_body(self):
+        """
+        Return the JSON message to forward, as bytes. Raise ValueError if the request does not hold a valid message.
+
+        JSON bodies are forwarded unchanged unless the validation mode is 'full'. Form encoded messages (in the
+        'payload' argument) are always decoded and encoded again.
+        """
+        content_type = self.request.headers.get('content-type')
+        if content_type is not None and 'json' in content_type:
+            body = self.request.body
+            validation = self.application.validation
+            if validation == 'none':
+                return body
+            if validation == 'structural':
+                if not looks_like_json_object(body):
+                    raise ValueError("body is not a JSON object")
+                return body
+            return dumpb(loads(body))
+        payload = self.get_body_argument('payload', None)
+        if payload is None:
+            raise ValueError("no payload")
+        return dumpb(loads(payload))
+
     @coroutine
     def forward_to_hook(self, hook_url):
-        headers = self.request.headers
-        content_type = headers.get('content-type')
+        self.application.in_flight += 1
         try:
-            if content_type is not None and 'json' in content_type:
-                json_decoded = json.loads(self.request.body)
-            else:
-                payload = self.request.body_arguments.get('payload')
-                json_decoded = json.loads(payload)
+            yield self._forward_to_hook(hook_url)
+        finally:
+            self.application.in_flight -= 1
+
+    @coroutine
+    def _forward_to_hook(self, hook_url):
+        try:
+            body = self.json_body()
         except ValueError:
             self.clear()
             self.set_status(400, "Invalid JSON in HTTP request")
             self.finish()
             return
 
-        http_client = AsyncHTTPClient()
-        req = HTTPRequest(
-            url=hook_url,
-            method="POST",
-            headers={'Content-Type': 'application/json'},
-            body=json.dumps(json_decoded)
-        )
+        aggregator = self.application.aggregator
+        dedup = self.application.dedup
+        if aggregator is not None or dedup is not None:
+            try:
+                message = loads(body)
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                self.clear()
+                self.set_status(400, "Invalid JSON in HTTP request")
+                self.finish()
+                return
+            # a malformed message must not break the merged post of the other callers
+            try:
+                message_model = IncomingMessage.factory(message)
+            except (TypeError, AttributeError, ValueError):
+                self.clear()
+                self.set_status(400, "Invalid message in HTTP request")
+                self.finish()
+                return
+            if dedup is not None and dedup.seen(message_model, hook_url):
+                self.finish("ok")
+                return
+            if aggregator is not None:
+                message = message_model.to_dict()
+
         try:
-            resp = yield http_client.fetch(req)
+            if aggregator is not None:
+                resp = yield aggregator.add(hook_url, message, len(body))
+            else:
+                resp = yield deliver(self.application, hook_url, body)
         except HTTPError as e:
             # HTTPError is raised for non-200 responses; the response can be found in e.response
+            logging.warning("Forward to %s failed: %s", upstream(hook_url), e)
             self.clear()
             if e.message:
                 self.set_status(e.code, "Upstream error: {}".format(e.message))
@@ -87,16 +273,147 @@ class MyHandler(RequestHandler):
                 self.finish()
         except Exception as e:
             # Other errors are possible, such as IOError.
+            logging.warning("Forward to %s failed: %s", upstream(hook_url), e)
             self.clear()
             self.set_status(500, str(e))
             self.finish()
         else:
+            if resp is None:
+                # spooled, will be delivered by drain_spool
+                self.set_status(202)
+                self.finish()
+                return
             self.set_status(resp.code, resp.reason)
             for (name, value) in sorted(resp.headers.get_all()):
                 self.add_header(name, value)
             self.finish(resp.body)
 
 
+@coroutine
+def deliver(app, hook_url, body):
+    """
+    Forward a message to the upstream hook and return the response, or spool it and return None.
+    """
+    if app.spool is not None:
+        app.spool.append(hook_url.encode('utf-8') + b'\n' + body)
+        app.spool_ready.set()
+        raise tornado.gen.Return(None)
+    req = HTTPRequest(
+        url=hook_url,
+        method="POST",
+        headers={'Content-Type': 'application/json'},
+        body=body
+    )
+    resp = yield app.upstreams.fetch(req)
+    raise tornado.gen.Return(resp)
+
+
+class Aggregator(object):
+    """
+    Merge the messages sent to the same hook, channel and user within `window` seconds into a single upstream post.
+
+    A merged post holds at most `max_messages` messages and about `max_bytes` bytes of JSON. Texts are joined and
+    attachments are concatenated. Every caller gets the upstream answer to the merged post, or the error that
+    prevented it. The messages are dicts normalized by the message model (`IncomingMessage.to_dict`).
+    """
+    def __init__(self, app, window=0.2, max_messages=20, max_bytes=16000):
+        self.app = app
+        self.window = window
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.batches = {}
+
+    def add(self, hook_url, message, size):
+        key = (hook_url, message.get('channel'), message.get('username'), message.get('icon_url'))
+        batch = self.batches.get(key)
+        if batch is not None and batch['size'] + size > self.max_bytes:
+            self.flush(key)
+            batch = None
+        if batch is None:
+            batch = self.batches[key] = {'messages': [], 'futures': [], 'size': 0}
+            batch['timeout'] = IOLoop.current().call_later(self.window, self.flush, key)
+        future = Future()
+        batch['messages'].append(message)
+        batch['futures'].append(future)
+        batch['size'] += size
+        if len(batch['messages']) >= self.max_messages:
+            self.flush(key)
+        return future
+
+    def flush(self, key):
+        batch = self.batches.pop(key, None)
+        if batch is None:
+            return
+        IOLoop.current().remove_timeout(batch['timeout'])
+        try:
+            message = merge_messages(batch['messages'])
+        except Exception as e:
+            logging.warning("Messages for %s could not be merged: %s", upstream(key[0]), e)
+            self.fail(batch['futures'], e)
+            return
+        IOLoop.current().spawn_callback(self.post, key[0], message, batch['futures'])
+
+    def flush_all(self):
+        for key in list(self.batches):
+            self.flush(key)
+
+    @coroutine
+    def post(self, hook_url, message, futures):
+        try:
+            resp = yield deliver(self.app, hook_url, dumpb(message))
+        except Exception as e:
+            self.fail(futures, e)
+        else:
+            for future in futures:
+                if not future.done():
+                    future.set_result(resp)
+
+    @staticmethod
+    def fail(futures, error):
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+
+def merge_messages(messages):
+    if len(messages) == 1:
+        return messages[0]
+    merged = dict((k, v) for k, v in messages[0].items() if k in ('channel', 'username', 'icon_url'))
+    texts = [m['text'] for m in messages if m.get('text')]
+    if texts:
+        merged['text'] = '\n'.join(texts)
+    attachments = [a for m in messages for a in (m.get('attachments') or [])]
+    if attachments:
+        merged['attachments'] = attachments
+    return merged
+
+
+class StatusHandler(RequestHandler):
+    def get(self):
+        self.write({'upstreams': self.application.upstreams.pool_stats()})
+
+
+class MetricsHandler(RequestHandler):
+    def get(self):
+        app = self.application
+        self.set_header('Content-Type', CONTENT_TYPE)
+        if app.metrics_dir is None:
+            self.write(app.metrics.render())
+            return
+        texts = [app.metrics.render()]
+        for name in sorted(os.listdir(app.metrics_dir)):
+            path = join(app.metrics_dir, name)
+            if path == app.metrics_file or not name.startswith('worker-'):
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    texts.append(f.read().decode('utf-8'))
+            except (IOError, OSError):
+                # the worker is being restarted
+                pass
+        self.write(merge_renderings(texts))
+
+
 class DefaultPathHandler(MyHandler):
     def get(self):
         self.write("DefaultPathHandler: use POST method")
@@ -115,32 +432,308 @@ class HooksHandler(MyHandler):
         yield self.forward_to_hook(self.application.mm_hooks + '/' + secret_url)
 
 
+def looks_like_json_object(body):
+    body = body.strip()
+    return body[:1] == b'{' and body[-1:] == b'}'
+
+
 def make_application(config):
     default_path = config.get('proxy', 'default_path')
     hooks_path = config.get('proxy', 'hooks_path')
+    status_path = config.get('proxy', 'status_path')
+    metrics_path = config.get('proxy', 'metrics_path')
     app = Application(handlers=[
         (r"{}$".format(default_path), DefaultPathHandler),
-        (r"{}/(.*)".format(hooks_path), HooksHandler)
+        (r"{}/(.*)".format(hooks_path), HooksHandler),
+        (r"{}$".format(status_path), StatusHandler),
+        (r"{}$".format(metrics_path), MetricsHandler)
     ])
     app.raw_config = config
+    app.validation = config.get('proxy', 'validation').lower()
+    if app.validation not in VALIDATION_MODES:
+        raise ValueError("validation must be one of: {}".format(', '.join(VALIDATION_MODES)))
     app.mm_default_hook = "{}/{}".format(config.get('mattermost', 'url'), config.get('mattermost', 'default_hook'))
     app.mm_hooks = config.get('mattermost', 'url')
+    # the metrics are kept per worker process; with several workers, share_metrics makes /metrics report the sum of
+    # the metrics of all the workers
+    app.metrics = Registry()
+    app.metrics_dir = None
+    app.metrics_file = None
+    app.upstreams = Upstreams(
+        config.getint('proxy', 'max_clients'),
+        config.getfloat('proxy', 'connect_timeout'),
+        config.getfloat('proxy', 'request_timeout'),
+        observer=MetricsObserver(app.metrics)
+    )
+    app.metrics.add_collector(app.upstreams.metrics)
+    app.requests_total = app.metrics.counter(
+        'pymatter_proxy_requests_total', 'Requests answered by the proxy', ('code',)
+    )
+    app.request_seconds = app.metrics.histogram('pymatter_proxy_request_seconds', 'Time spent answering requests')
+    app.metrics.gauge('pymatter_proxy_in_flight', 'Messages being forwarded', function=lambda: app.in_flight)
+    app.metrics.counter(
+        'pymatter_dedup_suppressed_total', 'Duplicated messages that were not forwarded',
+        function=lambda: 0 if app.dedup is None else app.dedup.suppressed
+    )
+    app.in_flight = 0
+    app.shutdown_timeout = config.getfloat('proxy', 'shutdown_timeout')
+    app.spool = None
+    app.dedup = None
+    app.aggregator = None
+    window = get_option(config, 'aggregate', 'window_ms', 0, config.getfloat) / 1000
+    if window > 0:
+        app.aggregator = Aggregator(
+            app,
+            window=window,
+            max_messages=get_option(config, 'aggregate', 'max_messages', 20, config.getint),
+            max_bytes=get_option(config, 'aggregate', 'max_bytes', 16000, config.getint)
+        )
     return app
 
 
-def sig_handler(sig, frame):
-    IOLoop.instance().add_callback(shutdown)
+def start_dedup(app):
+    """
+    When the [dedup] section defines a positive ttl, answer duplicated messages without forwarding them, and post a
+    summary of the suppressed duplicates when their window closes.
+    """
+    config = app.raw_config
+    ttl = get_option(config, 'dedup', 'ttl', 0, config.getfloat)
+    if ttl <= 0:
+        return
+    app.dedup = DedupCache(
+        ttl,
+        max_size=get_option(config, 'dedup', 'max_size', 10000, config.getint),
+        summary=get_option(config, 'dedup', 'summary', True, config.getboolean)
+    )
+    PeriodicCallback(lambda: send_summaries(app), 1000).start()
+
+
+def send_summaries(app, everything=False):
+    for hook_url, summary in app.dedup.expire(everything):
+        IOLoop.current().spawn_callback(deliver_summary, app, hook_url, summary)
+
+
+@coroutine
+def deliver_summary(app, hook_url, summary):
+    app.in_flight += 1
+    try:
+        yield deliver(app, hook_url, summary.dumpb())
+    except Exception as e:
+        logging.warning("Failed to post the summary of duplicated messages: %s", e)
+    finally:
+        app.in_flight -= 1
+
+
+def get_option(config, section, name, default, getter):
+    """
+    Read an option of an optional section.
+    """
+    if config.has_section(section) and config.has_option(section, name):
+        return getter(section, name)
+    return default
+
+
+def open_spool(app, worker, workers=1):
+    """
+    When the [spool] section defines a directory, acknowledge incoming messages as soon as they are written to a
+    spool, and deliver them in the background. Each worker process has its own spool; the spools left by workers that
+    no longer exist (when the number of workers was reduced) are adopted by the remaining ones.
+    """
+    config = app.raw_config
+    directory = get_option(config, 'spool', 'directory', '', config.get)
+    if not directory:
+        return
+    directory = expanduser(directory)
+    app.spool = Spool(
+        join(directory, 'worker-{}'.format(worker)),
+        segment_size=get_option(config, 'spool', 'segment_size', 16 * 1024 * 1024, config.getint),
+        sync_every=get_option(config, 'spool', 'sync_every', 100, config.getint),
+        sync_interval=get_option(config, 'spool', 'sync_interval', 0.5, config.getfloat)
+    )
+    adopt_spools(app.spool, directory, worker, workers)
+    app.spool_ready = Event()
+    IOLoop.current().spawn_callback(drain_spool, app)
+
+
+def adopt_spools(spool, directory, worker, workers):
+    """
+    Move the records of the leftover spools `worker-N` of `directory`, where N is not a current worker, to `spool`.
+    Worker `worker` adopts the spools for which N % `workers` == `worker`.
+
+    A crash while records are moved may deliver them twice, but doesn't lose them.
+    """
+    for name in sorted(os.listdir(directory)):
+        if not name.startswith('worker-'):
+            continue
+        try:
+            number = int(name[len('worker-'):])
+        except ValueError:
+            continue
+        if number < workers or number % workers != worker:
+            continue
+        leftover = Spool(join(directory, name))
+        moved = 0
+        while True:
+            records = leftover.pending(1000)
+            if not records:
+                break
+            for _, data in records:
+                spool.append(data)
+            spool.sync()
+            leftover.commit(records[-1][0])
+            moved += len(records)
+        leftover.close()
+        shutil.rmtree(join(directory, name))
+        logging.info("Adopted %d spooled messages from %s", moved, name)
+
+
+@coroutine
+def drain_spool(app):
+    """
+    Deliver the spooled messages in order. Messages are retried until the upstream server accepts them, except the
+    ones it rejects as invalid (4xx), which are dropped.
+    """
+    spool = app.spool
+    attempt = 0
+    while app.spool is not None:
+        app.spool_ready.clear()
+        records = spool.pending()
+        if not records:
+            spool.sync()
+            try:
+                yield app.spool_ready.wait(timeout=spool.sync_interval)
+            except TimeoutError:
+                pass
+            continue
+        for position, record in records:
+            url, body = record.split(b'\n', 1)
+            req = HTTPRequest(
+                url=url.decode('utf-8'),
+                method="POST",
+                headers={'Content-Type': 'application/json'},
+                body=body
+            )
+            try:
+                yield app.upstreams.fetch(req)
+            except HTTPError as e:
+                if e.code == 599 or e.code in RETRY_CODES:
+                    logging.warning("Delivery of spooled message failed, will retry: %s", e)
+                    yield sleep(backoff_delay(attempt))
+                    attempt = min(attempt + 1, 6)
+                    break
+                logging.error("Spooled message rejected by upstream, dropped: %s", e)
+            except Exception as e:
+                logging.warning("Delivery of spooled message failed, will retry: %s", e)
+                yield sleep(backoff_delay(attempt))
+                attempt = min(attempt + 1, 6)
+                break
+            attempt = 0
+            spool.commit(position)
+
+
+def share_metrics(app, directory, worker, interval=1.0):
+    """
+    Publish the metrics of the worker in `directory` every `interval` seconds, and make /metrics merge the metrics
+    published by the other workers with the current ones of the worker answering the request.
+
+    The values of the same series are added, gauges included (in flight requests, pool sizes...): the result
+    describes the whole proxy, whichever worker answers. The metrics of the other workers are at most `interval`
+    seconds old, and the counters of a worker restart from zero when the worker is restarted.
+    """
+    app.metrics_dir = directory
+    app.metrics_file = join(directory, 'worker-{}'.format(worker))
+    publish_metrics(app)
+    PeriodicCallback(lambda: publish_metrics(app), interval * 1000).start()
+
+
+def publish_metrics(app):
+    tmp = app.metrics_file + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(app.metrics.render().encode('utf-8'))
+        os.rename(tmp, app.metrics_file)
+    except (IOError, OSError) as ex:
+        logging.warning("Metrics could not be published in '%s': %s", app.metrics_dir, ex)
+
+
+def fork_workers(num_workers):
+    """
+    Fork `num_workers` processes. Return the worker number in the children.
+
+    The parent process only supervises the workers: it forwards SIGTERM and SIGINT to them, restarts the ones that
+    die unexpectedly, and exits when all of them have stopped.
+    """
+    def spawn(worker):
+        pid = os.fork()
+        if pid == 0:
+            children.clear()
+            return True
+        children[pid] = worker
+        return False
+
+    for worker in range(num_workers):
+        if spawn(worker):
+            return worker
+    signal.signal(signal.SIGTERM, parent_sig_handler)
+    signal.signal(signal.SIGINT, parent_sig_handler)
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as ex:
+            if ex.errno == errno.EINTR:
+                continue
+            raise
+        worker = children.pop(pid, None)
+        if worker is None:
+            continue
+        if os.WIFSIGNALED(status) or os.WEXITSTATUS(status) != 0:
+            logging.warning("Worker %d exited with status %d", pid, status)
+            if not stopping and spawn(worker):
+                return worker
+    sys.exit(0)
+
+
+def parent_sig_handler(sig, frame):
+    global stopping
+    stopping = True
+    for pid in list(children):
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
 
 
 def shutdown():
+    """
+    Stop accepting connections, then stop the IOLoop once the in-flight forwards are done (or after the shutdown
+    timeout).
+    """
     global server
-    if server is not None:
-        server.stop()
-        IOLoop.instance().stop()
+    if server is None:
+        return
+    server.stop()
+    server = None
+    if application.aggregator is not None:
+        application.aggregator.flush_all()
+    if application.dedup is not None:
+        send_summaries(application, everything=True)
+    deadline = time.time() + application.shutdown_timeout
+
+    def stop_when_drained():
+        if application.in_flight > 0 and time.time() < deadline:
+            IOLoop.instance().call_later(0.1, stop_when_drained)
+        else:
+            application.upstreams.close()
+            if application.spool is not None:
+                application.spool.close()
+                application.spool = None
+            IOLoop.instance().stop()
+
+    stop_when_drained()
 
 
 def main():
-    global server
+    global server, application
 
     parser = argparse.ArgumentParser(
         description="Start a HTTP proxy to forward incoming messages to Mattermost"
@@ -154,7 +747,7 @@ def main():
         if not exists(conf_fname):
             conf_fname = abspath(join(dirname(dirname(__file__)), 'conf', 'proxy.conf'))
     if not exists(conf_fname):
-        sys.stderr.write(b"No configuration provided\n")
+        sys.stderr.write("No configuration provided\n")
         sys.exit(-1)
 
     logging.info("Using config file '%s'", conf_fname)
@@ -162,13 +755,28 @@ def main():
     config = SafeConfigParser(defaults)
     config.read([conf_fname])
 
-    app = make_application(config)
+    app = application = make_application(config)
     sockets = bind_sockets(config.getint('proxy', 'port'))
+    workers = config.getint('proxy', 'workers')
+    if workers == 0:
+        workers = cpu_count()
+    worker = 0
+    if workers > 1:
+        # the workers share the listening sockets; the IOLoop must only be created after the fork
+        metrics_dir = tempfile.mkdtemp(prefix='pymatter-metrics-')
+        try:
+            worker = fork_workers(workers)
+        except SystemExit:
+            # the parent exits once all the workers have stopped
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+            raise
+        share_metrics(app, metrics_dir, worker)
+    open_spool(app, worker, workers)
+    start_dedup(app)
     server = HTTPServer(app)
     server.add_sockets(sockets)
 
-    signal.signal(signal.SIGTERM, sig_handler)
-    signal.signal(signal.SIGINT, sig_handler)
+    handle_signals(shutdown)
     IOLoop.current().start()
 
 if __name__ == "__main__":
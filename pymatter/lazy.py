@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+"""
+Deferred imports, so that the command line tools only pay for the modules they actually use.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import importlib
+import sys
+import threading
+import types
+
+_lock = threading.RLock()
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is imported when one of its attributes is first used.
+
+    Unlike `importlib.util.LazyLoader` (before Python 3.12), the first use may happen in several threads at once: the
+    import runs under a lock, and the attributes of the module are then copied to the stand-in.
+    """
+    def __getattr__(self, attr):
+        with _lock:
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """
+    Return the module `name`, or a `LazyModule` standing for it if it is not imported yet.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    # the native string type on both Python 2 and 3
+    return LazyModule(str(name))
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+"""
+Instrumentation of the send path: counters, gauges and histograms exposed in the Prometheus text format, and the
+observer interface through which the posters report what they do.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import bisect
+import threading
+from collections import OrderedDict
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+CONTENT_TYPE = u'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return u'+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return u'{}'.format(int(value))
+    return u'{}'.format(value)
+
+
+def format_labels(names, values, extra=u''):
+    pairs = [u'{}="{}"'.format(name, u'{}'.format(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(
+        u'\n', u'\\n')) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return u'{' + u','.join(pairs) + u'}' if pairs else u''
+
+
+class Metric(object):
+    """
+    Metric whose values are set by the code, or read from `function` (without labels) when the metrics are rendered.
+    """
+    kind = u'untyped'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels.get(name, u'') for name in self.labels)
+
+    def header(self):
+        return [u'# HELP {} {}'.format(self.name, self.documentation), u'# TYPE {} {}'.format(self.name, self.kind)]
+
+    def render(self):
+        if self.function is not None:
+            return self.header() + [u'{} {}'.format(self.name, format_value(self.function()))]
+        lines = self.header()
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.append(u'{}{} {}'.format(self.name, format_labels(self.labels, key), format_value(value)))
+        return lines
+
+    def __repr__(self):
+        return u"{}('{}')".format(self.__class__.__name__, self.name)
+
+
+class Counter(Metric):
+    kind = u'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = u'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+
+class Histogram(Metric):
+    kind = u'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # per bucket counts (not cumulative), sum
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in items:
+            cumulated = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulated += count
+                lines.append(u'{}_bucket{} {}'.format(
+                    self.name, format_labels(self.labels, key, u'le="{}"'.format(format_value(float(bound)))), cumulated
+                ))
+            lines.append(u'{}_sum{} {}'.format(self.name, format_labels(self.labels, key), format_value(total)))
+            lines.append(u'{}_count{} {}'.format(self.name, format_labels(self.labels, key), cumulated))
+        return lines
+
+
+class Registry(object):
+    """
+    Set of metrics rendered together.
+
+    Collectors are functions returning lines of the text format, called at each rendering; they expose statistics
+    kept elsewhere without copying them into metrics.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.by_name = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.by_name.get(name)
+            if metric is None:
+                metric = self.by_name[name] = cls(name, *args, **kwargs)
+                self.metrics.append(metric)
+            elif not isinstance(metric, cls):
+                raise ValueError(u"metric '{}' is already registered as a {}".format(name, metric.kind))
+            return metric
+
+    def counter(self, name, documentation, labels=(), function=None):
+        return self._get(Counter, name, documentation, labels, function)
+
+    def gauge(self, name, documentation, labels=(), function=None):
+        return self._get(Gauge, name, documentation, labels, function)
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, documentation, labels, buckets=buckets)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics):
+            lines.extend(metric.render())
+        for collector in list(self.collectors):
+            lines.extend(collector())
+        return u'\n'.join(lines) + u'\n'
+
+    def __repr__(self):
+        return u"Registry({})".format(len(self.metrics))
+
+
+REGISTRY = Registry()
+
+
+def merge_renderings(texts):
+    """
+    Merge the renderings of the same metrics by several processes: the values of identical series are added (counters,
+    gauges, and histogram buckets, sums and counts alike), the HELP and TYPE lines are kept once.
+    """
+    families = OrderedDict()
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith(u'#'):
+                parts = line.split(None, 3)
+                if len(parts) < 3:
+                    continue
+                family = families.setdefault(parts[2], ([], OrderedDict()))
+                if line not in family[0]:
+                    family[0].append(line)
+                continue
+            series, _, value = line.rpartition(u' ')
+            if family is None:
+                family = families.setdefault(series.split(u'{')[0], ([], OrderedDict()))
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            family[1][series] = family[1].get(series, 0.0) + value
+    lines = []
+    for comments, values in families.values():
+        lines.extend(comments)
+        lines.extend(u'{} {}'.format(series, format_value(value)) for series, value in values.items())
+    return u'\n'.join(lines) + u'\n'
+
+
+class Observer(object):
+    """
+    Callbacks invoked by the posters on their send path. Every method does nothing: override the ones you need.
+
+    `url` is the webhook URL. The methods are called from the sending threads (or the IOLoop) and must be fast.
+    """
+    def serialized(self, url, seconds):
+        """A message was serialized to JSON in `seconds`."""
+
+    def queued(self, url, depth):
+        """A message was queued; `depth` messages are now waiting."""
+
+    def dequeued(self, url, waited, depth):
+        """A message waited `waited` seconds in the queue before a sender took it."""
+
+    def dropped(self, url):
+        """A message was discarded because the queue was full."""
+
+    def request_started(self, url):
+        """An HTTP request is in flight."""
+
+    def request_finished(self, url, status, seconds):
+        """An HTTP request got an answer with `status` (-1 when no answer) after `seconds`."""
+
+    def retried(self, url, status):
+        """A request will be retried after a failure with `status` (-1 when there was no answer)."""
+
+    def sent(self, url):
+        """A message was accepted by the server."""
+
+    def failed(self, url, status):
+        """A message could not be delivered."""
+
+
+def upstream(url):
+    """
+    Label identifying the destination of `url`: the secret part of the webhook URLs is not exposed.
+    """
+    return urlsplit(url).netloc
+
+
+class MetricsObserver(Observer):
+    """
+    Observer maintaining Prometheus metrics in `registry`, labeled by upstream host.
+    """
+    def __init__(self, registry=REGISTRY):
+        self.registry = registry
+        labels = ('upstream',)
+        self.sent_total = registry.counter(u'pymatter_messages_sent_total', u'Messages accepted by the server', labels)
+        self.failed_total = registry.counter(
+            u'pymatter_messages_failed_total', u'Messages that could not be delivered', labels
+        )
+        self.retries_total = registry.counter(u'pymatter_retries_total', u'Requests retried after a failure', labels)
+        self.dropped_total = registry.counter(
+            u'pymatter_messages_dropped_total', u'Messages discarded because the queue was full', labels
+        )
+        self.responses_total = registry.counter(
+            u'pymatter_responses_total', u'HTTP answers by status code', labels + ('code',)
+        )
+        self.serialization = registry.histogram(
+            u'pymatter_serialization_seconds', u'Time spent serializing messages to JSON', labels
+        )
+        self.queue_wait = registry.histogram(
+            u'pymatter_queue_wait_seconds', u'Time spent by messages in the queue', labels
+        )
+        self.latency = registry.histogram(u'pymatter_upstream_latency_seconds', u'HTTP request duration', labels)
+        self.queue_depth = registry.gauge(u'pymatter_queue_depth', u'Messages waiting to be sent', labels)
+        self.in_flight = registry.gauge(u'pymatter_in_flight_requests', u'HTTP requests in flight', labels)
+
+    def serialized(self, url, seconds):
+        self.serialization.observe(seconds, upstream=upstream(url))
+
+    def queued(self, url, depth):
+        self.queue_depth.set(depth, upstream=upstream(url))
+
+    def dequeued(self, url, waited, depth):
+        label = upstream(url)
+        self.queue_wait.observe(waited, upstream=label)
+        self.queue_depth.set(depth, upstream=label)
+
+    def dropped(self, url):
+        self.dropped_total.inc(upstream=upstream(url))
+
+    def request_started(self, url):
+        self.in_flight.inc(upstream=upstream(url))
+
+    def request_finished(self, url, status, seconds):
+        label = upstream(url)
+        self.in_flight.dec(upstream=label)
+        self.latency.observe(seconds, upstream=label)
+        self.responses_total.inc(upstream=label, code=status)
+
+    def retried(self, url, status):
+        self.retries_total.inc(upstream=upstream(url))
+
+    def sent(self, url):
+        self.sent_total.inc(upstream=upstream(url))
+
+    def failed(self, url, status):
+        self.failed_total.inc(upstream=upstream(url))
+
+    def __repr__(self):
+        return u"MetricsObserver({!r})".format(self.registry)
@@ -2,6 +2,25 @@
 
 """
 Poll Mailgun for messages and forwards them to a Mattermost Incoming Webhook.
+
+The 'stored' events of the Mailgun events API are paged through in ascending order; the bodies of the stored messages
+are fetched concurrently, and the position in the events (the URL of the next page) is saved in a cursor file, so that
+each poll only reads the new events.
+
+Configuration (file given with -c, MM_MAILGUN_CONF or ~/.pymatter/mailgun.conf)::
+
+    [mailgun]
+    api_key = key-xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx
+    domain = mg.example.org
+    ; optional
+    api_url = https://api.mailgun.net/v3
+    workers = 8
+    interval = 30
+    cursor = ~/.pymatter/mailgun.cursor
+    fetch_retries = 3
+
+    [mattermost]
+    url = https://mattermost.example.org/hooks/xxxxxxxxxxxxxxxxxxxxxxxxxx
 """
 
 from __future__ import unicode_literals
@@ -9,15 +28,352 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import argparse
+import json
+import logging
 import os
+import signal
 import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from os.path import expanduser, abspath, exists
+try:
+    from ConfigParser import SafeConfigParser
+except ImportError:
+    from configparser import ConfigParser as SafeConfigParser
+
+import requests
+
+from .base import IncomingMessage, AsyncPoster, Attachment, Field, decode_text
+from .ratelimit import backoff_delay
+from .spool import Spool
+
+defaults = {
+    'api_url': 'https://api.mailgun.net/v3',
+    'event': 'stored',
+    'page_size': '300',
+    'workers': '8',
+    'interval': '30',
+    'lookback': '3600',
+    'timeout': '30',
+    'cursor': '~/.pymatter/mailgun.cursor',
+    'seen': '10000',
+    'channel': '',
+    'username': 'pymattermailgun',
+    'icon_url': '',
+    'senders': '2',
+    'spool': '',
+    'max_text': '4000',
+    'fetch_retries': '3'
+}
+
+# the stored message could not be fetched, its event must be read again
+FETCH_FAILED = object()
+
+
+class MailgunClient(object):
+    """
+    Client of the Mailgun events and stored messages APIs. The connection pool holds `workers` connections, so that
+    `workers` threads can fetch stored messages at the same time.
+    """
+    def __init__(self, api_url, domain, api_key, workers=8, timeout=30):
+        self.api_url = api_url.rstrip('/')
+        self.domain = domain
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = ('api', api_key)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=max(1, workers), pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def first_page(self, begin, event=u'stored', limit=300):
+        """
+        URL of the first page of the events since the `begin` timestamp.
+        """
+        req = requests.Request('GET', u'{}/{}/events'.format(self.api_url, self.domain), params={
+            'begin': begin, 'ascending': 'yes', 'limit': limit, 'event': event
+        })
+        return req.prepare().url
+
+    def page(self, url):
+        """
+        Return the events of the page at `url` and the URL of the next page.
+        """
+        resp = self.session.get(url, timeout=self.timeout)
+        resp.raise_for_status()
+        data = resp.json()
+        return data.get('items') or [], (data.get('paging') or {}).get('next') or url
+
+    def stored(self, url):
+        resp = self.session.get(url, timeout=self.timeout, headers={'Accept': 'application/json'})
+        resp.raise_for_status()
+        return resp.json()
+
+    def close(self):
+        self.session.close()
+
+    def __repr__(self):
+        return u"MailgunClient('{}')".format(self.domain)
+
+
+class Cursor(object):
+    """
+    Position in the Mailgun events, persisted as JSON in `filename`: the URL of the next page to read, and the ids of
+    the last events read (pages may overlap, the events already read are skipped).
+    """
+    def __init__(self, filename, max_seen=10000):
+        self.filename = filename
+        self.next = None
+        self.seen = deque(maxlen=max(1, max_seen))
+        self.seen_set = set()
+        if filename and exists(filename):
+            try:
+                with open(filename) as f:
+                    data = json.load(f)
+                self.next = data.get('next')
+                self.add(data.get('seen') or [])
+            except (IOError, OSError, ValueError, TypeError, AttributeError):
+                self.next = None
+
+    def add(self, ids):
+        for event_id in ids:
+            if len(self.seen) == self.seen.maxlen:
+                self.seen_set.discard(self.seen[0])
+            self.seen.append(event_id)
+            self.seen_set.add(event_id)
+
+    def __contains__(self, event_id):
+        return event_id in self.seen_set
+
+    def advance(self, next_url, ids):
+        self.add(ids)
+        self.next = next_url
+        self.save()
+
+    def save(self):
+        if not self.filename:
+            return
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'next': self.next, 'seen': list(self.seen)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.filename)
+
+    def __repr__(self):
+        return u"Cursor('{}')".format(self.filename)
+
+
+def stored_to_message(stored, msg_args, max_text=4000):
+    """
+    Build the IncomingMessage posted for a stored message, as returned by the Mailgun API.
+    """
+    subject = decode_text(stored.get('Subject') or stored.get('subject') or u'(no subject)')
+    body = decode_text(stored.get('stripped-text') or stored.get('body-plain') or u'')
+    truncated = len(body) > max_text
+    if truncated:
+        body = body[:max_text] + u'…'
+    att = Attachment(fallback=subject, title=subject, text=body)
+    for name in ('From', 'To', 'Date'):
+        value = stored.get(name) or stored.get(name.lower())
+        if value:
+            att.fields.append(Field(name, decode_text(value), True))
+    files = [decode_text(a.get('name') or u'') for a in stored.get('attachments') or []]
+    if files:
+        att.fields.append(Field('Attachments', u', '.join(files), False))
+    if truncated:
+        att.fields.append(Field('Truncated', u'yes', True))
+    sender = decode_text(stored.get('From') or stored.get('sender') or u'unknown sender')
+    return IncomingMessage(text=u"**Mail from {}**".format(sender), attachments=[att], **msg_args)
+
+
+class Poller(object):
+    """
+    Read the new events, fetch the stored messages with `workers` threads and post them with `poster`.
+
+    The pages are pipelined: the next page is read while the messages of the previous ones are being posted. The
+    cursor only moves past a page once all its messages were delivered (or failed for good): a poller stopped in the
+    middle of a page reads it again. With a spool, the messages are safe once spooled and the cursor moves at once.
+
+    A stored message that can't be fetched is tried again up to `retries` times with a jittered backoff. If it still
+    fails, the poll stops at its page: the cursor stays on the page, the events already forwarded are marked as seen,
+    and the next poll tries the failed ones again. Only the expired messages (404) are skipped.
+    """
+    def __init__(self, client, cursor, poster, msg_args, workers=8, event=u'stored', page_size=300, lookback=3600,
+                 max_text=4000, retries=3):
+        self.client = client
+        self.cursor = cursor
+        self.poster = poster
+        self.msg_args = msg_args
+        self.executor = ThreadPoolExecutor(max(1, workers))
+        self.event = event
+        self.page_size = page_size
+        self.lookback = lookback
+        self.max_text = max_text
+        self.retries = retries
+        self.forwarded = 0
+        self.failed = 0
+
+    def fetch(self, event):
+        """
+        Return the stored message of `event`, None if it expired, or FETCH_FAILED.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self.client.stored(event['storage']['url'])
+            except requests.HTTPError as ex:
+                if ex.response is not None and ex.response.status_code in (404, 410):
+                    # the stored messages expire after a few days
+                    logging.warning("Stored message of event %s has expired", event.get('id'))
+                    return None
+                error = ex
+            except (requests.RequestException, ValueError) as ex:
+                error = ex
+            if attempt >= self.retries:
+                logging.warning("Stored message of event %s could not be fetched: %s", event.get('id'), error)
+                return FETCH_FAILED
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+
+    def poll(self, stop=None):
+        """
+        Forward the messages of the events since the last poll. Return the number of forwarded messages.
+        """
+        url = self.cursor.next or self.client.first_page(time.time() - self.lookback, self.event, self.page_size)
+        forwarded = self.forwarded
+        pending = deque()
+        # ids of the events read by this poll: the cursor only learns them once their page is delivered, and the
+        # next page may start with the same events
+        read = set()
+        while stop is None or not stop.is_set():
+            items, next_url = self.client.page(url)
+            if not items:
+                break
+            events = [
+                e for e in items
+                if e.get('id') not in self.cursor and e.get('id') not in read and (e.get('storage') or {}).get('url')
+            ]
+            read.update(e.get('id') for e in items)
+            deliveries = []
+            failed = set()
+            for event, stored in zip(events, self.executor.map(self.fetch, events)):
+                if stored is FETCH_FAILED:
+                    failed.add(event.get('id'))
+                elif stored is not None:
+                    deliveries.append(self.poster.post(stored_to_message(stored, self.msg_args, self.max_text)))
+            if self.poster.spool is not None:
+                # spooled messages are durable: no need to wait for their delivery
+                self.forwarded += len(deliveries)
+                deliveries = []
+            if failed:
+                # stay on this page: the next poll reads it again and only fetches the failed events
+                pending.append((deliveries, url, [e.get('id') for e in items if e.get('id') not in failed]))
+                break
+            pending.append((deliveries, next_url, [e.get('id') for e in items]))
+            self.commit(pending, wait=False)
+            url = next_url
+        self.commit(pending, wait=True)
+        return self.forwarded - forwarded
+
+    def commit(self, pending, wait):
+        """
+        Move the cursor past the pages whose messages are all delivered.
+        """
+        while pending:
+            deliveries, next_url, ids = pending[0]
+            if not wait and not all(d is None or d.done() for d in deliveries):
+                return
+            for delivery in deliveries:
+                if delivery is None:
+                    continue
+                try:
+                    ok = delivery.result() == 200
+                except Exception:
+                    ok = False
+                if ok:
+                    self.forwarded += 1
+                else:
+                    self.failed += 1
+                    logging.warning("A mail could not be forwarded to mattermost")
+            self.cursor.advance(next_url, ids)
+            pending.popleft()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __repr__(self):
+        return u"Poller({!r})".format(self.client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Poll Mailgun and forward the stored messages to mattermost")
+    parser.add_argument('-c', '--config', default='', help="Configuration file path")
+    parser.add_argument('--once', action='store_true', help="Poll once and exit")
+    args = parser.parse_args()
+
+    conf_fname = args.config if args.config else os.environ.get('MM_MAILGUN_CONF')
+    if conf_fname is None:
+        conf_fname = abspath(expanduser('~/.pymatter/mailgun.conf'))
+    if not exists(conf_fname):
+        sys.stderr.write("No configuration provided\n")
+        sys.exit(-1)
+
+    logging.info("Using config file '%s'", conf_fname)
+    config = SafeConfigParser(defaults)
+    config.read([conf_fname])
+
+    workers = config.getint('mailgun', 'workers')
+    client = MailgunClient(
+        config.get('mailgun', 'api_url'), config.get('mailgun', 'domain'), config.get('mailgun', 'api_key'),
+        workers, config.getfloat('mailgun', 'timeout')
+    )
+    cursor_fname = config.get('mailgun', 'cursor')
+    cursor = Cursor(abspath(expanduser(cursor_fname)) if cursor_fname else None, config.getint('mailgun', 'seen'))
+    msg_args = {
+        'username': config.get('mattermost', 'username'),
+        'icon_url': config.get('mattermost', 'icon_url') or None,
+        'channel': config.get('mattermost', 'channel') or None
+    }
+    spool_dir = config.get('mattermost', 'spool')
+    spool = Spool(abspath(expanduser(spool_dir))) if spool_dir else None
+    poster = AsyncPoster(
+        config.get('mattermost', 'url'), workers=config.getint('mattermost', 'senders'),
+        queue_size=config.getint('mailgun', 'page_size'), spool=spool
+    )
+    poller = Poller(
+        client, cursor, poster, msg_args, workers, config.get('mailgun', 'event'),
+        config.getint('mailgun', 'page_size'), config.getfloat('mailgun', 'lookback'),
+        config.getint('mattermost', 'max_text'), config.getint('mailgun', 'fetch_retries')
+    )
+    interval = config.getfloat('mailgun', 'interval')
+    stop = threading.Event()
+
+    def sig_handler(sig, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, sig_handler)
+    signal.signal(signal.SIGINT, sig_handler)
 
-CONF_FILE = os.environ.get('MM_MAILGUN_CONF')
-if CONF_FILE is None:
-    CONF_FILE = abspath(expanduser('.pymatter/mailgun.conf'))
-if not exists(CONF_FILE):
-    sys.stderr.write(b"No configuration provided\n")
-    sys.exit(-1)
+    with poster:
+        try:
+            while not stop.is_set():
+                try:
+                    poller.poll(stop)
+                except (requests.RequestException, ValueError) as ex:
+                    logging.warning("Polling mailgun failed: %s", ex)
+                if args.once:
+                    break
+                stop.wait(interval)
+        finally:
+            poller.close()
+            client.close()
+    if spool is not None:
+        spool.close()
+    sys.exit(0 if poller.failed == 0 else 1)
 
 
+if __name__ == "__main__":
+    main()
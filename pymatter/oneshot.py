@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+Post a single message with the standard library only.
+
+Meant for short lived processes (pymatterecho in cron jobs and shell hooks) that post once and exit: importing
+`requests` costs more than the request itself. Use `Poster` or `AsyncPoster` to post several messages.
+
+When a relay (pymatterrelay) is running, `hand_off` gives it the message instead: the relay keeps its connections to
+mattermost open, and the process exits without waiting for the answer.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import errno
+import os
+import socket
+import time
+from os.path import expanduser, exists
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+    from http.client import HTTPException
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError, URLError
+    from httplib import HTTPException
+
+from .serializer import dumpb
+from .ratelimit import parse_retry_after, backoff_delay, RETRY_CODES
+
+
+class PostError(IOError):
+    """
+    The message could not be posted. `status` is the HTTP status of the last answer, -1 when there was no answer.
+    """
+    def __init__(self, message, status=-1):
+        super(PostError, self).__init__(message)
+        self.status = status
+
+
+def post(url, incoming_message, max_retries=2, timeout=10):
+    """
+    POST `incoming_message` (a message object, or its JSON serialization as bytes) to `url` and return the HTTP
+    status. Connection errors and 429/502/503/504 answers are retried up to `max_retries` times, after the
+    Retry-After delay or a jittered backoff; raise `PostError` if the message could not be posted. Errors once the
+    request was sent (read timeouts...) are not retried: the server may have received the message already.
+
+    Proxies are taken from the environment (http_proxy, https_proxy, no_proxy), like with `requests`.
+    """
+    data = incoming_message if isinstance(incoming_message, bytes) else incoming_message.dumpb()
+    attempt = 0
+    while True:
+        req = Request(url, data=data, headers={'Content-Type': 'application/json'})
+        retry_after = None
+        try:
+            resp = urlopen(req, timeout=timeout)
+        except HTTPError as ex:
+            status = ex.code
+            retry_after = parse_retry_after(ex.headers.get('Retry-After'))
+            error = PostError(u"{} answered {}".format(url, status), status)
+            ex.close()
+            if status not in RETRY_CODES:
+                raise error
+        except URLError as ex:
+            # urlopen wraps the errors raised while connecting and sending the request
+            error = PostError(u"{}: {}".format(url, ex.reason))
+        except (IOError, OSError, HTTPException) as ex:
+            # the request was sent, waiting for the answer failed
+            raise PostError(u"{}: {}".format(url, ex))
+        else:
+            try:
+                resp.read()
+                return resp.getcode()
+            except (IOError, OSError, HTTPException) as ex:
+                raise PostError(u"{}: {}".format(url, ex), resp.getcode())
+            finally:
+                resp.close()
+        if attempt >= max_retries:
+            raise error
+        time.sleep(max(retry_after or 0, backoff_delay(attempt)))
+        attempt += 1
+
+
+def relay_socket():
+    """
+    Path of the Unix socket of the relay: MM_RELAY_SOCKET, or ~/.pymatter/relay.sock.
+    """
+    return os.environ.get('MM_RELAY_SOCKET') or expanduser('~/.pymatter/relay.sock')
+
+
+def hand_off(url, incoming_message, path=None, timeout=1.0):
+    """
+    Write `incoming_message` (a message object, or its JSON serialization as bytes) and the destination `url` to the
+    relay listening on the Unix socket `path`, as a single JSON line. Return False when no relay accepted the message:
+    the caller should post it itself.
+
+    The relay does not answer: a message handed off is lost if the relay can't deliver it.
+    """
+    path = path or relay_socket()
+    if not hasattr(socket, 'AF_UNIX') or not exists(path):
+        return False
+    data = incoming_message if isinstance(incoming_message, bytes) else incoming_message.dumpb()
+    line = b'{"url":' + dumpb(url) + b',"message":' + data + b'}\n'
+    deadline = time.time() + timeout
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        while True:
+            try:
+                sock.connect(path)
+                break
+            except (IOError, OSError) as ex:
+                # the backlog of the relay is full
+                if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK) or time.time() > deadline:
+                    raise
+                time.sleep(0.001)
+        sock.sendall(line)
+    except (IOError, OSError):
+        # the relay discards incomplete lines
+        return False
+    finally:
+        sock.close()
+    return True
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""
+Client side rate limiting for Mattermost incoming webhooks.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import random
+import threading
+import time
+
+
+def _default_rate():
+    try:
+        return float(os.environ.get('PYMATTER_RATE') or 0) or None
+    except ValueError:
+        return None
+
+
+# no client side limit until the server pushes back, unless the PYMATTER_RATE environment variable sets one
+DEFAULT_RATE = _default_rate()
+
+THROTTLE_CODES = (429, 503)
+RETRY_CODES = (429, 502, 503, 504)
+
+
+class RateLimiter(object):
+    """
+    Adaptive token bucket.
+
+    Tokens are refilled at `rate` per second, up to `burst`. When the server pushes back (`throttled`), the rate is
+    cut by `decrease` and sending is paused for the duration given by the server. Every successful send raises the rate
+    again by `increase`, up to slightly less than the rate at which the server last pushed back, so that the throughput
+    settles just under the server limit (additive increase, multiplicative decrease). Concurrent senders usually get
+    throttled together: the rate is cut at most once per `cooldown` seconds.
+
+    When `rate` is None (the default), sends are not limited until the server first pushes back; the limiter then
+    starts from the rate observed during the last second.
+    """
+    def __init__(self, rate=DEFAULT_RATE, burst=None, min_rate=0.1, increase=0.1, decrease=0.5, cooldown=1.0):
+        self.rate = None if rate is None else float(rate)
+        self.burst = float(burst) if burst else (None if rate is None else max(1.0, self.rate))
+        self.min_rate = float(min_rate)
+        self.increase = float(increase)
+        self.decrease = float(decrease)
+        self.cooldown = float(cooldown)
+        self.ceiling = None
+        self.last_decrease = 0.0
+        self.tokens = self.burst
+        self.last = time.time()
+        self.paused_until = 0.0
+        # sends of the current and of the previous second, while unlimited
+        self.second = int(self.last)
+        self.count = 0
+        self.previous_count = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self):
+        """
+        Take a token if one is available and return 0, else return the number of seconds to wait before retrying.
+        """
+        with self.lock:
+            now = time.time()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.rate is None:
+                second = int(now)
+                if second != self.second:
+                    self.previous_count = self.count if second == self.second + 1 else 0
+                    self.second = second
+                    self.count = 0
+                self.count += 1
+                return 0.0
+            self._refill(now)
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return 0.0
+            return (1.0 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.delay()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate is None:
+                return
+            rate = self.rate + self.increase
+            if self.ceiling is not None:
+                if rate >= self.ceiling * 0.95:
+                    # probe slowly above the last known limit, which may have been caused by a transient failure
+                    self.ceiling += self.increase / 10
+                rate = min(rate, self.ceiling * 0.95)
+            self.rate = max(self.rate, rate)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            now = time.time()
+            if self.rate is None:
+                # start limiting from the observed rate
+                self.rate = float(max(self.count, self.previous_count, self.min_rate))
+                self.burst = self.burst or max(1.0, self.rate * self.decrease)
+            if now - self.last_decrease >= max(self.cooldown, retry_after or 0):
+                self.last_decrease = now
+                self.ceiling = self.rate
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = 0.0
+            self.last = now
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+    def __repr__(self):
+        if self.rate is None:
+            return u"RateLimiter(None)"
+        return u"RateLimiter({:.2f})".format(self.rate)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(url):
+    """
+    Return the RateLimiter shared by every poster sending to `url`.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(url)
+        if limiter is None:
+            limiter = _limiters[url] = RateLimiter()
+        return limiter
+
+
+def parse_retry_after(value):
+    """
+    Convert the value of a Retry-After header (delay in seconds or HTTP date) into a number of seconds.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # HTTP dates are rare: don't import the email package at startup
+    from email.utils import parsedate_tz, mktime_tz
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """
+    Exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local relay: receive messages on a Unix socket and post them to mattermost over persistent connections.
+
+The command line tools hand their message to the relay when it is running (see `pymatter.oneshot.hand_off`), instead
+of opening a new connection to mattermost for each message. Each connection to the relay carries JSON lines
+``{"url": WEBHOOK_URL, "message": MESSAGE}``; the relay does not answer.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import logging
+import os
+import socket
+import sys
+import time
+from os.path import abspath, dirname, exists
+
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+
+from .aio import AioPoster, handle_signals
+from .base import IncomingMessage
+from .oneshot import relay_socket
+from .serializer import loads
+
+IOLoop = tornado.ioloop.IOLoop
+TCPServer = tornado.tcpserver.TCPServer
+StreamClosedError = tornado.iostream.StreamClosedError
+coroutine = tornado.gen.coroutine
+
+server = None
+
+
+class RelayServer(TCPServer):
+    """
+    Read the messages from the clients and post them, with one `AioPoster` (a pool of keep-alive connections) per
+    webhook URL. Posters unused for `idle_timeout` seconds are closed.
+    """
+    def __init__(self, concurrency=10, max_size=16 * 1024 * 1024, idle_timeout=300):
+        super(RelayServer, self).__init__(max_buffer_size=max_size)
+        self.concurrency = concurrency
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        # path of the Unix socket, removed at shutdown
+        self.path = None
+        self.posters = {}
+        self.last_used = {}
+        self.connections = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+
+    @coroutine
+    def handle_stream(self, stream, address):
+        self.connections += 1
+        try:
+            while True:
+                line = yield stream.read_until(b'\n', max_bytes=self.max_size)
+                self.relay(line)
+        except StreamClosedError:
+            # end of the client messages, or an incomplete line
+            pass
+        except tornado.iostream.UnsatisfiableReadError:
+            logging.warning("Message larger than %s bytes discarded", self.max_size)
+            stream.close()
+        finally:
+            self.connections -= 1
+
+    def relay(self, line):
+        try:
+            data = loads(line)
+            url = data['url']
+            message = IncomingMessage.factory(data['message'], validate=False)
+        except (ValueError, KeyError, TypeError, AttributeError) as ex:
+            logging.warning("Invalid message discarded: %s", ex)
+            return
+        if not url.startswith(('http://', 'https://')):
+            logging.warning("Message to an invalid URL discarded: %s", url)
+            return
+        self.post(url, message)
+
+    @coroutine
+    def post(self, url, message):
+        poster = self.posters.get(url)
+        if poster is None:
+            poster = self.posters[url] = AioPoster(url, concurrency=self.concurrency).open()
+        self.last_used[url] = time.time()
+        self.in_flight += 1
+        try:
+            yield poster.post(message)
+        except Exception as ex:
+            self.failed += 1
+            logging.warning("Relay to %s failed: %s", url, ex)
+        else:
+            self.sent += 1
+        finally:
+            self.in_flight -= 1
+            # the poster may have been closed by close_idle while the request was running
+            if self.posters.get(url) is poster:
+                self.last_used[url] = time.time()
+
+    @coroutine
+    def close_idle(self):
+        deadline = time.time() - self.idle_timeout
+        for url in [url for url, used in self.last_used.items() if used < deadline]:
+            del self.last_used[url]
+            poster = self.posters.pop(url, None)
+            if poster is not None:
+                yield poster.close()
+
+    @coroutine
+    def close(self):
+        posters, self.posters = self.posters, {}
+        self.last_used = {}
+        for poster in posters.values():
+            yield poster.close()
+
+
+def relay_running(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (IOError, OSError):
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+@coroutine
+def shutdown(timeout=30):
+    """
+    Stop the IOLoop once the messages received are posted.
+
+    The socket file is removed first, so that the clients post by themselves, then the connections already waiting in
+    the backlog of the socket are read.
+    """
+    global server
+    if server is None:
+        return
+    relay_server, server = server, None
+    if exists(relay_server.path):
+        os.remove(relay_server.path)
+    deadline = time.time() + timeout
+    yield tornado.gen.sleep(0.1)
+    while (relay_server.connections or relay_server.in_flight) and time.time() < deadline:
+        yield tornado.gen.sleep(0.05)
+    relay_server.stop()
+    yield relay_server.close()
+    logging.info("%s messages relayed, %s failed", relay_server.sent, relay_server.failed)
+    IOLoop.current().stop()
+
+
+def main():
+    global server
+
+    parser = argparse.ArgumentParser(
+        description="pymatterrelay posts the messages of the local command line tools over persistent connections"
+    )
+    parser.add_argument("-s", "--socket", help="Path of the Unix socket (default: MM_RELAY_SOCKET or "
+                                               "~/.pymatter/relay.sock)")
+    parser.add_argument("--concurrency", type=int, default=10, help="Maximum number of requests in flight per URL")
+    parser.add_argument("--maxsize", type=int, default=16 * 1024 * 1024, help="Maximum size of a message in bytes")
+    parser.add_argument("--idle", type=float, default=300.0,
+                        help="Number of seconds after which the connections to an unused URL are closed")
+    args = parser.parse_args()
+
+    path = abspath(args.socket or relay_socket())
+    if relay_running(path):
+        sys.stderr.write("A relay is already listening on {}\n".format(path))
+        sys.exit(-1)
+    if not exists(dirname(path)):
+        os.makedirs(dirname(path))
+    try:
+        # only the owner may hand messages to the relay
+        sock = tornado.netutil.bind_unix_socket(path, mode=0o600, backlog=1024)
+    except (IOError, OSError) as ex:
+        sys.stderr.write("Can't listen on {}: {}\n".format(path, ex))
+        sys.exit(-1)
+
+    server = RelayServer(args.concurrency, args.maxsize, args.idle)
+    server.path = path
+    server.add_socket(sock)
+    handle_signals(shutdown)
+    idle = tornado.ioloop.PeriodicCallback(
+        lambda: server is not None and server.close_idle(), max(1.0, args.idle / 2) * 1000
+    )
+    idle.start()
+    try:
+        IOLoop.current().start()
+    finally:
+        idle.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+JSON serialization, using the fastest available backend: orjson, then ujson, then the standard library.
+
+The backend can be forced with the PYMATTER_JSON environment variable (``orjson``, ``ujson`` or ``json``).
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import os
+
+
+def _orjson():
+    import orjson
+
+    def dumpb(obj):
+        return orjson.dumps(obj)
+    return dumpb, orjson.loads
+
+
+def _ujson():
+    import ujson
+
+    def dumpb(obj):
+        # ujson escapes the slashes of the URLs by default
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+    return dumpb, ujson.loads
+
+
+def _json():
+    def dumpb(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+    return dumpb, loads
+
+
+BACKENDS = {
+    'orjson': _orjson,
+    'ujson': _ujson,
+    'json': _json
+}
+
+
+def get_backend(name):
+    """
+    Return the (dumpb, loads) functions of a backend. Raise ImportError if the backend is not installed.
+    """
+    return BACKENDS[name]()
+
+
+def _select():
+    forced = os.environ.get('PYMATTER_JSON')
+    names = [forced] if forced in BACKENDS else ['orjson', 'ujson', 'json']
+    for name in names:
+        try:
+            return (name,) + get_backend(name)
+        except ImportError:
+            pass
+    return ('json',) + _json()
+
+
+BACKEND, dumpb, loads = _select()
@@ -2,6 +2,23 @@
 
 """
 Set up a SMTP service and forwards incoming mails to a Mattermost Incoming Webhook.
+
+Configuration (file given with -c, MM_SMTPD_CONF or ~/.pymatter/smtpd.conf)::
+
+    [smtpd]
+    port = 2525
+    bind = 127.0.0.1
+    ; mails larger than max_size bytes are refused, only the first max_parse bytes are parsed
+    max_size = 26214400
+    max_parse = 1048576
+
+    [mattermost]
+    url = https://mattermost.example.org/hooks
+    ; optional, for the recipients that are not listed below
+    default_hook = xxxxxxxxxxxxxxxxxxxxxxxxxx
+
+    [recipients]
+    alerts@example.org = yyyyyyyyyyyyyyyyyyyyyyyyyy
 """
 
 from __future__ import unicode_literals
@@ -9,14 +26,393 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import argparse
+import datetime
+import logging
 import os
+import re
+import socket
 import sys
+import time
+from email.header import decode_header, make_header
 from os.path import expanduser, abspath, exists
+try:
+    from ConfigParser import SafeConfigParser
+except ImportError:
+    from configparser import ConfigParser as SafeConfigParser
+try:
+    from email.feedparser import BytesFeedParser as FeedParser
+except ImportError:
+    from email.feedparser import FeedParser
+
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+import tornado.util
+
+from .aio import AioPoster, handle_signals
+from .base import IncomingMessage, Attachment, Field, decode_text
+
+IOLoop = tornado.ioloop.IOLoop
+TCPServer = tornado.tcpserver.TCPServer
+StreamClosedError = tornado.iostream.StreamClosedError
+TimeoutError = tornado.util.TimeoutError
+coroutine = tornado.gen.coroutine
+with_timeout = tornado.gen.with_timeout
+
+defaults = {
+    'port': '2525',
+    'bind': '',
+    'hostname': '',
+    'max_size': '26214400',
+    'max_parse': '1048576',
+    'max_text': '4000',
+    'max_connections': '10000',
+    'idle_timeout': '300',
+    'concurrency': '20',
+    'username': 'pymattersmtpd',
+    'default_hook': '',
+    'shutdown_timeout': '10'
+}
+
+READ_SIZE = 64 * 1024
+MAX_LINE = 4096
+ADDRESS = re.compile(r'^\s*(?:FROM|TO):\s*<?([^<>\s]*)>?\s*(.*)$', re.I)
+TAGS = re.compile(r'<[^>]+>')
+
+server = None
+
+
+class LineTooLong(Exception):
+    pass
+
+
+def header(message, name):
+    value = message.get(name)
+    if value is None:
+        return u''
+    try:
+        return decode_text(u'{}'.format(make_header(decode_header(u'{}'.format(value)))))
+    except (UnicodeError, LookupError, ValueError):
+        return decode_text(u'{}'.format(value))
+
+
+def part_text(part):
+    payload = part.get_payload(decode=True) or b''
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, 'replace')
+    except LookupError:
+        return payload.decode('utf-8', 'replace')
+
+
+def mail_to_message(mail, truncated, username, max_text):
+    """
+    Build the IncomingMessage posted for a parsed mail: the text body (or the HTML body without its tags) in an
+    attachment, with the main headers and the names of the attached files as fields.
+    """
+    plain = html = None
+    files = []
+    for part in mail.walk():
+        if part.is_multipart():
+            continue
+        filename = part.get_filename()
+        content_type = part.get_content_type()
+        if filename or part.get('Content-Disposition', '').lower().startswith('attachment'):
+            files.append(decode_text(filename or content_type))
+        elif content_type == 'text/plain' and plain is None:
+            plain = part_text(part)
+        elif content_type == 'text/html' and html is None:
+            html = TAGS.sub(u'', part_text(part))
+    body = plain if plain is not None else (html or u'')
+    if len(body) > max_text:
+        body = body[:max_text] + u'…'
+        truncated = True
+    subject = header(mail, 'Subject') or u'(no subject)'
+    att = Attachment(fallback=subject, title=subject, text=body)
+    for name in ('From', 'To', 'Cc', 'Date'):
+        value = header(mail, name)
+        if value:
+            att.fields.append(Field(name, value, True))
+    if files:
+        att.fields.append(Field('Attachments', u', '.join(files), False))
+    if truncated:
+        att.fields.append(Field('Truncated', u'yes', True))
+    return IncomingMessage(
+        text=u"**Mail from {}**".format(header(mail, 'From') or u'unknown sender'), username=username,
+        attachments=[att]
+    )
+
+
+class SMTPSession(object):
+    """
+    One SMTP connection: reads the commands, streams the mail data into the MIME parser and delivers the mail.
+    """
+    def __init__(self, server, stream, address):
+        self.server = server
+        self.stream = stream
+        self.address = address
+        self.buffer = b''
+        self.reset()
+
+    def reset(self):
+        self.sender = None
+        self.hooks = []
+
+    @coroutine
+    def read_more(self):
+        chunk = yield with_timeout(
+            datetime.timedelta(seconds=self.server.idle_timeout), self.stream.read_bytes(READ_SIZE, partial=True)
+        )
+        self.buffer += chunk
+
+    @coroutine
+    def read_line(self):
+        while True:
+            end = self.buffer.find(b'\n')
+            if end >= 0:
+                line, self.buffer = self.buffer[:end], self.buffer[end + 1:]
+                raise tornado.gen.Return(line.rstrip(b'\r'))
+            if len(self.buffer) > MAX_LINE:
+                raise LineTooLong()
+            yield self.read_more()
+
+    def reply(self, text):
+        return self.stream.write(text.encode('utf-8') + b'\r\n')
+
+    @coroutine
+    def run(self):
+        try:
+            yield self.reply(u'220 {} ESMTP pymatter'.format(self.server.hostname))
+            while True:
+                try:
+                    line = yield self.read_line()
+                except LineTooLong:
+                    yield self.reply(u'500 Line too long')
+                    return
+                if not (yield self.command(line.decode('utf-8', 'replace'))):
+                    return
+        except TimeoutError:
+            yield self.reply(u'421 Idle timeout, closing connection')
+        except StreamClosedError:
+            pass
+        finally:
+            self.stream.close()
+
+    @coroutine
+    def command(self, line):
+        """
+        Handle a command line. Return False when the connection must be closed.
+        """
+        verb, _, arg = line.partition(u' ')
+        verb = verb.upper()
+        server = self.server
+        if verb == u'EHLO':
+            self.reset()
+            yield self.reply(u'250-{}\r\n250-SIZE {}\r\n250-8BITMIME\r\n250 PIPELINING'.format(
+                server.hostname, server.max_size
+            ))
+        elif verb == u'HELO':
+            self.reset()
+            yield self.reply(u'250 {}'.format(server.hostname))
+        elif verb == u'MAIL':
+            match = ADDRESS.match(arg)
+            if match is None:
+                yield self.reply(u'501 Syntax: MAIL FROM:<address>')
+            else:
+                size = re.search(r'SIZE=(\d+)', match.group(2), re.I)
+                if size and int(size.group(1)) > server.max_size:
+                    yield self.reply(u'552 Message size exceeds fixed maximum message size')
+                else:
+                    self.reset()
+                    self.sender = match.group(1)
+                    yield self.reply(u'250 OK')
+        elif verb == u'RCPT':
+            match = ADDRESS.match(arg)
+            if self.sender is None:
+                yield self.reply(u'503 Need MAIL command')
+            elif match is None:
+                yield self.reply(u'501 Syntax: RCPT TO:<address>')
+            else:
+                hook = server.hook(match.group(1))
+                if hook is None:
+                    yield self.reply(u'550 No such user here')
+                else:
+                    if hook not in self.hooks:
+                        self.hooks.append(hook)
+                    yield self.reply(u'250 OK')
+        elif verb == u'DATA':
+            if not self.hooks:
+                yield self.reply(u'503 Need RCPT command')
+            else:
+                yield self.reply(u'354 End data with <CR><LF>.<CR><LF>')
+                yield self.data()
+                self.reset()
+        elif verb == u'RSET':
+            self.reset()
+            yield self.reply(u'250 OK')
+        elif verb == u'NOOP':
+            yield self.reply(u'250 OK')
+        elif verb == u'VRFY':
+            yield self.reply(u'252 Cannot VRFY user')
+        elif verb == u'QUIT':
+            yield self.reply(u'221 Bye')
+            raise tornado.gen.Return(False)
+        else:
+            yield self.reply(u'502 Command not implemented')
+        raise tornado.gen.Return(True)
+
+    @coroutine
+    def data(self):
+        """
+        Stream the mail data into the MIME parser, undoing the dot-stuffing, until the final <CR><LF>.<CR><LF>. Only
+        the first `max_parse` bytes are parsed; the rest is read and discarded.
+        """
+        server = self.server
+        parser = FeedParser()
+        size = 0
+        parsed = 0
+        # the terminator and the stuffed dots are searched for at the beginning of the lines
+        self.buffer = b'\r\n' + self.buffer
+        while True:
+            end = self.buffer.find(b'\r\n.\r\n')
+            if end >= 0:
+                data, self.buffer = self.buffer[:end + 2], self.buffer[end + 5:]
+            else:
+                # cut before the last line start, so that no pattern spans two blocks
+                cut = self.buffer.rfind(b'\r\n')
+                if cut <= 0:
+                    if len(self.buffer) <= READ_SIZE:
+                        yield self.read_more()
+                        continue
+                    cut = len(self.buffer) - 1
+                data, self.buffer = self.buffer[:cut], self.buffer[cut:]
+            data = data.replace(b'\r\n..', b'\r\n.')
+            size += len(data)
+            if parsed < server.max_parse:
+                block = data[:server.max_parse - parsed]
+                parser.feed(block[2:] if parsed == 0 else block)
+                parsed += len(block)
+            if end >= 0:
+                break
+            yield self.read_more()
+
+        if size > server.max_size:
+            yield self.reply(u'552 Message size exceeds fixed maximum message size')
+            return
+        message = mail_to_message(parser.close(), parsed < size, server.username, server.max_text)
+        try:
+            yield [server.poster(hook).post(message) for hook in self.hooks]
+        except Exception as ex:
+            logging.warning("Forward of a mail from %s failed: %s", self.sender, ex)
+            yield self.reply(u'451 Requested action aborted: error in processing')
+        else:
+            yield self.reply(u'250 OK: message accepted for delivery')
+
+
+class SMTPServer(TCPServer):
+    """
+    SMTP server mapping the recipients to Mattermost webhooks.
+
+    Sessions are coroutines of the IOLoop, so that thousands of concurrent connections do not need thousands of
+    threads. Each webhook gets its own pooled poster sending at most `concurrency` requests at the same time.
+    """
+    def __init__(self, config):
+        super(SMTPServer, self).__init__(max_buffer_size=2 * READ_SIZE)
+        self.hostname = config.get('smtpd', 'hostname') or socket.getfqdn()
+        self.max_size = config.getint('smtpd', 'max_size')
+        self.max_parse = config.getint('smtpd', 'max_parse')
+        self.max_text = config.getint('smtpd', 'max_text')
+        self.max_connections = config.getint('smtpd', 'max_connections')
+        self.idle_timeout = config.getfloat('smtpd', 'idle_timeout')
+        self.concurrency = config.getint('smtpd', 'concurrency')
+        self.username = config.get('smtpd', 'username')
+        self.url = config.get('mattermost', 'url').rstrip('/')
+        self.default_hook = config.get('mattermost', 'default_hook')
+        self.recipients = dict(
+            (address.lower(), hook) for address, hook in config.items('recipients')
+            if address not in config.defaults()
+        ) if config.has_section('recipients') else {}
+        self.posters = {}
+        self.connections = 0
+
+    def hook(self, address):
+        hook = self.recipients.get(address.lower()) or self.default_hook
+        return u'{}/{}'.format(self.url, hook) if hook else None
+
+    def poster(self, hook_url):
+        poster = self.posters.get(hook_url)
+        if poster is None:
+            poster = self.posters[hook_url] = AioPoster(hook_url, concurrency=self.concurrency).open()
+        return poster
+
+    @coroutine
+    def handle_stream(self, stream, address):
+        if self.connections >= self.max_connections:
+            try:
+                yield stream.write(b'421 Too many connections, try again later\r\n')
+            except StreamClosedError:
+                pass
+            stream.close()
+            return
+        self.connections += 1
+        try:
+            yield SMTPSession(self, stream, address).run()
+        finally:
+            self.connections -= 1
+
+    @coroutine
+    def close(self):
+        for poster in self.posters.values():
+            yield poster.close()
+        self.posters = {}
+
+
+@coroutine
+def shutdown():
+    """
+    Stop accepting connections, then stop the IOLoop once the sessions are finished (or after the shutdown timeout).
+    """
+    global server
+    if server is None:
+        return
+    smtp_server, server = server, None
+    smtp_server.stop()
+    deadline = time.time() + smtp_server.shutdown_timeout
+    while smtp_server.connections > 0 and time.time() < deadline:
+        yield tornado.gen.sleep(0.1)
+    yield smtp_server.close()
+    IOLoop.current().stop()
+
+
+def main():
+    global server
+
+    parser = argparse.ArgumentParser(description="Start a SMTP server forwarding the mails to Mattermost")
+    parser.add_argument('-c', '--config', default='', help="Configuration file path")
+    args = parser.parse_args()
+
+    conf_fname = args.config if args.config else os.environ.get('MM_SMTPD_CONF')
+    if conf_fname is None:
+        conf_fname = abspath(expanduser('~/.pymatter/smtpd.conf'))
+    if not exists(conf_fname):
+        sys.stderr.write("No configuration provided\n")
+        sys.exit(-1)
+
+    logging.info("Using config file '%s'", conf_fname)
+    config = SafeConfigParser(defaults)
+    config.read([conf_fname])
+
+    server = SMTPServer(config)
+    server.shutdown_timeout = config.getfloat('smtpd', 'shutdown_timeout')
+    server.add_sockets(tornado.netutil.bind_sockets(
+        config.getint('smtpd', 'port'), config.get('smtpd', 'bind') or None, backlog=1024
+    ))
+    handle_signals(shutdown)
+    IOLoop.current().start()
 
-CONF_FILE = os.environ.get('MM_SMTPD_CONF')
-if CONF_FILE is None:
-    CONF_FILE = abspath(expanduser('.pymatter/smtpd.conf'))
-if not exists(CONF_FILE):
-    sys.stderr.write(b"No configuration provided\n")
-    sys.exit(-1)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+Durable on-disk queue of messages waiting to be delivered.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from os.path import join, exists
+
+HEADER = struct.Struct(str('>II'))
+SEGMENT_SUFFIX = '.seg'
+CURSOR_FILE = 'cursor'
+
+
+def iter_records(buf, offset):
+    """
+    Yield (end offset, payload) for the complete and valid records of `buf`, starting at `offset`.
+    """
+    size = len(buf)
+    while offset + HEADER.size <= size:
+        length, crc = HEADER.unpack_from(buf, offset)
+        end = offset + HEADER.size + length
+        if end > size:
+            return
+        payload = buf[offset + HEADER.size:end]
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            return
+        yield end, payload
+        offset = end
+
+
+def read_segment(path, offset, limit):
+    """
+    Read at most `limit` records of the segment at `path`, starting at `offset`, through a memory map.
+    """
+    size = os.path.getsize(path)
+    if size <= offset:
+        return []
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            records = []
+            for end, payload in iter_records(buf, offset):
+                records.append((end, payload))
+                if len(records) >= limit:
+                    break
+            return records
+        finally:
+            buf.close()
+
+
+class Spool(object):
+    """
+    Append-only queue stored in segment files of `directory`.
+
+    Records are appended to the current segment, and the segment is fsynced every `sync_every` records or
+    `sync_interval` seconds, whichever comes first (call `sync` regularly so that the interval is honoured when no
+    record is appended). A new segment is started when the current one reaches `segment_size` bytes.
+
+    The consumer reads the records in order with `pending` and acknowledges them with `commit`. The position of the
+    consumer is persisted in the directory, so that delivery resumes where it stopped after a restart. Segments that
+    have been entirely consumed are deleted.
+    """
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, sync_every=100, sync_interval=0.5):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.not_empty = threading.Event()
+        if not exists(directory):
+            os.makedirs(directory)
+        self.segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX)
+        )
+        self.cursor = self._load_cursor()
+        if not self.segments:
+            self.segments.append(max(1, self.cursor[0]))
+        self.writer = None
+        self.writer_size = 0
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self._open_writer()
+        if self.cursor[0] < self.segments[0]:
+            self.cursor = (self.segments[0], 0)
+        self.pending(1)
+
+    def segment_path(self, segment):
+        return join(self.directory, '{:020d}{}'.format(segment, SEGMENT_SUFFIX))
+
+    def _load_cursor(self):
+        try:
+            with open(join(self.directory, CURSOR_FILE)) as f:
+                segment, offset = f.read().split()
+            return int(segment), int(offset)
+        except (IOError, OSError, ValueError):
+            return 0, 0
+
+    def _open_writer(self):
+        path = self.segment_path(self.segments[-1])
+        # drop a record that was only partially written before a crash
+        valid = 0
+        if exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            for valid, _ in iter_records(data, valid):
+                pass
+            if valid != len(data):
+                with open(path, 'r+b') as f:
+                    f.truncate(valid)
+        self.writer = open(path, 'ab')
+        self.writer_size = valid
+
+    def append(self, payload):
+        """
+        Append a record and return its position, as given to `commit`.
+        """
+        record = HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        with self.lock:
+            if self.writer_size and self.writer_size + len(record) > self.segment_size:
+                self._sync()
+                self.writer.close()
+                self.segments.append(self.segments[-1] + 1)
+                self._open_writer()
+            self.writer.write(record)
+            self.writer.flush()
+            self.writer_size += len(record)
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every or time.time() - self.last_sync >= self.sync_interval:
+                self._sync()
+            position = (self.segments[-1], self.writer_size)
+        self.not_empty.set()
+        return position
+
+    def _sync(self):
+        if self.unsynced:
+            os.fsync(self.writer.fileno())
+            self.unsynced = 0
+        self.last_sync = time.time()
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def pending(self, limit=100):
+        """
+        Return at most `limit` records following the consumer position, as a list of (position, payload).
+
+        `not_empty` is set when records are waiting, so that a consumer can wait on it when this returns nothing.
+        """
+        # cleared before reading, so that a concurrent append is either read now or sets the event again
+        self.not_empty.clear()
+        with self.lock:
+            segment, offset = self.cursor
+            segments = [s for s in self.segments if s >= segment]
+        records = []
+        for s in segments:
+            start = offset if s == segment else 0
+            for end, payload in read_segment(self.segment_path(s), start, limit - len(records)):
+                records.append(((s, end), payload))
+            if len(records) >= limit:
+                break
+        if records:
+            self.not_empty.set()
+        return records
+
+    def commit(self, position):
+        """
+        Acknowledge every record up to `position`.
+        """
+        with self.lock:
+            self.cursor = position
+            tmp = join(self.directory, CURSOR_FILE + '.tmp')
+            with open(tmp, 'w') as f:
+                f.write('{} {}'.format(*position))
+            os.rename(tmp, join(self.directory, CURSOR_FILE))
+            while len(self.segments) > 1 and self.segments[0] < position[0]:
+                os.remove(self.segment_path(self.segments.pop(0)))
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self._sync()
+                self.writer.close()
+                self.writer = None
+
+    def __repr__(self):
+        return u"Spool('{}')".format(self.directory)
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+
+"""
+Follow files and send the lines appended to them to mattermost
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import codecs
+import ctypes
+import ctypes.util
+import errno
+import getpass
+import json
+import logging
+import os
+import platform
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from os.path import abspath, basename, dirname, exists
+
+from .base import IncomingMessage, AsyncPoster, LineBatcher, Code, Attachment, Field, decode_text
+from .cat import file_language
+from .spool import Spool
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct(str('iIII'))
+
+READ_SIZE = 64 * 1024
+
+
+def _load_libc():
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class PollWatcher(object):
+    """
+    Wake up every `interval` seconds.
+    """
+    def __init__(self, paths, interval=1.0):
+        self.interval = interval
+
+    def wait(self, timeout=None):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        return True
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return u"PollWatcher({})".format(self.interval)
+
+
+class InotifyWatcher(object):
+    """
+    Wake up when one of `paths` is modified, created, moved or deleted, or after `interval` seconds.
+
+    The parent directories are watched rather than the files themselves, so that a file recreated after a rotation
+    is noticed. Raise OSError when inotify is not available.
+    """
+    def __init__(self, paths, interval=1.0):
+        self.interval = interval
+        libc = _load_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.names = {}
+        for path in paths:
+            directory = dirname(path)
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory) if hasattr(os, 'fsencode') else directory,
+                                        WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(err, "inotify_add_watch failed on '{}'".format(directory))
+            self.names.setdefault(wd, set()).add(basename(path))
+
+    def wait(self, timeout=None):
+        """
+        Return True if one of the watched files may have changed.
+        """
+        timeout = self.interval if timeout is None else min(timeout, self.interval)
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            # periodic check, in case an event was missed (network file systems...)
+            return True
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError as ex:
+            if ex.errno == errno.EAGAIN:
+                return False
+            raise
+        relevant = False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+            # wd is -1 when the event queue overflowed
+            if wd == -1 or name.decode('utf-8', 'replace') in self.names.get(wd, ()):
+                relevant = True
+        return relevant
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __repr__(self):
+        return u"InotifyWatcher({})".format(self.interval)
+
+
+def make_watcher(paths, interval=1.0, use_inotify=True):
+    if use_inotify:
+        try:
+            return InotifyWatcher(paths, interval)
+        except OSError:
+            pass
+    return PollWatcher(paths, interval)
+
+
+class FollowedFile(object):
+    """
+    A file followed by name, like ``tail -F``.
+
+    `read_lines` returns the complete lines appended since the last call, with the (inode, offset) position following
+    each of them. When the file is replaced (rotation), the end of the previous file is read before switching to the
+    new one. When it is truncated, reading starts again from the beginning.
+    """
+    def __init__(self, path, inode=None, offset=None):
+        self.path = path
+        self.handle = None
+        self.inode = inode
+        self.offset = offset
+        self.partial = b''
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def _open(self, start_at_end):
+        try:
+            handle = open(self.path, 'rb')
+        except (IOError, OSError):
+            return False
+        inode = os.fstat(handle.fileno()).st_ino
+        if inode == self.inode and self.offset is not None:
+            offset = self.offset
+        elif self.inode is None and self.offset is None and start_at_end:
+            offset = os.fstat(handle.fileno()).st_size
+        else:
+            offset = 0
+        if offset > os.fstat(handle.fileno()).st_size:
+            offset = 0
+        handle.seek(offset)
+        self.handle, self.inode, self.offset = handle, inode, offset
+        self.partial = b''
+        self.decoder.reset()
+        return True
+
+    def _read(self, lines):
+        while True:
+            data = self.handle.read(READ_SIZE)
+            if not data:
+                return
+            data = self.partial + data
+            start = 0
+            end = data.find(b'\n')
+            while end >= 0:
+                self.offset += end + 1 - start
+                lines.append((self.decoder.decode(data[start:end + 1]), (self.inode, self.offset)))
+                start = end + 1
+                end = data.find(b'\n', start)
+            self.partial = data[start:]
+
+    def _close(self, lines):
+        self._read(lines)
+        if self.partial:
+            # the previous file will not grow anymore: its last line is complete
+            self.offset += len(self.partial)
+            lines.append((self.decoder.decode(self.partial, True) + u'\n', (self.inode, self.offset)))
+        self.handle.close()
+        self.handle = None
+        self.partial = b''
+
+    def read_lines(self, start_at_end=False):
+        lines = []
+        if self.handle is None and not self._open(start_at_end):
+            return lines
+        try:
+            stat = os.stat(self.path)
+        except (IOError, OSError):
+            stat = None
+        if stat is not None and stat.st_ino != self.inode:
+            self._close(lines)
+            if self._open(start_at_end=False):
+                self._read(lines)
+            return lines
+        if stat is not None and stat.st_size < self.offset + len(self.partial):
+            # truncated
+            self.handle.seek(0)
+            self.offset = 0
+            self.partial = b''
+            self.decoder.reset()
+        self._read(lines)
+        return lines
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+    def __repr__(self):
+        return u"FollowedFile('{}')".format(self.path)
+
+
+class Checkpoint(object):
+    """
+    Positions of the followed files, persisted as JSON in `filename`.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.positions = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        if filename and exists(filename):
+            try:
+                with open(filename) as f:
+                    self.positions = dict(
+                        (path, (position['inode'], position['offset'])) for path, position in json.load(f).items()
+                    )
+            except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+                self.positions = {}
+
+    def get(self, path):
+        return self.positions.get(path, (None, None))
+
+    def update(self, path, position):
+        with self.lock:
+            self.positions[path] = position
+            self.dirty = True
+
+    def save(self):
+        if not self.filename:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            data = dict(
+                (path, {'inode': inode, 'offset': offset}) for path, (inode, offset) in self.positions.items()
+            )
+            self.dirty = False
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.filename)
+
+    def __repr__(self):
+        return u"Checkpoint('{}')".format(self.filename)
+
+
+class Follower(object):
+    """
+    Batch the lines appended to a followed file and post them.
+
+    The checkpoint moves to the position following the last line of a batch once the batch is delivered (or failed
+    for good), in the order of the batches: the batches still queued or in flight when pymattertail stops are read
+    again by the next run. With a spool, the batches are safe once spooled and the checkpoint moves at once.
+    """
+    def __init__(self, followed, poster, checkpoint, msg_args, fields, language, plain, max_bytes, max_lines,
+                 max_latency):
+        self.followed = followed
+        self.poster = poster
+        self.checkpoint = checkpoint
+        self.msg_args = msg_args
+        self.fields = fields
+        self.language = language
+        self.plain = plain
+        self.name = basename(followed.path)
+        self.positions = deque()
+        # (delivery, position) of the batches posted and not checkpointed yet
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.batcher = LineBatcher(self.post_batch, max_bytes, max_lines, max_latency)
+
+    def post_batch(self, text):
+        # every line ends with a new line
+        position = None
+        for _ in range(text.count(u'\n')):
+            position = self.positions.popleft()
+        att = Attachment(fallback=self.name, text=text if self.plain else Code(text, self.language), title=self.name)
+        for name, value in self.fields:
+            att.fields.append(Field(name, value, True))
+        att.fields.append(Field('File name', self.name, True))
+        delivery = self.poster.post(IncomingMessage(attachments=[att], **self.msg_args))
+        if self.poster.spool is not None:
+            if position is not None:
+                self.checkpoint.update(self.followed.path, position)
+            return
+        with self.lock:
+            self.pending.append((delivery, position))
+        if delivery is None:
+            # duplicate suppressed by the poster
+            self.delivered(None)
+        else:
+            delivery.add_done_callback(self.delivered)
+
+    def delivered(self, delivery):
+        """
+        Move the checkpoint past the batches whose delivery is over, in order.
+        """
+        with self.lock:
+            while self.pending and (self.pending[0][0] is None or self.pending[0][0].done()):
+                done, position = self.pending.popleft()
+                if done is not None and not done.ok:
+                    logging.warning("Lines of '%s' could not be posted: %s", self.followed.path,
+                                    done.error or done.status)
+                if position is not None:
+                    self.checkpoint.update(self.followed.path, position)
+
+    def poll(self, start_at_end=False):
+        for line, position in self.followed.read_lines(start_at_end):
+            self.positions.append(position)
+            self.batcher.add(line)
+
+    def __repr__(self):
+        return u"Follower('{}')".format(self.followed.path)
+
+
+def follow(followers, watcher, checkpoint, stop, checkpoint_interval=5.0, start_at_end=True):
+    """
+    Poll the followers until `stop` is set.
+    """
+    for follower in followers:
+        follower.poll(start_at_end)
+    last_save = time.time()
+    while not stop.is_set():
+        if watcher.wait():
+            for follower in followers:
+                follower.poll()
+        if time.time() - last_save >= checkpoint_interval:
+            checkpoint.save()
+            last_save = time.time()
+
+
+def main():
+    hostname = platform.uname()[1]
+    local_username = getpass.getuser()
+
+    parser = argparse.ArgumentParser(
+        description="pymattertail follows files and posts the lines appended to them to a mattermost instance"
+    )
+    parser.add_argument("-c", "--channel", help="Post input values to the specified channel")
+    parser.add_argument("-i", "--iconurl", help="Icon URL")
+    parser.add_argument("-l", "--language", default="detect", help="Language for syntax highlighting")
+    parser.add_argument("-m", "--mattermosturl", help="Post the message to the specified webhook URL")
+    parser.add_argument("-p", "--plain", action='store_true', help="Don't surround the message with triple ticks")
+    parser.add_argument("-u", "--username", default="pymattertail", help="Displayed username")
+    parser.add_argument("-k", "--checkpoint", help="File where the positions in the followed files are saved")
+    parser.add_argument("--checkpointinterval", type=float, default=5.0,
+                        help="Number of seconds between checkpoint saves")
+    parser.add_argument("-f", "--fromstart", action='store_true',
+                        help="Read files from their beginning when no position was saved")
+    parser.add_argument("--spool", help="Directory of a durable spool for the messages waiting to be sent")
+    parser.add_argument("--poll", action='store_true', help="Poll the files instead of using inotify")
+    parser.add_argument("--interval", type=float, default=1.0, help="Number of seconds between polls")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of concurrent senders")
+    parser.add_argument("--maxbytes", type=int, default=4000, help="Maximum size of a batch in bytes")
+    parser.add_argument("--maxlines", type=int, default=100, help="Maximum number of lines in a batch")
+    parser.add_argument("--maxlatency", type=float, default=1.0,
+                        help="Maximum number of seconds a line waits in a batch before being posted")
+    parser.add_argument("files", nargs="+", help="Files to follow")
+    args = parser.parse_args()
+
+    channel = decode_text(args.channel if args.channel else os.environ.get("MM_CHANNEL"))
+    icon_url = decode_text(args.iconurl if args.iconurl else os.environ.get("MM_ICONURL"))
+    language = decode_text(args.language)
+    url = decode_text(args.mattermosturl if args.mattermosturl else os.environ.get("MM_HOOK"))
+    username = decode_text(args.username if args.username else os.environ.get("MM_USERNAME"))
+
+    if not url:
+        sys.stderr.write("No Mattermost URL was provided\n")
+        sys.exit(-1)
+
+    paths = [abspath(f) for f in args.files]
+    msg_args = {'username': username, 'icon_url': icon_url, 'channel': channel}
+    fields = [('Local user', local_username), ('Hostname', hostname)]
+    checkpoint = Checkpoint(args.checkpoint)
+    spool = Spool(args.spool) if args.spool else None
+    poster = AsyncPoster(url, workers=args.workers, spool=spool)
+    watcher = make_watcher(paths, args.interval, use_inotify=not args.poll)
+    stop = threading.Event()
+
+    def sig_handler(sig, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, sig_handler)
+    signal.signal(signal.SIGINT, sig_handler)
+
+    followers = []
+    for path in paths:
+        inode, offset = checkpoint.get(path)
+        followers.append(Follower(
+            FollowedFile(path, inode, offset), poster, checkpoint, msg_args, fields,
+            file_language(basename(path), language), args.plain, args.maxbytes, args.maxlines, args.maxlatency
+        ))
+
+    with poster:
+        for follower in followers:
+            follower.batcher.__enter__()
+        try:
+            follow(followers, watcher, checkpoint, stop, args.checkpointinterval, start_at_end=not args.fromstart)
+        finally:
+            for follower in followers:
+                follower.batcher.__exit__(None, None, None)
+                follower.followed.close()
+            watcher.close()
+    checkpoint.save()
+    if spool is not None:
+        spool.close()
+
+
+if __name__ == '__main__':
+    main()
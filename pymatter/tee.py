@@ -15,10 +15,171 @@ import sys
 import getpass
 import os
 import datetime
+import io
+import codecs
+import errno
+import threading
+from collections import deque
 
-import requests
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
 
-from .base import IncomingMessage, AsyncPoster, Code, Attachment, Field, decode_text
+from .base import IncomingMessage, AsyncPoster, LineBatcher, Code, Attachment, Field, decode_text
+from .oneshot import post, hand_off, PostError
+from .cli import exit_with_report
+
+
+def pump(source, sink, side, block_size=64 * 1024):
+    """
+    Copy the binary file `source` to `sink` in blocks of at most `block_size` bytes, handing a copy of each block to
+    `side`. The blocks are read into a single reusable buffer.
+
+    When `sink` is closed by the reader (broken pipe), the copy stops but `source` is still read for `side`.
+    """
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    copying = True
+    while True:
+        n = source.readinto(buf)
+        if not n:
+            return
+        if copying:
+            try:
+                written = 0
+                while written < n:
+                    written += sink.write(view[written:n]) or 0
+            except (IOError, OSError) as ex:
+                if ex.errno != errno.EPIPE:
+                    raise
+                copying = False
+        side.put(bytes(view[:n]))
+
+
+def release(stream):
+    """
+    Close the file descriptor of `stream` (pointing it to /dev/null), so that the reader at the other end of a pipe
+    sees the end of the data while the messages are still being sent.
+    """
+    stream.flush()
+    null = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(null, stream.fileno())
+    finally:
+        os.close(null)
+
+
+class SideChannel(object):
+    """
+    Bounded queue of blocks consumed by `consumer` in a background thread.
+
+    When `max_blocks` blocks are already waiting, `put` waits for the consumer if `block` is true. Otherwise the block
+    is dropped and counted in `dropped` (bytes), and the consumer is told about the gap with the next block that gets
+    through.
+    """
+    def __init__(self, consumer, max_blocks=256, block=True):
+        self.consumer = consumer
+        self.queue = Queue(max(1, int(max_blocks)))
+        self.block = block
+        self.dropped = 0
+        self.gap = 0
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.consuming_thread)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def put(self, block):
+        if self.block:
+            self.queue.put((block, 0))
+            return
+        try:
+            self.queue.put_nowait((block, self.gap))
+        except Full:
+            self.dropped += len(block)
+            self.gap += len(block)
+        else:
+            self.gap = 0
+
+    def consuming_thread(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.consumer.close()
+                return
+            block, gap = item
+            if gap:
+                self.consumer.skipped(gap)
+            self.consumer.feed(block)
+
+
+class LineSplitter(object):
+    """
+    Decode blocks of UTF-8 text and hand complete lines to `callback`.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.partial = u''
+
+    def feed(self, block):
+        text = self.partial + self.decoder.decode(block)
+        start = 0
+        end = text.find(u'\n')
+        while end >= 0:
+            self.callback(text[start:end + 1])
+            start = end + 1
+            end = text.find(u'\n', start)
+        self.partial = text[start:]
+
+    def skipped(self, size):
+        self.callback(self.partial + u"[... {} bytes skipped ...]\n".format(size))
+        self.partial = u''
+        self.decoder.reset()
+
+    def close(self):
+        text = self.partial + self.decoder.decode(b'', True)
+        self.partial = u''
+        if text:
+            self.callback(text + u'\n')
+
+
+class TailBuffer(object):
+    """
+    Keep the last `max_bytes` bytes of the blocks it is fed.
+    """
+    def __init__(self, max_bytes=1024 * 1024):
+        self.max_bytes = max(1, int(max_bytes))
+        self.blocks = deque()
+        self.size = 0
+        self.omitted = 0
+
+    def feed(self, block):
+        self.blocks.append(block)
+        self.size += len(block)
+        while self.size - len(self.blocks[0]) >= self.max_bytes:
+            first = self.blocks.popleft()
+            self.size -= len(first)
+            self.omitted += len(first)
+
+    def close(self):
+        pass
+
+    def text(self):
+        data = b''.join(self.blocks)
+        extra = len(data) - self.max_bytes
+        if extra > 0:
+            data = data[extra:]
+            self.omitted += extra
+        return codecs.utf_8_decode(data, 'replace', True)[0]
 
 
 def main():
@@ -36,6 +197,25 @@ def main():
                         help="Post each line of stdin as a distinct message, no buffering")
     parser.add_argument("-p", "--plain", action='store_true', help="Don't surround the message with triple ticks")
     parser.add_argument("-u", "--username", default="pymattertee", help="Displayed username")
+    parser.add_argument("--direct", action='store_true', help="Post directly, even when a relay is running")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of concurrent senders in --nobuffer mode")
+    parser.add_argument("-q", "--queuesize", type=int, default=1000,
+                        help="Maximum number of messages waiting to be sent in --nobuffer mode (0 for unbounded)")
+    parser.add_argument("-o", "--overflow", default=AsyncPoster.BLOCK, choices=AsyncPoster.OVERFLOW_POLICIES,
+                        help="What to do when the queue is full in --nobuffer mode")
+    parser.add_argument("-b", "--batch", action='store_true',
+                        help="In --nobuffer mode, merge consecutive lines into a single message")
+    parser.add_argument("--maxbytes", type=int, default=4000, help="Maximum size of a batch in bytes")
+    parser.add_argument("--maxlines", type=int, default=100, help="Maximum number of lines in a batch")
+    parser.add_argument("--maxlatency", type=float, default=1.0,
+                        help="Maximum number of seconds a line waits in a batch before being posted")
+    parser.add_argument("--blocksize", type=int, default=64 * 1024, help="Size of the blocks copied to stdout")
+    parser.add_argument("--sidequeue", type=int, default=256,
+                        help="Maximum number of blocks queued for mattermost before stdin is paused (or blocks are "
+                             "skipped with a drop overflow policy in --nobuffer mode)")
+    parser.add_argument("--maxbuffer", type=int, default=1024 * 1024,
+                        help="Without --nobuffer, maximum number of bytes sent (the end of the input is kept)")
     args = parser.parse_args()
 
     channel = decode_text(args.channel if args.channel else os.environ.get("MM_CHANNEL"))
@@ -47,28 +227,48 @@ def main():
     username = decode_text(args.username if args.username else os.environ.get("MM_USERNAME"))
 
     if not url:
-        sys.stderr.write(b"No Mattermost URL was provided\n")
+        sys.stderr.write("No Mattermost URL was provided\n")
         sys.exit(-1)
 
+    sys.stdout.flush()
+    source = io.open(sys.stdin.fileno(), 'rb', buffering=0, closefd=False)
+    sink = io.open(sys.stdout.fileno(), 'wb', buffering=0, closefd=False)
+
     if no_buffer:
-        poster = AsyncPoster(url)
+        poster = AsyncPoster(url, workers=args.workers, queue_size=args.queuesize, overflow=args.overflow)
+        # only the drop policies may lose data
+        block = args.overflow == AsyncPoster.BLOCK
+
+        def post_text(text):
+            poster.post(IncomingMessage(username=username, icon_url=icon_url, channel=channel, text=Code(text)))
+
         with poster:
-            for line in sys.stdin:
-                text = Code(line)
-                sys.stdout.write(line)
-                msg = IncomingMessage(username=username, icon_url=icon_url, channel=channel, text=text)
-                poster.post(msg)
-        if all([code == 200 for code in poster.answers_codes]):
-            sys.stderr.write(b"Mattermost server answered OK\n")
-        else:
-            sys.stderr.write(b"One or more requests failed: {}\n".format(b" ".join([str(code) for code in poster.answers_codes])))
-            sys.exit(-1)
+            if args.batch:
+                with LineBatcher(post_text, args.maxbytes, args.maxlines, args.maxlatency) as batcher:
+                    with SideChannel(LineSplitter(batcher.add), args.sidequeue, block) as side:
+                        pump(source, sink, side, args.blocksize)
+                        release(sys.stdout)
+            else:
+                with SideChannel(LineSplitter(post_text), args.sidequeue, block) as side:
+                    pump(source, sink, side, args.blocksize)
+                    release(sys.stdout)
+        if side.dropped:
+            sys.stderr.write("{} bytes were skipped because mattermost could not keep up\n".format(side.dropped))
+        if poster.dropped:
+            sys.stderr.write("{} messages were dropped because the queue was full\n".format(poster.dropped))
+        exit_with_report([poster], lost=side.dropped > 0)
 
     else:
-        buf = sys.stdin.read()
-        sys.stdout.write(buf)
+        # the buffer already bounds the memory: never skip blocks, the omitted bytes are only the ones it discards
+        tail = TailBuffer(args.maxbuffer)
+        with SideChannel(tail, args.sidequeue) as side:
+            pump(source, sink, side, args.blocksize)
+            release(sys.stdout)
+        buf = tail.text()
         now = datetime.datetime.utcnow().strftime('%c')
         text = u"**{} on `{}` wrote:**\n".format(local_username, hostname)
+        if tail.omitted:
+            text += u"_(the first {} bytes were omitted)_\n".format(tail.omitted)
         msg = IncomingMessage(username=username, icon_url=icon_url, channel=channel, text=text)
         att = Attachment(fallback='tee content', text=buf if plain else Code(buf, language))
         att.fields.append(Field('Date', now, True))
@@ -76,13 +276,17 @@ def main():
         att.fields.append(Field('Hostname', hostname, True))
         msg.attachments.append(att)
 
+        if not args.direct and hand_off(url, msg):
+            sys.stderr.write("Message handed to the relay\n")
+            return
+
         try:
-            resp = msg.post(url)
-        except requests.RequestException as ex:
+            post(url, msg)
+        except PostError as ex:
             sys.stderr.write(str(ex) + '\n')
             sys.exit(-1)
         else:
-            sys.stderr.write(b"Mattermost server answered OK\n")
+            sys.stderr.write("Mattermost server answered OK\n")
 
 if __name__ == '__main__':
     main()
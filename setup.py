@@ -7,7 +7,10 @@ import os
 
 on_rtd = os.environ.get('READTHEDOCS', None) == 'True'
 
-requirements = ['future', 'requests', 'tornado']
+requirements = ['future', 'requests', 'tornado', 'futures; python_version < "3"']
+extras_requirements = {
+    'fast': ['orjson']
+}
 setup_requires = ['setuptools_git', 'setuptools', 'twine', 'wheel', 'pip']
 name = 'pymatter'
 version = '0.1'
@@ -34,7 +37,13 @@ classifiers = [
 
 entry_points = {
     'console_scripts': [
-        'pymattertee = pymatter.tee:main'
+        'pymattertee = pymatter.tee:main',
+        'pymattercat = pymatter.cat:main',
+        'pymatterecho = pymatter.echo:main',
+        'pymattertail = pymatter.tail:main',
+        'pymattersmtpd = pymatter.smtpd:main',
+        'pymattermgpoll = pymatter.mgpoll:main',
+        'pymatterrelay = pymatter.relay:main'
     ]
 }
 
@@ -61,6 +70,7 @@ def runsetup():
         setup_requires=setup_requires,
         include_package_data=True,
         install_requires=requirements,
+        extras_require=extras_requirements,
         license=licens,
         zip_safe=False,
         keywords=keywords,
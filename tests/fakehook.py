@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+Incoming webhook stand-in for the tests, running in a background thread.
+"""
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+class FakeHookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.received.append(body)
+            code = server.codes.pop(0) if server.codes else 200
+        server.request_started.set()
+        server.gate.wait()
+        if code == 200:
+            with server.lock:
+                server.bodies.append(body)
+        self.send_response(code)
+        self.send_header('Content-Length', '2')
+        for name, value in server.headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeHook(ThreadingMixIn, HTTPServer):
+    """
+    Answer the POST requests with the statuses of `codes`, then with 200.
+
+    `bodies` holds the bodies of the accepted requests, `received` the bodies of all the requests, `connections` counts
+    the connections. While `gate` is
+    cleared, the requests are held before being answered.
+    """
+    daemon_threads = True
+
+    def __init__(self, codes=None, headers=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeHookHandler)
+        self.codes = list(codes or [])
+        self.headers = headers or {}
+        self.bodies = []
+        self.received = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.request_started = threading.Event()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/hooks/test'.format(self.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.gate.set()
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import unittest
+
+import tornado.gen
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+
+from pymatter.aio import AioPoster, HTTPConnectError, HTTPTimeoutError, make_http_client
+from pymatter.base import IncomingMessage
+from pymatter.ratelimit import RateLimiter
+
+
+class CountingServer(tornado.httpserver.HTTPServer):
+    connections = 0
+
+    def handle_stream(self, stream, address):
+        self.connections += 1
+        return super(CountingServer, self).handle_stream(stream, address)
+
+
+class HookHandler(tornado.web.RequestHandler):
+    @tornado.gen.coroutine
+    def post(self, action):
+        self.application.requests += 1
+        if action == 'slow':
+            yield tornado.gen.sleep(1)
+        if action == 'close':
+            self.set_header('Connection', 'close')
+        if action == 'invalid':
+            self.set_status(400)
+        self.finish(self.request.body)
+
+
+class TestKeepAliveClient(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        app = tornado.web.Application([(r"/hooks/(.*)", HookHandler)])
+        app.requests = 0
+        return app
+
+    def get_http_server(self):
+        return CountingServer(self._app, idle_connection_timeout=0.5, **self.get_httpserver_options())
+
+    def setUp(self):
+        super(TestKeepAliveClient, self).setUp()
+        self.client = make_http_client(2, connect_timeout=1, request_timeout=0.5)
+
+    def tearDown(self):
+        self.client.close()
+        super(TestKeepAliveClient, self).tearDown()
+
+    def post(self, action, body=b'{}'):
+        return self.client.fetch(self.get_url('/hooks/' + action), method='POST', body=body)
+
+    @tornado.testing.gen_test
+    def test_connections_are_reused(self):
+        for i in range(10):
+            resp = yield self.post('ok', b'{"n": %d}' % i)
+            self.assertEqual(resp.body, b'{"n": %d}' % i)
+        yield [self.post('ok') for _ in range(10)]
+        self.assertEqual(self.http_server.connections, 2)
+        self.assertEqual(self.client.connections, 2)
+
+    @tornado.testing.gen_test
+    def test_connection_close(self):
+        for _ in range(3):
+            resp = yield self.post('close')
+            self.assertEqual(resp.code, 200)
+        self.assertEqual(self.http_server.connections, 3)
+
+    @tornado.testing.gen_test
+    def test_closed_idle_connection(self):
+        yield self.post('ok')
+        # the server closes the idle connection
+        yield tornado.gen.sleep(1)
+        resp = yield self.post('ok')
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(self.http_server.connections, 2)
+
+    @tornado.testing.gen_test
+    def test_errors(self):
+        with self.assertRaises(tornado.httpclient.HTTPClientError) as cm:
+            yield self.post('invalid', b'{"text": ""}')
+        self.assertEqual(cm.exception.code, 400)
+        self.assertEqual(cm.exception.response.body, b'{"text": ""}')
+        with self.assertRaises(HTTPTimeoutError):
+            yield self.post('slow')
+        resp = yield self.post('ok')
+        self.assertEqual(resp.code, 200)
+
+    @tornado.testing.gen_test
+    def test_connection_refused(self):
+        sock, port = tornado.testing.bind_unused_port()
+        sock.close()
+        with self.assertRaises(HTTPConnectError):
+            yield self.client.fetch('http://127.0.0.1:{}/hooks/ok'.format(port), method='POST', body=b'{}')
+
+
+class TestAioPoster(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        app = tornado.web.Application([(r"/hooks/(.*)", HookHandler)])
+        app.requests = 0
+        return app
+
+    @tornado.testing.gen_test
+    def test_post(self):
+        poster = AioPoster(self.get_url('/hooks/ok'), concurrency=4, limiter=RateLimiter(None))
+        yield poster.__aenter__()
+        try:
+            responses = yield [poster.post(IncomingMessage(text=str(i))) for i in range(20)]
+        finally:
+            yield poster.__aexit__(None, None, None)
+        self.assertEqual([r.code for r in responses], [200] * 20)
+        self.assertEqual(responses[3].body, b'{"text":"3","username":"pymatter"}')
+
+    @tornado.testing.gen_test
+    def test_timeouts_are_not_retried(self):
+        poster = AioPoster(self.get_url('/hooks/slow'), max_retries=3, request_timeout=0.2, limiter=RateLimiter(None))
+        with self.assertRaises(HTTPTimeoutError):
+            yield poster.post(IncomingMessage(text='hello'))
+        yield poster.close()
+        self.assertEqual(self._app.requests, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
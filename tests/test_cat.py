@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import argparse
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from pymatter.cat import iter_chunks, post_chunks
+
+from .fakehook import FakeHook
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestErrors(unittest.TestCase):
+    def run_tool(self, module, *args):
+        env = dict(os.environ)
+        env.pop('MM_HOOK', None)
+        process = subprocess.Popen([sys.executable, '-m', module] + list(args), cwd=ROOT, env=env,
+                                   stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = process.communicate(b'')
+        return process.returncode, err.decode('utf-8')
+
+    def test_missing_file(self):
+        code, err = self.run_tool('pymatter.cat', '-m', 'http://127.0.0.1:1/hooks/test', 'nonexistent.txt')
+        self.assertNotEqual(code, 0)
+        self.assertEqual(err, "'nonexistent.txt' does not exist\n")
+
+    def test_missing_url(self):
+        for command in (['pymatter.cat', 'README.rst'], ['pymatter.tee']):
+            code, err = self.run_tool(*command)
+            self.assertNotEqual(code, 0)
+            self.assertEqual(err, "No Mattermost URL was provided\n")
+
+
+class TestChunks(unittest.TestCase):
+    def test_iter_chunks(self):
+        text = ''.join('line {}\n'.format(i) for i in range(100)) + 'no new line'
+        chunks = list(iter_chunks(io.StringIO(text), 50))
+        self.assertTrue(all(len(c.encode('utf-8')) <= 50 and c.endswith('\n') for c in chunks))
+        self.assertEqual(''.join(chunks), text + '\n')
+
+    def test_long_line(self):
+        chunks = list(iter_chunks(io.StringIO('é' * 100), 21))
+        self.assertTrue(all(len(c.encode('utf-8')) <= 21 for c in chunks))
+        self.assertEqual(''.join(c[:-1] for c in chunks), 'é' * 100)
+
+    def test_parts_are_posted_in_order(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        files = []
+        for name in ('a.txt', 'b.txt'):
+            files.append(os.path.join(directory, name))
+            with io.open(files[-1], 'w', encoding='utf-8') as handle:
+                handle.write(''.join('{} {}\n'.format(name, i) for i in range(2000)))
+        args = argparse.Namespace(files=files, chunksize=500, plain=True, language='detect', workers=4)
+        with FakeHook() as hook:
+            posters = post_chunks(hook.url, args, {}, [])
+        self.assertTrue(all(poster.all_sent for poster in posters))
+        parts = {}
+        for body in hook.bodies:
+            fields = {f['title']: f['value'] for f in json.loads(body.decode('utf-8'))['attachments'][0]['fields']}
+            parts.setdefault(fields['File name'], []).append(int(fields['Part']))
+        self.assertEqual(sorted(parts), ['a.txt', 'b.txt'])
+        for numbers in parts.values():
+            self.assertGreater(len(numbers), 10)
+            self.assertEqual(numbers, list(range(1, len(numbers) + 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import unittest
+
+from pymatter.base import IncomingMessage, Attachment
+from pymatter.dedup import DedupCache, summary_message
+
+
+class TestDedupCache(unittest.TestCase):
+    def test_duplicates_are_suppressed(self):
+        cache = DedupCache(ttl=60)
+        self.assertFalse(cache.seen(IncomingMessage(text='hello'), 'a'))
+        self.assertTrue(cache.seen(IncomingMessage(text='hello'), 'a'))
+        self.assertFalse(cache.seen(IncomingMessage(text='hello'), 'b'))
+        self.assertEqual(cache.suppressed, 1)
+
+    def test_summary(self):
+        cache = DedupCache(ttl=60)
+        for _ in range(3):
+            cache.seen(IncomingMessage(text='hello', channel='town-square'), 'a')
+        summaries = cache.expire(everything=True)
+        self.assertEqual(len(summaries), 1)
+        scope, message = summaries[0]
+        self.assertEqual(scope, 'a')
+        self.assertEqual(message.channel, 'town-square')
+        self.assertIn('2 duplicates', message.text)
+
+    def test_summary_without_text(self):
+        message = summary_message(IncomingMessage(text=None), 1)
+        self.assertIn('1 duplicate', message.text)
+        message = summary_message(IncomingMessage(text=None, attachments=[Attachment(text='x', fallback=None)]), 1)
+        self.assertIn('1 duplicate', message.text)
+        message = summary_message(IncomingMessage(text=None, attachments=[Attachment(fallback='x' * 300)]), 1)
+        self.assertTrue(message.text.endswith('x' * 200 + '…'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import unittest
+
+from pymatter.base import FanoutPoster, Destination, IncomingMessage, Attachment
+
+from .fakehook import FakeHook
+
+
+class TestFanoutPoster(unittest.TestCase):
+    def test_overrides(self):
+        with FakeHook() as first, FakeHook() as second:
+            destinations = [first.url, Destination(second.url, channel='ops', username='bot')]
+            with FanoutPoster(destinations) as poster:
+                message = IncomingMessage(text='hello', channel='town-square', attachments=[Attachment(text='a')])
+                deliveries = poster.post(message)
+                self.assertEqual([d.result(5) for d in deliveries], [200, 200])
+            self.assertTrue(poster.all_sent)
+            self.assertEqual(first.bodies, [message.dumpb()])
+            posted = json.loads(second.bodies[0].decode('utf-8'))
+            self.assertEqual(posted['channel'], 'ops')
+            self.assertEqual(posted['username'], 'bot')
+            self.assertEqual(posted['attachments'], [{'text': 'a'}])
+
+    def test_attachments_are_serialized_once(self):
+        calls = []
+        to_dict = Attachment.to_dict
+
+        def counting_to_dict(attachment):
+            calls.append(attachment)
+            return to_dict(attachment)
+
+        Attachment.to_dict = counting_to_dict
+        self.addCleanup(setattr, Attachment, 'to_dict', to_dict)
+        message = IncomingMessage(text='hello', attachments=[Attachment(text='a'), Attachment(text='b')])
+        bodies = [message.dumpb(), message.dumpb_with(channel='ops'), message.dumpb_with(username='bot', text='')]
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(json.loads(bodies[0].decode('utf-8')), message.to_dict())
+        self.assertEqual(json.loads(bodies[2].decode('utf-8')), {'username': 'bot',
+                                                                 'attachments': [{'text': 'a'}, {'text': 'b'}]})
+        del calls[:]
+        message.attachments[1].text = 'c'
+        self.assertIn(b'"text":"c"', message.dumpb_with(channel='ops'))
+        self.assertEqual(calls, [message.attachments[1]])
+
+    def test_connections_are_reused_across_hosts(self):
+        with FakeHook() as first, FakeHook() as second:
+            with FanoutPoster([first.url, second.url], workers=2) as poster:
+                for i in range(10):
+                    for delivery in poster.post(IncomingMessage(text=str(i))):
+                        delivery.result(5)
+            self.assertEqual(len(first.bodies), 10)
+            self.assertEqual(len(second.bodies), 10)
+            self.assertLessEqual(first.connections, 2)
+            self.assertLessEqual(second.connections, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
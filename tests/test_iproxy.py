@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+try:
+    from ConfigParser import SafeConfigParser
+except ImportError:
+    from configparser import ConfigParser as SafeConfigParser
+
+import tornado.gen
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+
+from pymatter import iproxy
+from pymatter.spool import Spool
+
+
+class UpstreamHandler(tornado.web.RequestHandler):
+    def post(self, path):
+        self.application.bodies.append(self.request.body)
+        self.finish("ok")
+
+
+class ProxyTestCase(tornado.testing.AsyncHTTPTestCase):
+    """
+    Run the proxy in front of a local upstream server that records the bodies it receives.
+    """
+    options = {}
+
+    def get_app(self):
+        self.upstream = tornado.web.Application([(r"/hooks/(.*)", UpstreamHandler)])
+        self.upstream.bodies = []
+        sock, port = tornado.testing.bind_unused_port()
+        self.upstream_server = tornado.httpserver.HTTPServer(self.upstream)
+        self.upstream_server.add_sockets([sock])
+
+        config = SafeConfigParser(iproxy.defaults)
+        config.add_section('proxy')
+        config.add_section('mattermost')
+        config.set('mattermost', 'url', 'http://127.0.0.1:{}/hooks'.format(port))
+        config.set('mattermost', 'default_hook', 'default')
+        for section, values in self.options.items():
+            if not config.has_section(section):
+                config.add_section(section)
+            for name, value in values.items():
+                config.set(section, name, value)
+        app = iproxy.make_application(config)
+        iproxy.start_dedup(app)
+        return app
+
+    def tearDown(self):
+        self.upstream_server.stop()
+        self._app.upstreams.close()
+        super(ProxyTestCase, self).tearDown()
+
+    def post(self, body, path='/hook', content_type='application/json'):
+        return self.fetch(path, method='POST', body=body, headers={'Content-Type': content_type})
+
+
+class TestForward(ProxyTestCase):
+    def test_upstream_connections_are_reused(self):
+        for i in range(10):
+            resp = self.post(b'{"text": "%d"}' % i)
+            self.assertEqual(resp.code, 200)
+            self.assertEqual(resp.body, b'ok')
+        self.assertEqual(len(self.upstream.bodies), 10)
+        stats = json.loads(self.fetch('/status').body.decode('utf-8'))['upstreams']
+        self.assertEqual(len(stats), 1)
+        stats = list(stats.values())[0]
+        self.assertEqual(stats['requests'], 10)
+        self.assertEqual(stats['connections'], 1)
+        self.assertIn('pymatter_upstream_connections_total', self.fetch('/metrics').body.decode('utf-8'))
+
+
+class TestFullValidation(ProxyTestCase):
+    options = {'proxy': {'validation': 'full'}}
+
+    def test_json_is_encoded_again(self):
+        self.assertEqual(self.post(b'{"text": "hello",  "channel": "ops"}').code, 200)
+        self.assertEqual(self.upstream.bodies, [b'{"text":"hello","channel":"ops"}'])
+
+    def test_invalid_json(self):
+        for body in (b'{"text": ', b'{oops}', b'not json'):
+            self.assertEqual(self.post(body).code, 400)
+        self.assertEqual(self.upstream.bodies, [])
+
+    def test_form_payload(self):
+        resp = self.post(b'payload=%7B%22text%22%3A+%22hello%22%7D', content_type='application/x-www-form-urlencoded')
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(self.upstream.bodies, [b'{"text":"hello"}'])
+        resp = self.post(b'other=1', content_type='application/x-www-form-urlencoded')
+        self.assertEqual(resp.code, 400)
+
+
+class TestStructuralValidation(ProxyTestCase):
+    options = {'proxy': {'validation': 'structural'}}
+
+    def test_body_is_forwarded_unchanged(self):
+        self.assertEqual(self.post(b' {"text": "hello",  "channel": "ops"}\n').code, 200)
+        self.assertEqual(self.upstream.bodies, [b' {"text": "hello",  "channel": "ops"}\n'])
+
+    def test_not_an_object(self):
+        for body in (b'{"text": ', b'["text"]', b'', b'"text"'):
+            self.assertEqual(self.post(body).code, 400)
+        self.assertEqual(self.upstream.bodies, [])
+
+    def test_only_the_braces_are_checked(self):
+        self.assertEqual(self.post(b'{oops}').code, 200)
+        self.assertEqual(self.upstream.bodies, [b'{oops}'])
+
+
+class TestNoValidation(ProxyTestCase):
+    options = {'proxy': {'validation': 'none'}}
+
+    def test_body_is_forwarded_as_is(self):
+        self.assertEqual(self.post(b'not json').code, 200)
+        self.assertEqual(self.upstream.bodies, [b'not json'])
+
+    def test_form_payload_is_still_decoded(self):
+        resp = self.post(b'payload=not+json', content_type='application/x-www-form-urlencoded')
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(self.upstream.bodies, [])
+
+
+class TestValidationMode(unittest.TestCase):
+    def test_unknown_mode(self):
+        config = SafeConfigParser(iproxy.defaults)
+        config.add_section('proxy')
+        config.add_section('mattermost')
+        config.set('mattermost', 'url', 'http://127.0.0.1/hooks')
+        config.set('mattermost', 'default_hook', 'default')
+        config.set('proxy', 'validation', 'strict')
+        self.assertRaises(ValueError, iproxy.make_application, config)
+
+
+class TestAggregate(ProxyTestCase):
+    options = {'aggregate': {'window_ms': '100', 'max_messages': '3', 'max_bytes': '1000'}}
+
+    def post_all(self, bodies):
+        """
+        Post `bodies` at the same time and return the responses.
+        """
+        @tornado.gen.coroutine
+        def post_all():
+            responses = yield [self.http_client.fetch(
+                self.get_url('/hook'), method='POST', body=body, headers={'Content-Type': 'application/json'},
+                raise_error=False
+            ) for body in bodies]
+            raise tornado.gen.Return(responses)
+        return self.io_loop.run_sync(post_all, timeout=5)
+
+    def test_messages_are_merged(self):
+        responses = self.post_all([b'{"text": "a"}', b'{"text": "b", "attachments": [{"text": "c"}]}'])
+        self.assertEqual([r.code for r in responses], [200, 200])
+        self.assertEqual([json.loads(b.decode('utf-8')) for b in self.upstream.bodies],
+                         [{'text': 'a\nb', 'attachments': [{'text': 'c'}]}])
+
+    def test_latency_flush(self):
+        self.assertEqual(self.post(b'{"text": "a"}').code, 200)
+        self.assertEqual(self.upstream.bodies, [b'{"text":"a"}'])
+
+    def test_count_flush(self):
+        self._app.aggregator.window = 30
+        responses = self.post_all([b'{"text": "%d"}' % i for i in range(3)])
+        self.assertEqual([r.code for r in responses], [200, 200, 200])
+        self.assertEqual(self.upstream.bodies, [b'{"text":"0\\n1\\n2"}'])
+
+    def test_size_flush(self):
+        self._app.aggregator.max_bytes = 30
+        responses = self.post_all([b'{"text": "first message"}', b'{"text": "second message"}'])
+        self.assertEqual([r.code for r in responses], [200, 200])
+        self.assertEqual(self.upstream.bodies, [b'{"text":"first message"}', b'{"text":"second message"}'])
+
+    def test_invalid_messages(self):
+        responses = self.post_all([b'{"text": "a", "attachments": "oops"}', b'{"text": "b"}', b'{"text": 5}'])
+        self.assertEqual([r.code for r in responses], [400, 200, 200])
+        self.assertEqual(self.upstream.bodies, [b'{"text":"b\\n5"}'])
+        self.assertEqual(self._app.in_flight, 0)
+
+    def test_merge_error(self):
+        aggregator = self._app.aggregator
+
+        @tornado.gen.coroutine
+        def add_all():
+            futures = [aggregator.add(self._app.mm_default_hook, message, 10) for message in ({'text': 'a'},
+                                                                                            {'text': 5})]
+            aggregator.flush_all()
+            for future in futures:
+                with self.assertRaises(TypeError):
+                    yield future
+        self.io_loop.run_sync(add_all, timeout=5)
+        self.assertEqual(self.upstream.bodies, [])
+
+
+class TestDedup(ProxyTestCase):
+    options = {'dedup': {'ttl': '60', 'summary': 'false'}}
+
+    def test_duplicates_are_not_forwarded(self):
+        for _ in range(3):
+            self.assertEqual(self.post(b'{"text": "hello"}').code, 200)
+        self.assertEqual(len(self.upstream.bodies), 1)
+
+    def test_invalid_message(self):
+        resp = self.post(b'{"attachments": ["oops"]}')
+        self.assertEqual(resp.code, 400)
+        self.assertEqual(self.upstream.bodies, [])
+
+
+class TestWorkerMetrics(ProxyTestCase):
+    """
+    The proxy runs as worker 0, and worker 1 already published its metrics.
+    """
+    def get_app(self):
+        app = super(TestWorkerMetrics, self).get_app()
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'worker-1'), 'wb') as f:
+            f.write(b'# HELP pymatter_proxy_requests_total Requests answered by the proxy\n'
+                    b'# TYPE pymatter_proxy_requests_total counter\n'
+                    b'pymatter_proxy_requests_total{code="200"} 5\n')
+        iproxy.share_metrics(app, self.directory, 0)
+        return app
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestWorkerMetrics, self).tearDown()
+
+    def test_metrics_are_summed(self):
+        self.assertEqual(self.post(b'{"text": "hello"}').code, 200)
+        lines = self.fetch('/metrics').body.decode('utf-8').splitlines()
+        self.assertIn('pymatter_proxy_requests_total{code="200"} 6', lines)
+        self.assertEqual(lines.count('# TYPE pymatter_proxy_requests_total counter'), 1)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['worker-0', 'worker-1'])
+
+
+class TestSpool(ProxyTestCase):
+    """
+    The proxy runs as worker 0 of 2, and a previous run with 3 workers left messages in the spool of worker 2.
+    """
+    def get_app(self):
+        app = super(TestSpool, self).get_app()
+        self.directory = tempfile.mkdtemp()
+        leftover = Spool(os.path.join(self.directory, 'worker-2'))
+        leftover.append(app.mm_default_hook.encode('utf-8') + b'\n{"text":"leftover"}')
+        leftover.close()
+        app.raw_config.add_section('spool')
+        app.raw_config.set('spool', 'directory', self.directory)
+        app.raw_config.set('spool', 'sync_interval', '0.05')
+        iproxy.open_spool(app, 0, 2)
+        return app
+
+    def tearDown(self):
+        spool, self._app.spool = self._app.spool, None
+        spool.close()
+        shutil.rmtree(self.directory)
+        super(TestSpool, self).tearDown()
+
+    def wait_for_bodies(self, count):
+        @tornado.gen.coroutine
+        def wait():
+            while len(self.upstream.bodies) < count:
+                yield tornado.gen.sleep(0.01)
+        self.io_loop.run_sync(wait, timeout=5)
+
+    def test_leftover_spools_are_adopted(self):
+        self.assertEqual(sorted(os.listdir(self.directory)), ['worker-0'])
+        self.assertEqual(self.post(b'{"text": "new"}').code, 202)
+        self.wait_for_bodies(2)
+        self.assertEqual(self.upstream.bodies, [b'{"text":"leftover"}', b'{"text":"new"}'])
+
+
+if __name__ == '__main__':
+    unittest.main()
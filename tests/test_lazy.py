@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import subprocess
+import sys
+import threading
+import unittest
+
+from pymatter.lazy import LazyModule, lazy_import
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestLazyImport(unittest.TestCase):
+    def setUp(self):
+        # a module nothing else imports
+        self.saved = sys.modules.pop('colorsys', None)
+        self.addCleanup(self.restore)
+
+    def restore(self):
+        sys.modules.pop('colorsys', None)
+        if self.saved is not None:
+            sys.modules['colorsys'] = self.saved
+
+    def test_imported_on_first_use(self):
+        colorsys = lazy_import('colorsys')
+        self.assertIsInstance(colorsys, LazyModule)
+        self.assertNotIn('colorsys', sys.modules)
+        self.assertEqual(colorsys.rgb_to_hsv(1.0, 0.0, 0.0), (0.0, 1.0, 1.0))
+        self.assertIn('colorsys', sys.modules)
+        self.assertIs(colorsys.rgb_to_hsv, sys.modules['colorsys'].rgb_to_hsv)
+
+    def test_already_imported(self):
+        self.assertIs(lazy_import('os'), os)
+
+    def test_first_use_in_threads(self):
+        colorsys = lazy_import('colorsys')
+        start = threading.Event()
+        results = []
+
+        def use():
+            start.wait()
+            try:
+                results.append(colorsys.hsv_to_rgb(0.0, 0.0, 1.0))
+            except Exception as ex:
+                results.append(ex)
+
+        threads = [threading.Thread(target=use) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, [(1.0, 1.0, 1.0)] * 16)
+
+    def test_requests_is_not_imported_by_the_model(self):
+        code = "import sys, pymatter.base; pymatter.base.IncomingMessage(text='x').dumpb(); " \
+               "sys.exit('requests' in sys.modules)"
+        self.assertEqual(subprocess.call([sys.executable, '-c', code], cwd=ROOT), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import unittest
+
+from pymatter.metrics import Registry, merge_renderings
+
+
+def make_registry(requests, seconds):
+    registry = Registry()
+    counter = registry.counter('requests_total', 'Requests', ('code',))
+    for code, count in requests.items():
+        counter.inc(count, code=code)
+    histogram = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    for value in seconds:
+        histogram.observe(value)
+    registry.gauge('in_flight', 'In flight', function=lambda: 2)
+    return registry
+
+
+class TestMerge(unittest.TestCase):
+    def test_series_are_added(self):
+        first = make_registry({'200': 3}, [0.05, 0.5]).render()
+        second = make_registry({'200': 1, '502': 2}, [5.0]).render()
+        merged = merge_renderings([first, second])
+        lines = merged.splitlines()
+        self.assertEqual(lines.count('# HELP requests_total Requests'), 1)
+        self.assertIn('requests_total{code="200"} 4', lines)
+        self.assertIn('requests_total{code="502"} 2', lines)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('latency_seconds_count 3', lines)
+        self.assertIn('latency_seconds_sum 5.55', lines)
+        self.assertIn('in_flight 4', lines)
+        # the series of a family follow its header
+        self.assertLess(lines.index('# TYPE requests_total counter'), lines.index('requests_total{code="502"} 2'))
+        self.assertLess(lines.index('requests_total{code="502"} 2'), lines.index('# HELP latency_seconds Latency'))
+
+    def test_single_rendering(self):
+        text = make_registry({'200': 3}, [0.05]).render()
+        self.assertEqual(merge_renderings([text]), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import requests
+
+from pymatter.base import AsyncPoster
+from pymatter.mgpoll import MailgunClient, Cursor, Poller
+
+from .fakehook import FakeHook
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeMailgun(object):
+    """
+    benchmarks/fakemailgun.py running in a subprocess.
+    """
+    def __init__(self, events, overlap=0):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'benchmarks', 'fakemailgun.py'), '--events', str(events),
+             '--overlap', str(overlap)],
+            stdout=subprocess.PIPE
+        )
+        self.api_url = self.process.stdout.readline().decode('utf-8').strip()
+        self.root = self.api_url.rsplit('/', 1)[0]
+
+    def add(self, number):
+        requests.post('{}/add'.format(self.root), params={'n': number}).raise_for_status()
+
+    def stats(self):
+        return requests.get('{}/stats'.format(self.root)).json()
+
+    def stop(self):
+        self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+class PollerTestCase(unittest.TestCase):
+    events = 25
+    overlap = 0
+
+    def setUp(self):
+        self.mailgun = FakeMailgun(self.events, self.overlap)
+        self.addCleanup(self.mailgun.stop)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cursor_file = os.path.join(self.directory, 'mailgun.cursor')
+
+    def poll(self, hook, client=None, retries=0):
+        """
+        Poll once with a new client, cursor and poster, as a restarted pymattermgpoll would.
+        """
+        client = client or MailgunClient(self.mailgun.api_url, 'mg.example.org', 'key', workers=4)
+        cursor = Cursor(self.cursor_file)
+        with AsyncPoster(hook.url, max_retries=0) as poster:
+            poller = Poller(client, cursor, poster, {'username': 'mailgun'}, workers=4, page_size=10,
+                            retries=retries)
+            try:
+                forwarded = poller.poll()
+            finally:
+                poller.close()
+                client.close()
+        return forwarded, poller
+
+    def subjects(self, hook):
+        return [json.loads(body.decode('utf-8'))['attachments'][0]['title'] for body in hook.bodies]
+
+
+class TestPoller(PollerTestCase):
+    def test_pages(self):
+        with FakeHook() as hook:
+            forwarded, poller = self.poll(hook)
+        self.assertEqual(forwarded, 25)
+        self.assertEqual(poller.failed, 0)
+        self.assertEqual(sorted(self.subjects(hook)), sorted('mail {}'.format(i) for i in range(25)))
+        stats = self.mailgun.stats()
+        # three pages of events, then an empty one
+        self.assertEqual(stats['pages'], 4)
+        self.assertEqual(stats['duplicates'], 0)
+
+    def test_cursor_file(self):
+        with FakeHook() as hook:
+            self.poll(hook)
+        with open(self.cursor_file) as f:
+            data = json.load(f)
+        self.assertTrue('/events/25?' in data['next'])
+        self.assertEqual(sorted(data['seen']), sorted('event-{}'.format(i) for i in range(25)))
+
+    def test_resume_after_restart(self):
+        with FakeHook() as hook:
+            self.assertEqual(self.poll(hook)[0], 25)
+            self.mailgun.add(5)
+            forwarded, _ = self.poll(hook)
+            self.assertEqual(forwarded, 5)
+            self.assertEqual(self.poll(hook)[0], 0)
+        self.assertEqual(len(hook.bodies), 30)
+        self.assertEqual(sorted(self.subjects(hook)[25:]), sorted('mail {}'.format(i) for i in range(25, 30)))
+        self.assertEqual(self.mailgun.stats()['duplicates'], 0)
+
+    def test_failed_mails_are_counted(self):
+        with FakeHook(codes=[500]) as hook:
+            forwarded, poller = self.poll(hook)
+            self.assertEqual(forwarded, 24)
+            self.assertEqual(poller.failed, 1)
+        # the cursor moved past the pages anyway: the failed mail is reported, not retried forever
+        self.assertTrue('/events/25?' in Cursor(self.cursor_file).next)
+
+
+class FlakyClient(MailgunClient):
+    """
+    Client failing to fetch the stored messages of `errors` (key: list of the status codes of the failures, -1 for
+    a connection error).
+    """
+    def __init__(self, api_url, errors):
+        super(FlakyClient, self).__init__(api_url, 'mg.example.org', 'key', workers=4)
+        self.errors = errors
+
+    def stored(self, url):
+        failures = self.errors.get(url.rsplit('/', 1)[1])
+        if failures:
+            status = failures.pop(0)
+            if status == -1:
+                raise requests.ConnectionError('connection reset')
+            response = requests.Response()
+            response.status_code = status
+            raise requests.HTTPError('{} error'.format(status), response=response)
+        return super(FlakyClient, self).stored(url)
+
+
+class TestFetchErrors(PollerTestCase):
+    def test_transient_errors_are_retried(self):
+        client = FlakyClient(self.mailgun.api_url, {'key3': [-1], 'key12': [503]})
+        with FakeHook() as hook:
+            forwarded, _ = self.poll(hook, client, retries=1)
+        self.assertEqual(forwarded, 25)
+
+    def test_failed_fetch_stops_the_cursor(self):
+        client = FlakyClient(self.mailgun.api_url, {'key13': [-1, 503]})
+        with FakeHook() as hook:
+            forwarded, _ = self.poll(hook, client, retries=1)
+            # the first page, and the second one but its mail 13
+            self.assertEqual(forwarded, 19)
+            cursor = Cursor(self.cursor_file)
+            self.assertIn('/events/10?', cursor.next)
+            self.assertNotIn('event-13', cursor)
+            self.assertIn('event-14', cursor)
+            forwarded, _ = self.poll(hook)
+            self.assertEqual(forwarded, 6)
+        subjects = self.subjects(hook)
+        self.assertEqual(sorted(subjects), sorted('mail {}'.format(i) for i in range(25)))
+
+    def test_expired_messages_are_skipped(self):
+        client = FlakyClient(self.mailgun.api_url, {'key3': [404]})
+        with FakeHook() as hook:
+            forwarded, _ = self.poll(hook, client, retries=3)
+        self.assertEqual(forwarded, 24)
+        self.assertIn('/events/25?', Cursor(self.cursor_file).next)
+
+
+class TestOverlappingPages(PollerTestCase):
+    overlap = 3
+
+    def test_events_are_read_once(self):
+        with FakeHook() as hook:
+            forwarded, _ = self.poll(hook)
+        self.assertEqual(forwarded, 25)
+        subjects = self.subjects(hook)
+        self.assertEqual(len(subjects), len(set(subjects)))
+        self.assertEqual(len(subjects), 25)
+        self.assertEqual(self.mailgun.stats()['duplicates'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import unittest
+
+from pymatter.base import IncomingMessage, Attachment, Field
+
+
+class TestModel(unittest.TestCase):
+    def test_mutations_are_serialized(self):
+        msg = IncomingMessage(text='hello')
+        self.assertEqual(json.loads(msg.dumpb().decode('utf-8')), {'text': 'hello', 'username': 'pymatter'})
+        msg.text = 'bye'
+        msg.attachments.append(Attachment(text='details', fields=[Field('Host', 'a')]))
+        self.assertEqual(json.loads(msg.dumpb().decode('utf-8'))['text'], 'bye')
+        msg.attachments[0].fields[0].value = 'b'
+        msg.attachments[0].fields.append(Field('Date', 'today', True))
+        d = json.loads(msg.dumps())
+        self.assertEqual(d['attachments'][0]['fields'], [
+            {'title': 'Host', 'value': 'b', 'short': False}, {'title': 'Date', 'value': 'today', 'short': True}
+        ])
+        del msg.attachments[:]
+        self.assertNotIn('attachments', json.loads(msg.dumps()))
+
+    def test_serialization_is_cached(self):
+        msg = IncomingMessage(text='hello', attachments=[Attachment(text='details', fields=[Field('Host', 'a')])])
+        data = msg.dumpb()
+        self.assertIs(msg.dumpb(), data)
+        field = msg.attachments[0].fields[0]
+        field.value = 'b'
+        self.assertIn(b'"value":"b"', msg.dumpb())
+        msg.attachments[0].fields.insert(0, Field('Date', 'today'))
+        self.assertIn(b'"title":"Date"', msg.dumpb())
+        msg.attachments[0].fields.sort(key=lambda f: f.title, reverse=True)
+        self.assertLess(msg.dumpb().index(b'Host'), msg.dumpb().index(b'Date'))
+        msg.attachments = [{'text': 'other'}]
+        self.assertNotIn(b'details', msg.dumpb())
+        msg.attachments[0] = Attachment(text='replaced')
+        self.assertIn(b'replaced', msg.dumpb())
+        msg.channel = 'ops'
+        data = msg.dumpb()
+        self.assertIn(b'"channel":"ops"', data)
+        self.assertIs(msg.dumpb(), data)
+
+    def test_short_is_a_bool(self):
+        field = Field('Host', 'a', 'yes')
+        self.assertIs(field.short, True)
+        field.short = 0
+        self.assertIs(field.short, False)
+        self.assertEqual(field.to_dict(), {'title': 'Host', 'value': 'a', 'short': False})
+        self.assertIs(Field.from_trusted_dict({'title': 'Host', 'short': 1}).short, True)
+
+    def test_dumpb_with(self):
+        msg = IncomingMessage(text='hello', channel='ops', attachments=[Attachment(text='details')])
+        d = json.loads(msg.dumpb_with(channel='dev', username=b'bot').decode('utf-8'))
+        self.assertEqual(d, {'text': 'hello', 'username': 'bot', 'channel': 'dev',
+                             'attachments': [{'text': 'details'}]})
+        self.assertEqual(msg.channel, 'ops')
+        self.assertRaises(ValueError, msg.dumpb_with, color='red')
+
+    def test_trusted_dict(self):
+        text = '{"text": "hello", "attachments": [{"title": "t", "fields": [{"title": "a", "value": "b"}]}]}'
+        self.assertEqual(IncomingMessage.loads(text, validate=False).to_dict(), IncomingMessage.loads(text).to_dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
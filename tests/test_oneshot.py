@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import socket
+import unittest
+
+from pymatter.base import IncomingMessage
+from pymatter.oneshot import post, PostError
+
+from .fakehook import FakeHook
+
+
+class TestPost(unittest.TestCase):
+    def test_post(self):
+        with FakeHook() as hook:
+            self.assertEqual(post(hook.url, IncomingMessage(text='hello')), 200)
+            self.assertEqual(post(hook.url, b'{"text":"raw"}'), 200)
+        self.assertEqual(hook.bodies, [b'{"text":"hello","username":"pymatter"}', b'{"text":"raw"}'])
+
+    def test_retried_answers(self):
+        with FakeHook(codes=[503]) as hook:
+            self.assertEqual(post(hook.url, b'{"text":"hello"}', max_retries=1), 200)
+        self.assertEqual(len(hook.received), 2)
+
+    def test_client_error(self):
+        with FakeHook(codes=[400]) as hook:
+            with self.assertRaises(PostError) as cm:
+                post(hook.url, b'{"text":"hello"}', max_retries=2)
+        self.assertEqual(cm.exception.status, 400)
+        self.assertEqual(len(hook.received), 1)
+
+    def test_connection_refused(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        with self.assertRaises(PostError) as cm:
+            post('http://127.0.0.1:{}/hooks/test'.format(port), b'{"text":"hello"}', max_retries=1)
+        self.assertEqual(cm.exception.status, -1)
+
+    def test_read_timeout_is_not_retried(self):
+        with FakeHook() as hook:
+            hook.gate.clear()
+            with self.assertRaises(PostError) as cm:
+                post(hook.url, b'{"text":"hello"}', max_retries=2, timeout=0.2)
+            self.assertEqual(cm.exception.status, -1)
+            # the server may have received the message: posting it again could duplicate it
+            self.assertEqual(len(hook.received), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+import time
+import unittest
+from queue import Full
+
+from pymatter.base import AsyncPoster, Delivery, IncomingMessage, LineBatcher
+
+from .fakehook import FakeHook
+
+
+class TestDelivery(unittest.TestCase):
+    def test_result(self):
+        delivery = Delivery(IncomingMessage(text='hello'), threading.Condition())
+        self.assertFalse(delivery.done())
+        threading.Timer(0.05, delivery.resolve, (200,)).start()
+        self.assertEqual(delivery.result(timeout=5), 200)
+        self.assertTrue(delivery.done())
+        self.assertTrue(delivery.ok)
+
+    def test_result_timeout(self):
+        from concurrent.futures import TimeoutError
+        delivery = Delivery(IncomingMessage(text='hello'), threading.Condition())
+        self.assertRaises(TimeoutError, delivery.result, 0.01)
+
+    def test_result_error(self):
+        delivery = Delivery(IncomingMessage(text='hello'), threading.Condition())
+        delivery.resolve(-1, IOError('unreachable'))
+        self.assertRaises(IOError, delivery.result)
+        self.assertEqual(delivery.status, -1)
+
+    def test_callbacks(self):
+        delivery = Delivery(IncomingMessage(text='hello'), threading.Condition())
+        called = []
+        delivery.add_done_callback(called.append)
+        self.assertEqual(called, [])
+        delivery.resolve(200)
+        self.assertEqual(called, [delivery])
+        # already done: called now
+        delivery.add_done_callback(called.append)
+        self.assertEqual(called, [delivery, delivery])
+
+    def test_failing_callback(self):
+        delivery = Delivery(IncomingMessage(text='hello'), threading.Condition())
+        called = []
+
+        def fail(d):
+            raise RuntimeError('callback failed')
+
+        delivery.add_done_callback(fail)
+        delivery.add_done_callback(called.append)
+        delivery.resolve(200)
+        self.assertEqual(called, [delivery])
+        delivery.add_done_callback(fail)
+
+    def test_failing_callback_does_not_stop_the_poster(self):
+        with FakeHook() as hook:
+            with AsyncPoster(hook.url, max_retries=0) as poster:
+                first = poster.post(IncomingMessage(text='first'))
+                first.add_done_callback(lambda d: 1 / 0)
+                first.result(5)
+                second = poster.post(IncomingMessage(text='second'))
+                self.assertEqual(second.result(5), 200)
+            self.assertEqual(poster.sent, 2)
+
+
+class TestOverflow(unittest.TestCase):
+    """
+    One worker is held by the server while three messages are posted to a queue of two.
+    """
+    def post_while_held(self, hook, poster):
+        hook.gate.clear()
+        first = poster.post(IncomingMessage(text='0'))
+        self.assertTrue(hook.request_started.wait(5))
+        return [first] + [poster.post(IncomingMessage(text=str(i))) for i in range(1, 4)]
+
+    def test_policies(self):
+        self.assertRaises(ValueError, AsyncPoster, 'http://127.0.0.1/hooks/test', overflow='drop')
+
+    def test_drop_newest(self):
+        with FakeHook() as hook:
+            with AsyncPoster(hook.url, queue_size=2, overflow=AsyncPoster.DROP_NEWEST, max_retries=0) as poster:
+                deliveries = self.post_while_held(hook, poster)
+                self.assertTrue(deliveries[3].done())
+                self.assertIsInstance(deliveries[3].error, Full)
+                hook.gate.set()
+            self.assertEqual([d.status for d in deliveries[:3]], [200, 200, 200])
+            self.assertEqual(poster.dropped, 1)
+            self.assertFalse(poster.all_sent)
+            self.assertEqual(hook.bodies, [b'{"text":"0","username":"pymatter"}',
+                                           b'{"text":"1","username":"pymatter"}',
+                                           b'{"text":"2","username":"pymatter"}'])
+
+    def test_drop_oldest(self):
+        with FakeHook() as hook:
+            with AsyncPoster(hook.url, queue_size=2, overflow=AsyncPoster.DROP_OLDEST, max_retries=0) as poster:
+                deliveries = self.post_while_held(hook, poster)
+                self.assertTrue(deliveries[1].done())
+                self.assertIsInstance(deliveries[1].error, Full)
+                hook.gate.set()
+            self.assertEqual([deliveries[i].status for i in (0, 2, 3)], [200, 200, 200])
+            self.assertEqual(poster.dropped, 1)
+            self.assertEqual(len(hook.bodies), 3)
+            self.assertNotIn(b'"text":"1"', b''.join(hook.bodies))
+
+    def test_block(self):
+        with FakeHook() as hook:
+            with AsyncPoster(hook.url, queue_size=2, overflow=AsyncPoster.BLOCK, max_retries=0) as poster:
+                hook.gate.clear()
+                poster.post(IncomingMessage(text='0'))
+                self.assertTrue(hook.request_started.wait(5))
+                poster.post(IncomingMessage(text='1'))
+                poster.post(IncomingMessage(text='2'))
+                blocked = threading.Thread(target=poster.post, args=(IncomingMessage(text='3'),))
+                blocked.start()
+                blocked.join(0.2)
+                self.assertTrue(blocked.is_alive())
+                hook.gate.set()
+                blocked.join(5)
+                self.assertFalse(blocked.is_alive())
+            self.assertEqual(poster.dropped, 0)
+            self.assertEqual(poster.sent, 4)
+            self.assertTrue(poster.all_sent)
+
+
+
+class TestLineBatcher(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+
+    def test_max_lines(self):
+        batcher = LineBatcher(self.batches.append, max_bytes=1000, max_lines=3, max_latency=60)
+        for i in range(7):
+            batcher.add('{}\n'.format(i))
+        self.assertEqual(self.batches, ['0\n1\n2\n', '3\n4\n5\n'])
+
+    def test_max_bytes(self):
+        batcher = LineBatcher(self.batches.append, max_bytes=12, max_lines=100, max_latency=60)
+        batcher.add('abcd\n')
+        batcher.add('éfg\n')
+        self.assertEqual(self.batches, [])
+        # would grow beyond 12 bytes: the batch is flushed first
+        batcher.add('hij\n')
+        self.assertEqual(self.batches, ['abcd\néfg\n'])
+        # a line larger than max_bytes makes a batch of its own
+        batcher.add('x' * 20 + '\n')
+        self.assertEqual(self.batches, ['abcd\néfg\n', 'hij\n', 'x' * 20 + '\n'])
+        batcher.add('k\n')
+        batcher.add('lmnopqrst\n')
+        # 12 bytes reached
+        self.assertEqual(self.batches[3:], ['k\nlmnopqrst\n'])
+
+    def test_max_latency(self):
+        with LineBatcher(self.batches.append, max_bytes=1000, max_lines=100, max_latency=0.05) as batcher:
+            batcher.add(b'first\n')
+            batcher.add('second\n')
+            deadline = time.time() + 5
+            while not self.batches and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.batches, ['first\nsecond\n'])
+            batcher.add('third\n')
+        self.assertEqual(self.batches, ['first\nsecond\n', 'third\n'])
+
+    def test_flush_on_close(self):
+        with LineBatcher(self.batches.append, max_bytes=1000, max_lines=100, max_latency=60) as batcher:
+            batcher.add('pending\n')
+            self.assertEqual(self.batches, [])
+        self.assertEqual(self.batches, ['pending\n'])
+        # nothing left to flush
+        batcher.flush()
+        self.assertEqual(self.batches, ['pending\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
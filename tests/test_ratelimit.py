@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import unittest
+
+import requests
+
+from pymatter.base import send
+from pymatter.ratelimit import RateLimiter, parse_retry_after, backoff_delay
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_unlimited_until_throttled(self):
+        limiter = RateLimiter(None)
+        for _ in range(1000):
+            self.assertEqual(limiter.delay(), 0)
+        limiter.succeeded()
+        self.assertIsNone(limiter.rate)
+        limiter.throttled()
+        # starts from half the observed rate, below the rate that got throttled
+        self.assertGreaterEqual(limiter.ceiling, 1000)
+        self.assertEqual(limiter.rate, limiter.ceiling / 2)
+        self.assertGreater(limiter.delay(), 0)
+
+    def test_token_bucket(self):
+        limiter = RateLimiter(10, burst=2)
+        self.assertEqual(limiter.delay(), 0)
+        self.assertEqual(limiter.delay(), 0)
+        self.assertAlmostEqual(limiter.delay(), 0.1, delta=0.01)
+
+    def test_multiplicative_decrease(self):
+        limiter = RateLimiter(10, cooldown=60)
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 5)
+        self.assertEqual(limiter.ceiling, 10)
+        # concurrent senders throttled together cut the rate once
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 5)
+
+    def test_additive_increase(self):
+        limiter = RateLimiter(10, increase=1, cooldown=0)
+        limiter.throttled()
+        for _ in range(3):
+            limiter.succeeded()
+        self.assertEqual(limiter.rate, 8)
+        for _ in range(10):
+            limiter.succeeded()
+        # settles just under the rate that got throttled, probing slowly above it
+        self.assertAlmostEqual(limiter.rate, limiter.ceiling * 0.95)
+        self.assertGreater(limiter.rate, 9.5)
+        self.assertLess(limiter.rate, 10.5)
+
+    def test_min_rate(self):
+        limiter = RateLimiter(1, min_rate=0.5, cooldown=0)
+        for _ in range(10):
+            limiter.throttled()
+        self.assertEqual(limiter.rate, 0.5)
+
+    def test_retry_after(self):
+        limiter = RateLimiter(1000)
+        limiter.throttled(2)
+        self.assertAlmostEqual(limiter.delay(), 2, delta=0.1)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('3'), 3)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+        date = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 60))
+        self.assertAlmostEqual(parse_retry_after(date), 60, delta=2)
+
+    def test_backoff_delay(self):
+        for attempt in range(10):
+            self.assertLessEqual(backoff_delay(attempt, base=0.5, cap=4), min(4, 0.5 * 2 ** attempt))
+
+
+class FailingSession(object):
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def post(self, url, data=None):
+        self.calls += 1
+        raise self.error
+
+
+class TestSendRetries(unittest.TestCase):
+    def test_connection_errors_are_retried(self):
+        for error in (requests.ConnectionError(), requests.ConnectTimeout()):
+            session = FailingSession(error)
+            self.assertRaises(type(error), send, session, 'http://127.0.0.1/hooks/x', b'{}', None, 1)
+            self.assertEqual(session.calls, 2)
+
+    def test_read_timeouts_are_not_retried(self):
+        session = FailingSession(requests.ReadTimeout())
+        self.assertRaises(requests.ReadTimeout, send, session, 'http://127.0.0.1/hooks/x', b'{}', None, 2)
+        self.assertEqual(session.calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
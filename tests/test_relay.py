@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import tornado.gen
+import tornado.netutil
+import tornado.testing
+import tornado.web
+
+from pymatter.base import IncomingMessage
+from pymatter.oneshot import hand_off
+from pymatter.relay import RelayServer, relay_running
+
+from .test_aio import CountingServer, HookHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestRelayServer(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        app = tornado.web.Application([(r"/hooks/(.*)", HookHandler)])
+        app.requests = 0
+        return app
+
+    def get_http_server(self):
+        return CountingServer(self._app, **self.get_httpserver_options())
+
+    def setUp(self):
+        super(TestRelayServer, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'relay.sock')
+        self.relay = RelayServer(concurrency=2)
+        self.relay.add_socket(tornado.netutil.bind_unix_socket(self.path))
+
+    def tearDown(self):
+        self.relay.stop()
+        self.io_loop.run_sync(self.relay.close)
+        shutil.rmtree(self.directory)
+        super(TestRelayServer, self).tearDown()
+
+    @tornado.testing.gen_test
+    def test_messages_are_posted_over_persistent_connections(self):
+        url = self.get_url('/hooks/ok')
+        for i in range(20):
+            self.assertTrue(hand_off(url, IncomingMessage(text=str(i)), self.path))
+        self.assertTrue(hand_off(url, b'{"attachments": "invalid"}', self.path))
+        while self.relay.sent + self.relay.failed < 20:
+            yield tornado.gen.sleep(0.01)
+        self.assertEqual(self.relay.sent, 20)
+        self.assertEqual(self._app.requests, 20)
+        self.assertLessEqual(self.http_server.connections, 2)
+
+    @tornado.testing.gen_test
+    def test_request_longer_than_idle_timeout(self):
+        self.relay.idle_timeout = 0.1
+        url = self.get_url('/hooks/slow')
+        posted = self.relay.post(url, IncomingMessage(text='slow'))
+        yield tornado.gen.sleep(0.3)
+        # evicted while its request is running
+        yield self.relay.close_idle()
+        self.assertNotIn(url, self.relay.posters)
+        yield posted
+        self.assertNotIn(url, self.relay.last_used)
+        yield self.relay.close_idle()
+        # a new poster is opened for the next message
+        yield self.relay.post(self.get_url('/hooks/ok'), IncomingMessage(text='next'))
+        self.assertEqual(self.relay.sent + self.relay.failed, 2)
+
+
+class TestRelayProcess(unittest.TestCase):
+    def test_sigterm(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'relay.sock')
+        relay = subprocess.Popen([sys.executable, '-m', 'pymatter.relay', '-s', path], cwd=ROOT)
+        try:
+            deadline = time.time() + 10
+            while not relay_running(path) and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertTrue(relay_running(path))
+            relay.send_signal(signal.SIGTERM)
+            self.assertEqual(relay.wait(10), 0)
+            self.assertFalse(os.path.exists(path))
+        finally:
+            if relay.poll() is None:
+                relay.kill()
+                relay.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import json
+import os
+import sys
+import unittest
+
+from pymatter import serializer
+
+SAMPLES = [
+    {},
+    {'text': 'hello', 'username': 'pymatter', 'icon_url': 'https://example.org/icon.png'},
+    {'text': 'é ✓ 😀 "quoted" \\ back\nslash\t', 'channel': None, 'short': True, 'long': False},
+    {'attachments': [{'fields': [{'title': 'a', 'value': 'b', 'short': True}], 'text': 'x' * 5000}]},
+    {'numbers': [0, -1, 2 ** 53, 0.5, 1.25], 'nested': {'empty': [], 'list': [[], {}]}},
+    ['not', 'an', 'object'],
+]
+
+
+class TestBackends(unittest.TestCase):
+    def test_equivalent_to_the_stdlib(self):
+        reference_dumpb, reference_loads = serializer.get_backend('json')
+        for name in serializer.BACKENDS:
+            try:
+                dumpb, loads = serializer.get_backend(name)
+            except ImportError:
+                continue
+            for sample in SAMPLES:
+                with self.subTest(backend=name, sample=sample):
+                    data = dumpb(sample)
+                    self.assertIsInstance(data, bytes)
+                    self.assertEqual(data, reference_dumpb(sample))
+                    self.assertEqual(json.loads(data.decode('utf-8')), sample)
+                    self.assertEqual(loads(data), sample)
+                    self.assertEqual(loads(data.decode('utf-8')), reference_loads(data))
+
+    def test_invalid_json(self):
+        for name in serializer.BACKENDS:
+            try:
+                _, loads = serializer.get_backend(name)
+            except ImportError:
+                continue
+            for text in (b'{"text": ', b'{oops}', b''):
+                with self.subTest(backend=name, text=text):
+                    self.assertRaises(ValueError, loads, text)
+
+
+class TestSelection(unittest.TestCase):
+    def setUp(self):
+        saved = dict((name, sys.modules.get(name)) for name in ('orjson', 'ujson'))
+        self.addCleanup(self.restore, saved)
+        self.forced = os.environ.pop('PYMATTER_JSON', None)
+
+    def restore(self, saved):
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        if self.forced is not None:
+            os.environ['PYMATTER_JSON'] = self.forced
+        else:
+            os.environ.pop('PYMATTER_JSON', None)
+
+    def test_fallback_without_the_fast_extra(self):
+        # a None entry makes the import fail, as if the package was not installed
+        sys.modules['orjson'] = None
+        sys.modules['ujson'] = None
+        name, dumpb, _ = serializer._select()
+        self.assertEqual(name, 'json')
+        self.assertEqual(dumpb({'text': 'é'}), '{"text":"é"}'.encode('utf-8'))
+
+    def test_forced_backend_missing(self):
+        sys.modules['ujson'] = None
+        os.environ['PYMATTER_JSON'] = 'ujson'
+        self.assertEqual(serializer._select()[0], 'json')
+        os.environ['PYMATTER_JSON'] = 'json'
+        self.assertEqual(serializer._select()[0], 'json')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import asyncio
+import json
+import smtplib
+import threading
+import time
+import unittest
+try:
+    from ConfigParser import SafeConfigParser
+except ImportError:
+    from configparser import ConfigParser as SafeConfigParser
+
+import tornado.ioloop
+import tornado.netutil
+
+from pymatter import smtpd
+
+from .fakehook import FakeHook
+
+MAIL = (
+    'From: Alice <alice@example.org>\r\n'
+    'To: alerts@example.org\r\n'
+    'Subject: disk full\r\n'
+    '\r\n'
+    'first line\r\n'
+    '.hidden\r\n'
+    '.\r\n'
+    '..two dots\r\n'
+    'last line\r\n'
+)
+
+
+class SMTPTestCase(unittest.TestCase):
+    """
+    Run the SMTP server on an IOLoop in a background thread, in front of a fake webhook, and talk to it with smtplib.
+    """
+    def setUp(self):
+        self.hook = FakeHook().__enter__()
+        self.addCleanup(self.hook.__exit__, None, None, None)
+        config = SafeConfigParser(smtpd.defaults)
+        config.add_section('smtpd')
+        config.add_section('mattermost')
+        config.add_section('recipients')
+        config.set('smtpd', 'hostname', 'test')
+        config.set('smtpd', 'max_size', '20000')
+        config.set('smtpd', 'max_parse', '2000')
+        config.set('mattermost', 'url', self.hook.url.rsplit('/', 1)[0])
+        config.set('recipients', 'alerts@example.org', 'test')
+        sockets = tornado.netutil.bind_sockets(0, '127.0.0.1')
+        self.port = sockets[0].getsockname()[1]
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            self.io_loop = tornado.ioloop.IOLoop.current()
+            self.server = smtpd.SMTPServer(config)
+            self.server.add_sockets(sockets)
+            self.io_loop.add_callback(started.set)
+            self.io_loop.start()
+            self.io_loop.run_sync(self.server.close)
+            self.io_loop.close(all_fds=True)
+
+        self.thread = threading.Thread(target=run)
+        self.thread.start()
+        self.assertTrue(started.wait(5))
+        self.addCleanup(self.stop)
+
+    def stop(self):
+        # let the sessions notice that the clients are gone
+        deadline = time.time() + 5
+        while self.server.connections and time.time() < deadline:
+            time.sleep(0.01)
+        self.io_loop.add_callback(self.io_loop.stop)
+        self.thread.join(5)
+
+    def connect(self):
+        client = smtplib.SMTP('127.0.0.1', self.port, timeout=5)
+        self.addCleanup(client.close)
+        return client
+
+    def posted(self):
+        return [json.loads(body.decode('utf-8')) for body in self.hook.bodies]
+
+
+class TestSMTP(SMTPTestCase):
+    def test_dot_unstuffing(self):
+        client = self.connect()
+        # smtplib stuffs the lines starting with a dot
+        client.sendmail('alice@example.org', ['alerts@example.org'], MAIL)
+        client.quit()
+        posted = self.posted()
+        self.assertEqual(len(posted), 1)
+        attachment = posted[0]['attachments'][0]
+        self.assertEqual(attachment['title'], 'disk full')
+        self.assertEqual(attachment['text'].splitlines(), ['first line', '.hidden', '.', '..two dots', 'last line'])
+        self.assertNotIn('Truncated', [f['title'] for f in attachment['fields']])
+
+    def test_unknown_recipient(self):
+        client = self.connect()
+        client.ehlo()
+        self.assertEqual(client.mail('alice@example.org')[0], 250)
+        self.assertEqual(client.rcpt('nobody@example.org')[0], 550)
+        self.assertEqual(client.rcpt('ALERTS@example.org')[0], 250)
+        self.assertRaises(smtplib.SMTPRecipientsRefused, client.sendmail, 'alice@example.org',
+                          ['nobody@example.org'], MAIL)
+        self.assertEqual(self.hook.bodies, [])
+
+    def test_truncated_mail(self):
+        client = self.connect()
+        client.sendmail('alice@example.org', ['alerts@example.org'], MAIL + ('x' * 70 + '\r\n') * 100)
+        attachment = self.posted()[0]['attachments'][0]
+        self.assertIn({'title': 'Truncated', 'value': 'yes', 'short': True}, attachment['fields'])
+        self.assertEqual(attachment['text'].splitlines()[0], 'first line')
+
+    def test_oversized_mail(self):
+        client = self.connect()
+        client.ehlo()
+        self.assertEqual(client.mail('alice@example.org', ['SIZE=30000'])[0], 552)
+        # without the SIZE parameter, the mail is refused once read
+        client.mail('alice@example.org')
+        client.rcpt('alerts@example.org')
+        code, _ = client.data(MAIL + ('x' * 70 + '\r\n') * 400)
+        self.assertEqual(code, 552)
+        self.assertEqual(client.noop()[0], 250)
+        self.assertEqual(self.hook.bodies, [])
+
+    def test_rset_and_quit(self):
+        client = self.connect()
+        client.ehlo()
+        client.mail('alice@example.org')
+        client.rcpt('alerts@example.org')
+        self.assertEqual(client.rset()[0], 250)
+        self.assertEqual(client.docmd('DATA')[0], 503)
+        self.assertEqual(client.docmd('RCPT TO:<alerts@example.org>')[0], 503)
+        self.assertEqual(client.quit()[0], 221)
+        self.assertEqual(self.hook.bodies, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
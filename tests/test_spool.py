@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pymatter.base import AsyncPoster, IncomingMessage
+from pymatter.ratelimit import RateLimiter
+from pymatter.spool import Spool, HEADER
+
+from .fakehook import FakeHook
+
+
+class SpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestSpool(SpoolTestCase):
+    def test_records_are_read_in_order(self):
+        spool = Spool(self.directory)
+        for i in range(10):
+            spool.append(b'record %d' % i)
+        records = spool.pending(4)
+        self.assertEqual([data for _, data in records], [b'record %d' % i for i in range(4)])
+        spool.commit(records[-1][0])
+        self.assertEqual([data for _, data in spool.pending()], [b'record %d' % i for i in range(4, 10)])
+        spool.close()
+
+    def test_cursor_survives_a_restart(self):
+        spool = Spool(self.directory)
+        for i in range(5):
+            spool.append(b'record %d' % i)
+        spool.commit(spool.pending(2)[-1][0])
+        spool.close()
+        spool = Spool(self.directory)
+        self.assertEqual([data for _, data in spool.pending()], [b'record %d' % i for i in range(2, 5)])
+        spool.close()
+
+    def test_partial_record_after_a_crash(self):
+        spool = Spool(self.directory, sync_every=1)
+        spool.append(b'complete')
+        path = spool.segment_path(spool.segments[-1])
+        spool.close()
+        # the process died while writing the second record
+        with open(path, 'ab') as f:
+            f.write(HEADER.pack(100, 0) + b'trunc')
+        spool = Spool(self.directory)
+        self.assertEqual([data for _, data in spool.pending()], [b'complete'])
+        spool.append(b'after restart')
+        self.assertEqual([data for _, data in spool.pending()], [b'complete', b'after restart'])
+        spool.close()
+
+    def test_corrupted_record(self):
+        spool = Spool(self.directory)
+        spool.append(b'first')
+        spool.append(b'second')
+        path = spool.segment_path(spool.segments[-1])
+        spool.close()
+        with open(path, 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'X')
+        spool = Spool(self.directory)
+        self.assertEqual([data for _, data in spool.pending()], [b'first'])
+        spool.close()
+
+    def test_consumed_segments_are_deleted(self):
+        spool = Spool(self.directory, segment_size=64)
+        for i in range(20):
+            spool.append(b'x' * 20)
+        self.assertGreater(len(spool.segments), 5)
+        records = spool.pending(1000)
+        self.assertEqual(len(records), 20)
+        spool.commit(records[-1][0])
+        self.assertEqual(len(spool.segments), 1)
+        self.assertEqual(len([n for n in os.listdir(self.directory) if n.endswith('.seg')]), 1)
+        spool.close()
+
+
+class TestSpooledPoster(SpoolTestCase):
+    def test_undelivered_messages_are_delivered_by_the_next_poster(self):
+        with FakeHook(codes=[503] * 1000) as hook:
+            spool = Spool(self.directory)
+            with AsyncPoster(hook.url, spool=spool, max_retries=0, limiter=RateLimiter(None)) as poster:
+                deliveries = [poster.post(IncomingMessage(text=str(i))) for i in range(3)]
+                while not hook.received:
+                    hook.request_started.wait(1)
+            spool.close()
+            self.assertFalse(any(d.done() for d in deliveries))
+            self.assertEqual(hook.bodies, [])
+
+        with FakeHook() as hook:
+            spool = Spool(self.directory)
+            with AsyncPoster(hook.url, spool=spool, limiter=RateLimiter(None)) as poster:
+                while len(hook.bodies) < 3:
+                    hook.request_started.wait(1)
+                    hook.request_started.clear()
+            spool.close()
+            self.assertEqual(poster.sent, 3)
+            self.assertEqual(hook.bodies, [IncomingMessage(text=str(i)).dumpb() for i in range(3)])
+            spool = Spool(self.directory)
+            self.assertEqual(spool.pending(), [])
+            spool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pymatter.base import AsyncPoster
+from pymatter.tail import Checkpoint, FollowedFile, Follower
+
+from .fakehook import FakeHook
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'app.log')
+        with open(self.path, 'w') as f:
+            f.write('first\nsecond\n')
+        self.checkpoint = Checkpoint(os.path.join(self.directory, 'checkpoint'))
+
+    def follower(self, poster):
+        return Follower(FollowedFile(self.path), poster, self.checkpoint, {}, [], 'text', True, 4000, 1, 60)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_checkpoint_follows_deliveries(self):
+        with FakeHook() as hook:
+            with AsyncPoster(hook.url, max_retries=0) as poster:
+                follower = self.follower(poster)
+                hook.gate.clear()
+                follower.poll(start_at_end=False)
+                self.assertTrue(hook.request_started.wait(5))
+                # posted, not delivered
+                self.assertEqual(self.checkpoint.get(self.path), (None, None))
+                hook.gate.set()
+                self.wait_for(lambda: self.checkpoint.get(self.path)[1] == 13)
+            self.assertEqual(len(hook.bodies), 2)
+        self.checkpoint.save()
+        self.assertEqual(Checkpoint(self.checkpoint.filename).get(self.path)[1], 13)
+
+    def test_stop_before_delivery(self):
+        with FakeHook() as hook:
+            hook.gate.clear()
+            poster = AsyncPoster(hook.url, max_retries=0).__enter__()
+            follower = self.follower(poster)
+            follower.poll(start_at_end=False)
+            self.assertTrue(hook.request_started.wait(5))
+            self.checkpoint.save()
+            # the lines will be read again by the next run
+            self.assertEqual(Checkpoint(self.checkpoint.filename).get(self.path), (None, None))
+            hook.gate.set()
+            poster.__exit__(None, None, None)
+
+    def test_failed_batches_are_passed(self):
+        with FakeHook(codes=[400]) as hook:
+            with AsyncPoster(hook.url, max_retries=0) as poster:
+                self.follower(poster).poll(start_at_end=False)
+            self.assertEqual(len(hook.received), 2)
+        self.assertEqual(self.checkpoint.get(self.path)[1], 13)
+
+
+if __name__ == '__main__':
+    unittest.main()
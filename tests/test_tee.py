@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import io
+import threading
+import time
+import unittest
+
+from pymatter.tee import SideChannel, LineSplitter, TailBuffer, pump
+
+
+class SlowConsumer(object):
+    def __init__(self):
+        self.gate = threading.Event()
+        self.blocks = []
+        self.gaps = []
+
+    def feed(self, block):
+        self.gate.wait()
+        self.blocks.append(block)
+
+    def skipped(self, size):
+        self.gaps.append(size)
+
+    def close(self):
+        pass
+
+
+class TestSideChannel(unittest.TestCase):
+    def test_block(self):
+        consumer = SlowConsumer()
+        with SideChannel(consumer, max_blocks=1) as side:
+            producer = threading.Thread(target=lambda: [side.put(b'x' * 10) for _ in range(5)])
+            producer.start()
+            producer.join(0.2)
+            self.assertTrue(producer.is_alive())
+            consumer.gate.set()
+            producer.join(5)
+        self.assertEqual(side.dropped, 0)
+        self.assertEqual(consumer.blocks, [b'x' * 10] * 5)
+        self.assertEqual(consumer.gaps, [])
+
+    def test_drop(self):
+        consumer = SlowConsumer()
+        with SideChannel(consumer, max_blocks=1, block=False) as side:
+            for _ in range(5):
+                side.put(b'x' * 10)
+            consumer.gate.set()
+            while not side.queue.empty():
+                time.sleep(0.01)
+            side.put(b'y')
+        self.assertGreater(side.dropped, 0)
+        self.assertEqual(sum(consumer.gaps), side.dropped)
+        self.assertEqual(consumer.blocks[-1], b'y')
+
+    def test_buffered(self):
+        tail = TailBuffer(25)
+        source = io.BytesIO(b''.join(b'line %d\n' % i for i in range(100)))
+        with SideChannel(tail, max_blocks=1) as side:
+            pump(source, io.BytesIO(), side, block_size=7)
+        self.assertEqual(side.dropped, 0)
+        text = tail.text()
+        self.assertEqual(len(text), 25)
+        self.assertTrue(text.endswith('line 99\n'))
+        self.assertEqual(tail.omitted, len(source.getvalue()) - 25)
+
+
+class TestLineSplitter(unittest.TestCase):
+    def test_lines(self):
+        lines = []
+        splitter = LineSplitter(lines.append)
+        splitter.feed(b'one\ntw')
+        splitter.feed(b'o\n\xc3')
+        splitter.feed(b'\xa9t\xc3')
+        splitter.skipped(10)
+        splitter.feed(b'three')
+        splitter.close()
+        self.assertEqual(lines, ['one\n', 'two\n', '\xe9t[... 10 bytes skipped ...]\n', 'three\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()